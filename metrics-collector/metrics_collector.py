@@ -19,6 +19,8 @@
 #
 ###############################################################################
 
+from bisect import bisect_left
+from itertools import accumulate
 import json
 import logging
 import random
@@ -26,6 +28,7 @@ import string
 import os
 import sys
 import ssl
+import threading
 from urllib.parse import urlparse
 import paho.mqtt.client as mqtt
 from paho.mqtt.packettypes import PacketTypes
@@ -36,6 +39,9 @@ from prometheus_client import (
     start_http_server, REGISTRY, GC_COLLECTOR,
     PLATFORM_COLLECTOR, PROCESS_COLLECTOR
 )
+from prometheus_client.core import HistogramMetricFamily
+from prometheus_client.registry import Collector
+from prometheus_client.utils import floatToGoString
 
 REGISTRY.unregister(GC_COLLECTOR)
 REGISTRY.unregister(PLATFORM_COLLECTOR)
@@ -52,6 +58,86 @@ logging.basicConfig(stream=sys.stdout)
 LOGGER = logging.getLogger(__name__)
 LOGGER.setLevel(LOGGING_LEVEL)
 
+
+class RelayHistogram(Collector):
+    """Histogram aggregating relay observations and snapshot totals per
+    label values, exposed as a HistogramMetricFamily"""
+
+    def __init__(self, name: str, documentation: str, labelnames: list,
+                 buckets: tuple) -> None:
+        """
+        Relay histogram initializer, registering it
+
+        :param name: `str` of metric name
+        :param documentation: `str` of metric help
+        :param labelnames: `list` of label names
+        :param buckets: `tuple` of bucket upper bounds, without `+Inf`
+
+        :returns: `None`
+        """
+
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = list(labelnames)
+        self.buckets = [float(bucket) for bucket in buckets]
+        # label values: [counts per bucket, then above all buckets, sum]
+        self.totals = {}
+        self.lock = threading.Lock()
+
+        REGISTRY.register(self)
+
+    def get_totals(self, labels: list) -> list:
+        return self.totals.setdefault(
+            tuple(labels), [[0] * (len(self.buckets) + 1), 0])
+
+    def observe(self, labels: list, value: float) -> None:
+        with self.lock:
+            totals = self.get_totals(labels)
+            totals[0][bisect_left(self.buckets, value)] += 1
+            totals[1] += value
+
+    def add(self, labels: list, totals: dict) -> bool:
+        """
+        Add the totals of a relay snapshot
+
+        :param labels: `list` of metric label values
+        :param totals: `dict` of bucket counts (the last one for
+                       observations above all buckets) and sum
+
+        :returns: `bool` of whether the buckets of the totals match
+        """
+
+        if len(totals['buckets']) != len(self.buckets) + 1:
+            return False
+
+        with self.lock:
+            current = self.get_totals(labels)
+            for i, count in enumerate(totals['buckets']):
+                current[0][i] += count
+            current[1] += totals['sum']
+
+        return True
+
+    def describe(self) -> list:
+        return [HistogramMetricFamily(self.name, self.documentation,
+                                      labels=self.labelnames)]
+
+    def collect(self) -> list:
+        family = HistogramMetricFamily(self.name, self.documentation,
+                                       labels=self.labelnames)
+        bounds = [floatToGoString(bucket) for bucket in self.buckets]
+        bounds.append('+Inf')
+
+        with self.lock:
+            totals = [(labels, list(accumulate(counts)), sum_)
+                      for labels, (counts, sum_) in self.totals.items()]
+
+        for labels, counts, sum_ in totals:
+            family.add_metric(list(labels), list(zip(bounds, counts)), sum_)
+
+        return [family]
+
+
 # sets metrics as per https://github.com/wmo-im/wis2-metric-hierarchy/blob/main/metric-hierarchy/gdc.csv  # noqa
 
 METRIC_NO_METADATA = Counter(
@@ -60,13 +146,13 @@ METRIC_NO_METADATA = Counter(
     ['centre_id', 'report_by']
 )
 
-METRIC_INVALID = Counter(
+METRIC_INVALID_TOPIC = Counter(
     'wmo_wis2_gb_messages_invalid_topic_total',
     'Number of WIS2 messages published to invalid topic',
     ['centre_id', 'report_by']
 )
 
-METRIC_INVALID = Counter(
+METRIC_INVALID_FORMAT = Counter(
     'wmo_wis2_gb_messages_invalid_format_total',
     'Number of WIS2 messages failed validation',
     ['centre_id', 'report_by']
@@ -96,6 +182,211 @@ METRIC_TIMESTAMP_SECONDS = Gauge(
     ['centre_id', 'report_by']
 )
 
+METRIC_DEDUP_BATCH_SIZE = RelayHistogram(
+    'wmo_wis2_gb_dedup_batch_size',
+    'Number of message ids per Redis de-duplication batch',
+    ['centre_id', 'report_by'],
+    (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000)
+)
+
+METRIC_DEDUP_LATENCY_SECONDS = RelayHistogram(
+    'wmo_wis2_gb_dedup_latency_seconds',
+    'Round trip time in seconds of Redis de-duplication batches',
+    ['centre_id', 'report_by'],
+    (.0005, .001, .0025, .005, .01, .025, .05, .1, .25, .5, 1)
+)
+
+METRIC_DEDUP_CACHE_HITS = Counter(
+    'wmo_wis2_gb_dedup_cache_hits_total',
+    'Number of duplicate message ids rejected by the in-memory cache',
+    ['centre_id', 'report_by']
+)
+
+METRIC_DEDUP_CACHE_MISSES = Counter(
+    'wmo_wis2_gb_dedup_cache_misses_total',
+    'Number of message ids not found in the in-memory cache',
+    ['centre_id', 'report_by']
+)
+
+METRIC_DEDUP_CACHE_EVICTIONS = Counter(
+    'wmo_wis2_gb_dedup_cache_evictions_total',
+    'Number of live message ids evicted from the in-memory cache',
+    ['centre_id', 'report_by']
+)
+
+METRIC_DEDUP_DEGRADED_FLAG = Gauge(
+    'wmo_wis2_gb_dedup_degraded_flag',
+    'Whether de-duplication runs locally because Redis is unavailable',
+    ['centre_id', 'report_by']
+)
+
+METRIC_DEDUP_WRITEBACK = Counter(
+    'wmo_wis2_gb_dedup_writeback_total',
+    'Number of locally de-duplicated message ids written back to Redis',
+    ['centre_id', 'report_by']
+)
+
+METRIC_DEDUP_WON = Counter(
+    'wmo_wis2_gb_dedup_won_total',
+    'Number of message ids an upstream delivered first',
+    ['centre_id', 'report_by']
+)
+
+METRIC_DEDUP_DUPLICATE = Counter(
+    'wmo_wis2_gb_dedup_duplicate_total',
+    'Number of message ids an upstream delivered after another',
+    ['centre_id', 'report_by']
+)
+
+METRIC_DEDUP_DUPLICATE_LAG_SECONDS = RelayHistogram(
+    'wmo_wis2_gb_dedup_duplicate_lag_seconds',
+    'Time in seconds from the first arrival of a message id to its arrival from an upstream',  # noqa
+    ['centre_id', 'report_by'],
+    (.01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30, 60, 300, 900, 3600)
+)
+
+METRIC_DEDUP_LATE_DUPLICATE = Counter(
+    'wmo_wis2_gb_dedup_late_duplicate_total',
+    'Number of message ids seen before that arrived after the de-duplication TTL',  # noqa
+    ['centre_id', 'report_by']
+)
+
+METRIC_DEDUP_TTL_SECONDS = Gauge(
+    'wmo_wis2_gb_dedup_ttl_seconds',
+    'Seconds message ids are remembered in Redis',
+    ['centre_id', 'report_by']
+)
+
+METRIC_PUBLISH_LATENCY_SECONDS = RelayHistogram(
+    'wmo_wis2_gb_publish_latency_seconds',
+    'Time in seconds from publish to Global Broker acknowledgement',
+    ['centre_id', 'report_by'],
+    (.0005, .001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5)
+)
+
+METRIC_PUBLISH_QUEUE_DEPTH = Gauge(
+    'wmo_wis2_gb_publish_queue_depth',
+    'Number of messages waiting for a Global Broker publisher connection',
+    ['centre_id', 'report_by', 'connection']
+)
+
+METRIC_PUBLISH_CONNECTION = Counter(
+    'wmo_wis2_gb_publish_connection_total',
+    'Number of messages published by a Global Broker publisher connection',
+    ['centre_id', 'report_by', 'connection']
+)
+
+METRIC_QUEUE_OVERFLOW = Counter(
+    'wmo_wis2_gb_queue_overflow_total',
+    'Number of items put on a full relay queue',
+    ['centre_id', 'report_by', 'queue']
+)
+
+METRIC_QUEUE_DROPPED = Counter(
+    'wmo_wis2_gb_queue_dropped_total',
+    'Number of items dropped by the overflow policy of a relay queue',
+    ['centre_id', 'report_by', 'queue']
+)
+
+METRIC_QUEUE_SPILLED = Counter(
+    'wmo_wis2_gb_queue_spilled_total',
+    'Number of items spilled to the overflow buffer of a relay queue',
+    ['centre_id', 'report_by', 'queue']
+)
+
+METRIC_QUEUE_HIGH_WATERMARK = Gauge(
+    'wmo_wis2_gb_queue_high_watermark',
+    'Highest number of items in a relay queue over the last interval',
+    ['centre_id', 'report_by', 'queue']
+)
+
+METRIC_QUEUE_SPOOL_BYTES = Gauge(
+    'wmo_wis2_gb_queue_spool_bytes',
+    'Number of bytes on disk of the spool of a relay queue',
+    ['centre_id', 'report_by', 'queue']
+)
+
+METRIC_QUEUE_LANE_LATENCY_SECONDS = RelayHistogram(
+    'wmo_wis2_gb_queue_lane_latency_seconds',
+    'Time in seconds messages of a priority lane wait to be published',
+    ['centre_id', 'report_by', 'lane'],
+    (.001, .005, .01, .05, .1, .5, 1, 5, 10, 30, 60)
+)
+
+METRIC_VALIDATE_FALLBACK = Counter(
+    'wmo_wis2_gb_validate_fallback_total',
+    'Number of messages validated in process as the validation pool was full',
+    ['centre_id', 'report_by']
+)
+
+METRIC_VALIDATION_RATE = Gauge(
+    'wmo_wis2_gb_validation_rate',
+    'Fraction of new messages of a centre validated against the schema over the last interval',  # noqa
+    ['centre_id', 'report_by']
+)
+
+METRIC_ACTIVE_VERSION = Gauge(
+    'wmo_wis2_gb_active_version',
+    'Whether a version of the topic hierarchy or message schema is in use (1) or was replaced (0)',  # noqa
+    ['centre_id', 'report_by', 'component', 'version']
+)
+
+METRIC_CHECK = Counter(
+    'wmo_wis2_gb_check_total',
+    'Number of messages checked by a check stage',
+    ['centre_id', 'report_by', 'stage']
+)
+
+METRIC_CHECK_REJECTED = Counter(
+    'wmo_wis2_gb_check_rejected_total',
+    'Number of messages rejected by a check stage',
+    ['centre_id', 'report_by', 'stage']
+)
+
+METRIC_CHECK_SECONDS = Counter(
+    'wmo_wis2_gb_check_seconds_total',
+    'Time in seconds spent by messages in a check stage',
+    ['centre_id', 'report_by', 'stage']
+)
+
+# relay metric names, as published to wis2-globalbroker/metrics/{name}
+METRICS = {
+    'no_metadata_total': METRIC_NO_METADATA,
+    'invalid_topic_total': METRIC_INVALID_TOPIC,
+    'invalid_format_total': METRIC_INVALID_FORMAT,
+    'published_total': METRIC_PUBLISHED,
+    'messages_received_total': METRIC_RECEIVED,
+    'connected_flag': METRIC_CONNECTED_FLAG,
+    'last_message_timestamp': METRIC_TIMESTAMP_SECONDS,
+    'dedup_batch_size': METRIC_DEDUP_BATCH_SIZE,
+    'dedup_latency_seconds': METRIC_DEDUP_LATENCY_SECONDS,
+    'dedup_cache_hits_total': METRIC_DEDUP_CACHE_HITS,
+    'dedup_cache_misses_total': METRIC_DEDUP_CACHE_MISSES,
+    'dedup_cache_evictions_total': METRIC_DEDUP_CACHE_EVICTIONS,
+    'dedup_degraded_flag': METRIC_DEDUP_DEGRADED_FLAG,
+    'dedup_writeback_total': METRIC_DEDUP_WRITEBACK,
+    'dedup_won_total': METRIC_DEDUP_WON,
+    'dedup_duplicate_total': METRIC_DEDUP_DUPLICATE,
+    'dedup_duplicate_lag_seconds': METRIC_DEDUP_DUPLICATE_LAG_SECONDS,
+    'dedup_late_duplicate_total': METRIC_DEDUP_LATE_DUPLICATE,
+    'dedup_ttl_seconds': METRIC_DEDUP_TTL_SECONDS,
+    'publish_latency_seconds': METRIC_PUBLISH_LATENCY_SECONDS,
+    'publish_queue_depth': METRIC_PUBLISH_QUEUE_DEPTH,
+    'publish_connection_total': METRIC_PUBLISH_CONNECTION,
+    'queue_overflow_total': METRIC_QUEUE_OVERFLOW,
+    'queue_dropped_total': METRIC_QUEUE_DROPPED,
+    'queue_spilled_total': METRIC_QUEUE_SPILLED,
+    'queue_high_watermark': METRIC_QUEUE_HIGH_WATERMARK,
+    'queue_spool_bytes': METRIC_QUEUE_SPOOL_BYTES,
+    'queue_lane_latency_seconds': METRIC_QUEUE_LANE_LATENCY_SECONDS,
+    'validate_fallback_total': METRIC_VALIDATE_FALLBACK,
+    'validation_rate': METRIC_VALIDATION_RATE,
+    'active_version': METRIC_ACTIVE_VERSION,
+    'check_total': METRIC_CHECK,
+    'check_rejected_total': METRIC_CHECK_REJECTED,
+    'check_seconds_total': METRIC_CHECK_SECONDS
+}
+
 
 def init_metrics() -> None:
     """
@@ -107,6 +398,71 @@ def init_metrics() -> None:
     disable_created_metrics()
 
 
+def apply_metric(name: str, labels: list, value=None) -> None:
+    """
+    Applies a single relay metric event
+
+    :param name: `str` of relay metric name
+    :param labels: `list` of metric label values
+    :param value: value of metric event (counter increment, gauge value
+                  or histogram observation)
+
+    :returns: `None`
+    """
+
+    metric = METRICS.get(name)
+
+    if metric is None:
+        LOGGER.debug(f'Unknown metric {name}')
+    elif isinstance(metric, Counter):
+        metric.labels(*labels).inc(1 if value is None else value)
+    elif isinstance(metric, Gauge):
+        metric.labels(*labels).set(value)
+    else:
+        metric.observe(labels, value)
+
+
+def apply_histogram(name: str, labels: list, totals: dict) -> None:
+    """
+    Applies relay histogram totals: per bucket counts (the last one for
+    observations above all buckets) and the sum of observations
+
+    :param name: `str` of relay metric name
+    :param labels: `list` of metric label values
+    :param totals: `dict` of histogram bucket counts, sum and count
+
+    :returns: `None`
+    """
+
+    metric = METRICS.get(name)
+
+    if not isinstance(metric, RelayHistogram):
+        LOGGER.debug(f'Unknown histogram {name}')
+    elif not metric.add(labels, totals):
+        LOGGER.warning(f'Histogram {name} buckets do not match')
+
+
+def apply_snapshot(snapshot: dict) -> None:
+    """
+    Applies a relay metrics snapshot: counters are deltas since the
+    previous snapshot, gauges are last values and histograms are bucket
+    counts and sums of the observations since the previous snapshot
+
+    :param snapshot: `dict` of metrics snapshot
+
+    :returns: `None`
+    """
+
+    labels = snapshot['labels']
+
+    for name, value in snapshot.get('counters', {}).items():
+        apply_metric(name, labels, value)
+    for name, value in snapshot.get('gauges', {}).items():
+        apply_metric(name, labels, value)
+    for name, totals in snapshot.get('histograms', {}).items():
+        apply_histogram(name, labels, totals)
+
+
 def collect_metrics() -> None:
     """
     Subscribe to MQTT wis2-globalbroker/metrics and collect metrics
@@ -130,20 +486,11 @@ def collect_metrics() -> None:
         LOGGER.debug(f'Topic: {topic}')
         LOGGER.debug(f"Labels: {payload['labels']}")
         LOGGER.debug(f"Value: {payload.get('labels')}")
-        if topic == 'wis2-globalbroker/metrics/published_total':
-            METRIC_PUBLISHED.labels(*labels).inc()
-        elif topic == 'wis2-globalbroker/metrics/invalid_topic_total':
-            METRIC_INVALID.labels(*labels).inc()
-        elif topic == 'wis2-globalbroker/metrics/invalid_format_total':
-            METRIC_INVALID.labels(*labels).inc()
-        elif topic == 'wis2-globalbroker/metrics/messages_received_total':
-            METRIC_RECEIVED.labels(*labels).inc()
-        elif topic == 'wis2-globalbroker/metrics/no_metadata_total':
-            METRIC_NO_METADATA.labels(*labels).inc()
-        elif topic == 'wis2-globalbroker/metrics/last_message_timestamp':
-            METRIC_TIMESTAMP_SECONDS.labels(*labels).set(value)
-        elif topic == 'wis2-globalbroker/metrics/connected_flag':
-            METRIC_CONNECTED_FLAG.labels(*labels).set(value)
+        name = topic.split('/')[-1]
+        if name == 'snapshot':
+            apply_snapshot(payload)
+        else:
+            apply_metric(name, labels, value)
 
     def setup_mqtt_client(connection_info: str, verify_cert: bool):
         randstring = ''.join(random.choice(string.hexdigits) for i in range(6))
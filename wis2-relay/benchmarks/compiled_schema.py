@@ -0,0 +1,201 @@
+###############################################################################
+#
+# Licensed to the Apache Software Foundation (ASF) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The ASF licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+#
+###############################################################################
+
+"""
+Conformance and throughput of the compiled message schema against
+jsonschema, on a corpus of messages and random mutations of them
+
+    python benchmarks/compiled_schema.py --messages 2000 --mutations 10
+"""
+
+import copy
+import json
+import random
+import time
+import uuid
+
+import click
+from jsonschema.validators import Draft202012Validator
+
+from wis2_relay.schema import MESSAGE_SCHEMA
+from wis2_relay.schema_compiler import (compile_schema, FORMAT_CHECKER,
+                                        schema_digest)
+
+# values replacing those of messages in mutations
+VALUES = [None, 1, 1.5, True, False, '', 'x', 'not a uri', [], {}, 0, -1,
+          5000, 'Feature', 'Point', '2024-13-01T00:00:00Z', 'urn:wmo:md:x',
+          'sha512', 'utf-8', [1], [200, 0], [10, 95], {'type': 'Point'},
+          'a' * 5000, 4096, 4097]
+
+
+def message(rnd: random.Random, i: int) -> dict:
+    """
+    Create a valid WIS2 notification message
+
+    :param rnd: `random.Random` of generator
+    :param i: `int` of message number
+
+    :returns: `dict` of message
+    """
+
+    message = {
+        'id': str(uuid.UUID(int=rnd.getrandbits(128))),
+        'conformsTo': ['http://wis.wmo.int/spec/wnm/1/conf/core'],
+        'type': 'Feature',
+        'geometry': rnd.choice([
+            None,
+            {'type': 'Point', 'coordinates': [10.5, 45.2, 100]},
+            {'type': 'Polygon',
+             'coordinates': [[[0, 0], [1, 0], [1, 1], [0, 0]]]}]),
+        'properties': {
+            'pubtime': '2024-06-01T12:00:00Z',
+            'data_id': f'ca-eccc-msc/data/{i}',
+            'metadata_id': 'urn:wmo:md:ca-eccc-msc:x',
+            'datetime': '2024-06-01T12:00:00Z',
+            'integrity': {'method': 'sha512', 'value': 'abc='}
+        },
+        'links': [{'href': f'https://example.org/data/{i}.bufr4',
+                   'rel': 'canonical', 'type': 'application/bufr',
+                   'length': 123}]
+    }
+    properties = message['properties']
+    if i % 3 == 0:
+        properties['content'] = {'encoding': 'utf-8', 'value': 'x' * 50,
+                                 'size': 50}
+    if i % 4 == 0:
+        del properties['datetime']
+        properties['start_datetime'] = '2024-06-01T00:00:00Z'
+        properties['end_datetime'] = '2024-06-01T06:00:00Z'
+
+    return message
+
+
+def paths(value, prefix: tuple = ()):
+    if prefix:
+        yield prefix
+    if isinstance(value, dict):
+        for key, item in value.items():
+            yield from paths(item, prefix + (key,))
+    elif isinstance(value, list):
+        for index, item in enumerate(value):
+            yield from paths(item, prefix + (index,))
+
+
+def mutate(rnd: random.Random, message: dict) -> dict:
+    """
+    Delete, add or replace one to three values of a message
+
+    :param rnd: `random.Random` of generator
+    :param message: `dict` of message
+
+    :returns: `dict` of mutated copy of the message
+    """
+
+    message = copy.deepcopy(message)
+    candidates = list(paths(message))
+
+    for _ in range(rnd.choice([1, 1, 1, 2, 3])):
+        path = rnd.choice(candidates)
+        parent = message
+        try:
+            for key in path[:-1]:
+                parent = parent[key]
+            operation = rnd.random()
+            if operation < 0.3 and isinstance(parent, dict):
+                del parent[path[-1]]
+            elif operation < 0.4 and isinstance(parent, dict):
+                parent[rnd.choice(['extra', 'x-1'])] = rnd.choice(VALUES)
+            elif operation < 0.45 and isinstance(parent, list):
+                parent.append(rnd.choice(VALUES))
+            else:
+                parent[path[-1]] = rnd.choice(VALUES)
+        except (KeyError, IndexError, TypeError):
+            # an earlier mutation removed or replaced the path
+            pass
+
+    return message
+
+
+def rate(function, messages: list) -> float:
+    start = time.perf_counter()
+    for message in messages:
+        function(message)
+    return len(messages) / (time.perf_counter() - start)
+
+
+@click.command()
+@click.option('--schema', 'path', type=click.Path(exists=True),
+              default=str(MESSAGE_SCHEMA), help='Message schema')
+@click.option('--messages', 'count', type=int, default=2000,
+              help='Number of valid messages of the corpus')
+@click.option('--mutations', type=int, default=10,
+              help='Number of mutations per message')
+@click.option('--seed', type=int, default=1, help='Random seed')
+def main(path, count, mutations, seed):
+    """Benchmark the compiled message schema against jsonschema"""
+
+    with open(path, 'rb') as fh:
+        schema_bytes = fh.read()
+    schema = json.loads(schema_bytes)
+
+    namespace = {}
+    exec(compile_schema(schema, schema_digest(schema_bytes)), namespace)
+    compiled = namespace['validate']
+    validator = Draft202012Validator(schema, format_checker=FORMAT_CHECKER)
+
+    rnd = random.Random(seed)
+    corpus = []
+    for i in range(count):
+        corpus.append(message(rnd, i))
+        corpus += [mutate(rnd, corpus[-1]) for _ in range(mutations)]
+
+    def validate_message(message, compiled=None):
+        # as WNMValidate.validate_message
+        if compiled is not None and compiled(message):
+            return True, None
+        try:
+            validator.validate(message)
+            return True, None
+        except Exception as err:
+            return False, repr(err)
+
+    verdicts = [validator.is_valid(message) for message in corpus]
+    mismatches = sum(compiled(message) != verdict
+                     for message, verdict in zip(corpus, verdicts))
+    differences = sum(validate_message(message) !=
+                      validate_message(message, compiled)
+                      for message in corpus)
+    click.echo(f'{len(corpus)} messages, {sum(verdicts)} valid: '
+               f'{mismatches} validity mismatches, {differences} '
+               'validate_message output differences')
+
+    valid = [message for message, verdict in zip(corpus, verdicts)
+             if verdict]
+    click.echo(f'jsonschema: {rate(validator.validate, valid):.0f} '
+               'valid messages/s')
+    click.echo(f'compiled: {rate(compiled, valid):.0f} valid messages/s')
+    namespace['check_format'] = FORMAT_CHECKER.conforms
+    click.echo(f'compiled without the format memo: '
+               f'{rate(compiled, valid):.0f} valid messages/s')
+
+
+if __name__ == '__main__':
+    main()
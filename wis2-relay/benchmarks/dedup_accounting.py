@@ -0,0 +1,168 @@
+###############################################################################
+#
+# Licensed to the Apache Software Foundation (ASF) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The ASF licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+#
+###############################################################################
+
+"""
+Throughput of the dedup layouts with and without upstream accounting,
+and consistency of the accounting counters, with upstreams delivering
+the same message ids.  With --stats, shows the counters of the relays
+instead
+
+    python benchmarks/dedup_accounting.py --redis localhost --upstreams 3
+    python benchmarks/dedup_accounting.py --redis localhost --stats
+"""
+
+import time
+import uuid
+
+import click
+from redis.cluster import RedisCluster as Redis
+
+from wis2_relay.dedup import (BucketLayout, create_layout, DEDUP_BATCH_SIZE,
+                              DEDUP_PREFIX, first_arrival, slot_tags)
+
+from dedup_layouts import delete_keys
+
+
+def store(redis, layout, ids: list, upstream: str) -> int:
+    """
+    Store a batch of message ids delivered by an upstream
+
+    :returns: `int` of number of new ids
+    """
+
+    value = str(first_arrival('benchmark', upstream, time.time()))
+    items = [(mesg_id, value, layout.ttl) for mesg_id in ids]
+    pipe = redis.pipeline()
+    commands = layout.queue(pipe, items, redis.keyslot)
+    verdicts = layout.verdicts(items, commands, pipe.execute())
+    return sum(verdict is True for verdict in verdicts)
+
+
+def counters(redis, keys: list) -> dict:
+    """
+    Sum the accounting counters of hashes
+
+    :returns: `dict` of counts by upstream and counter
+    """
+
+    counts = {}
+    for i in range(0, len(keys), DEDUP_BATCH_SIZE):
+        pipe = redis.pipeline()
+        for key in keys[i:i + DEDUP_BATCH_SIZE]:
+            pipe.hgetall(key)
+        for fields in pipe.execute():
+            for field, value in fields.items():
+                counts[field.decode()] = (counts.get(field.decode(), 0) +
+                                          int(value))
+    return counts
+
+
+def show_stats(redis) -> None:
+    """
+    Show the message ids won and the duplicates per upstream counted by
+    the relays (dedup_accounting), since the counters were created
+
+    :returns: `None`
+    """
+
+    keys = list(redis.scan_iter(match=f'{DEDUP_PREFIX}-stats:*',
+                                count=DEDUP_BATCH_SIZE))
+    counts = {}
+    for field, value in counters(redis, keys).items():
+        upstream, _, counter = field.rpartition(':')
+        upstream_counts = counts.setdefault(upstream,
+                                            {'won': 0, 'duplicate': 0})
+        upstream_counts[counter] = value
+
+    for upstream, upstream_counts in sorted(counts.items()):
+        won, duplicate = upstream_counts['won'], upstream_counts['duplicate']
+        click.echo(f'{upstream}: {won} won, {duplicate} duplicate '
+                   f'({won / (won + duplicate):.1%} won)')
+
+
+@click.command()
+@click.option('--redis', 'host', default='localhost',
+              help='Redis cluster host')
+@click.option('--ids', 'count', type=int, default=20000,
+              help='Number of message ids delivered by each upstream')
+@click.option('--upstreams', type=int, default=3, help='Number of upstreams')
+@click.option('--stats', is_flag=True,
+              help='Show the counters of the relays instead')
+def main(host, count, upstreams, stats):
+    """Benchmark dedup with and without upstream accounting"""
+
+    redis = Redis(host=host, port=6379)
+    if stats:
+        show_stats(redis)
+        return
+
+    prefix = f'{DEDUP_PREFIX}-benchmark'
+    names = [f'upstream-{u}' for u in range(upstreams)]
+
+    for layout_name in ['key', 'bucket']:
+        for accounting in [False, True]:
+            layout = create_layout({'dedup_layout': layout_name,
+                                    'dedup_accounting': accounting}, prefix)
+            if layout.script is not None:
+                redis.script_load(layout.script)
+
+            ids = [f'benchmark:{uuid.uuid4()}' for _ in range(count)]
+            if isinstance(layout, BucketLayout):
+                bucket = int(time.time() // layout.bucket_seconds)
+            new = 0
+            start = time.perf_counter()
+            for n, i in enumerate(range(0, count, DEDUP_BATCH_SIZE)):
+                batch = ids[i:i + DEDUP_BATCH_SIZE]
+                # each upstream delivers some batches first
+                for upstream in names[n % upstreams:] + names[:n % upstreams]:
+                    new += store(redis, layout, batch, upstream)
+            rate = count * upstreams / (time.perf_counter() - start)
+
+            name = layout_name + (' with accounting' if accounting else '')
+            click.echo(f'{name}: {rate:.0f} ids/s, {new} new of {count}')
+
+            if isinstance(layout, BucketLayout):
+                stats_keys = [layout.stats_key(shard)
+                              for shard in range(layout.shards)]
+                keys = [key for shard in range(layout.shards)
+                        for key in layout.keys(shard, bucket)[:2]]
+            else:
+                tags = slot_tags()
+                stats_keys = list({layout.stats_key(
+                    tags[redis.keyslot(mesg_id)]) for mesg_id in ids})
+                keys = ids
+
+            if accounting:
+                counts = counters(redis, stats_keys)
+                won = sum(value for field, value in counts.items()
+                          if field.endswith(':won'))
+                duplicate = sum(value for field, value in counts.items()
+                                if field.endswith(':duplicate'))
+                click.echo(f'  counters: {won} won (expected {count}), '
+                           f'{duplicate} duplicate (expected '
+                           f'{count * (upstreams - 1)})')
+                keys += stats_keys
+
+            delete_keys(redis, keys)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,118 @@
+###############################################################################
+#
+# Licensed to the Apache Software Foundation (ASF) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The ASF licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+#
+###############################################################################
+
+"""
+Throughput and accuracy of RedisDedup, against Redis and in degraded mode
+with the local Bloom filter fallback
+
+    python benchmarks/dedup_fallback.py --ids 90000 --redis localhost
+"""
+
+import random
+import time
+import uuid
+
+import click
+from redis.cluster import RedisCluster as Redis
+
+from wis2_relay.dedup import (DEDUP_BATCH_SIZE, delete_keys, RedisDedup,
+                              create_fallback)
+
+
+def stream(count: int, duplicates: float) -> list:
+    """
+    Create message ids with duplicates of earlier ids
+
+    :param count: `int` of unique ids
+    :param duplicates: `float` of ratio of duplicates to unique ids
+
+    :returns: `list` of (id, whether the id is new) tuples
+    """
+
+    ids = []
+    arrivals = []
+    while len(ids) < count:
+        if ids and random.random() < duplicates / (1 + duplicates):
+            arrivals.append((random.choice(ids), False))
+        else:
+            ids.append(f'benchmark:{uuid.uuid4()}')
+            arrivals.append((ids[-1], True))
+
+    return arrivals
+
+
+def report(mode: str, arrivals: list, verdicts: list,
+           elapsed: float) -> None:
+    false_duplicates = sum(1 for (_, new), verdict in zip(arrivals, verdicts)
+                           if new and not verdict)
+    missed = sum(1 for (_, new), verdict in zip(arrivals, verdicts)
+                 if not new and verdict is True)
+    errors = sum(1 for verdict in verdicts if isinstance(verdict, Exception))
+    unique = sum(1 for _, new in arrivals if new)
+
+    click.echo(f'{mode}: {len(arrivals) / elapsed:.0f} ids/s, '
+               f'{missed} missed duplicates, {false_duplicates} false '
+               f'duplicates ({false_duplicates / unique:.3%}), '
+               f'{errors} errors')
+
+
+@click.command()
+@click.option('--ids', 'count', type=int, default=90000,
+              help='Number of unique message ids')
+@click.option('--duplicates', type=float, default=1.0,
+              help='Ratio of duplicates to unique ids')
+@click.option('--rate', type=float, default=100,
+              help='dedup_expected_rate sizing the fallback filter')
+@click.option('--redis', 'host', help='Redis cluster host to also measure')
+def main(count, duplicates, rate, host):
+    """Benchmark de-duplication against Redis and the local fallback"""
+
+    options = {'dedup_expected_rate': rate}
+    arrivals = stream(count, duplicates)
+    fallback = create_fallback(options)
+    size = sum(len(bloom.bits) for bloom in fallback.filters)
+    click.echo(f'{len(arrivals)} ids, fallback filter of '
+               f'{fallback.generations} x {fallback.capacity} ids, '
+               f'{fallback.generations * size / 1024:.0f} KiB')
+
+    dedup = RedisDedup(None, options, fallback=fallback)
+    start = time.perf_counter()
+    verdicts = [dedup.set_nx_local(mesg_id, 'benchmark')
+                for mesg_id, _ in arrivals]
+    report('degraded', arrivals, verdicts, time.perf_counter() - start)
+
+    if host is None:
+        return
+
+    redis = Redis(host=host, port=6379)
+    dedup = RedisDedup(redis, options, fallback=create_fallback(options))
+    verdicts = []
+    start = time.perf_counter()
+    for i in range(0, len(arrivals), DEDUP_BATCH_SIZE):
+        verdicts += dedup.set_nx([(mesg_id, 'benchmark') for mesg_id, _ in
+                                  arrivals[i:i + DEDUP_BATCH_SIZE]])
+    report('redis', arrivals, verdicts, time.perf_counter() - start)
+
+    delete_keys(redis, [mesg_id for mesg_id, new in arrivals if new])
+
+
+if __name__ == '__main__':
+    main()
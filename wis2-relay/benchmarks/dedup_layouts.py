@@ -0,0 +1,150 @@
+###############################################################################
+#
+# Licensed to the Apache Software Foundation (ASF) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The ASF licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+#
+###############################################################################
+
+"""
+Redis memory per message id and throughput of the dedup layouts, for
+several bucket sizes and shard counts of the bucket layout.  Run it
+against a test cluster
+
+    python benchmarks/dedup_layouts.py --redis localhost --layout key \\
+        --layout bucket:300:1024 --layout bucket:60:256
+"""
+
+import time
+import uuid
+
+import click
+from redis.cluster import RedisCluster as Redis
+
+from wis2_relay.dedup import (BucketLayout, create_layout,
+                              DEDUP_BATCH_SIZE, DEDUP_BUCKET_SECONDS,
+                              DEDUP_PREFIX, DEDUP_SHARDS, KeyLayout)
+
+
+def used_memory(redis) -> int:
+    """
+    Get the memory used by the primary nodes of a Redis cluster
+
+    :param redis: `redis.cluster.RedisCluster` client
+
+    :returns: `int` of bytes
+    """
+
+    info = redis.info('memory', target_nodes=Redis.PRIMARIES)
+    if 'used_memory' in info:
+        # the reply of a single node is not keyed by node
+        return info['used_memory']
+
+    return sum(node['used_memory'] for node in info.values())
+
+
+def delete_keys(redis, keys: list) -> None:
+    for i in range(0, len(keys), DEDUP_BATCH_SIZE):
+        pipe = redis.pipeline()
+        for key in keys[i:i + DEDUP_BATCH_SIZE]:
+            pipe.delete(key)
+        pipe.execute()
+
+
+def store_ids(redis, layout: KeyLayout, ids: list, value: str) -> float:
+    """
+    Store message ids in batches, as the relay does
+
+    :param redis: `redis.cluster.RedisCluster` client
+    :param layout: `KeyLayout` of the ids
+    :param ids: `list` of `str` of message ids
+    :param value: `str` of value to store with the ids
+
+    :returns: `float` of ids per second
+    """
+
+    start = time.perf_counter()
+
+    for i in range(0, len(ids), DEDUP_BATCH_SIZE):
+        pipe = redis.pipeline()
+        layout.queue(pipe, [(mesg_id, value, layout.ttl)
+                            for mesg_id in ids[i:i + DEDUP_BATCH_SIZE]],
+                     redis.keyslot)
+        pipe.execute()
+
+    return len(ids) / (time.perf_counter() - start)
+
+
+def layout_options(spec: str) -> dict:
+    """
+    Parse a layout given as `key` or `bucket[:seconds[:shards]]`
+
+    :param spec: `str` of layout
+
+    :returns: `dict` of relay options
+    """
+
+    name, *args = spec.split(':')
+    options = {'dedup_layout': name}
+    if name == 'bucket':
+        args += [DEDUP_BUCKET_SECONDS, DEDUP_SHARDS][len(args):]
+        options['dedup_bucket_seconds'] = int(args[0])
+        options['dedup_shards'] = int(args[1])
+
+    return options
+
+
+@click.command()
+@click.option('--redis', 'host', default='localhost',
+              help='Redis cluster host')
+@click.option('--ids', 'count', type=int, default=100000,
+              help='Number of message ids to store per layout')
+@click.option('--layout', 'specs', multiple=True,
+              help='key or bucket[:seconds[:shards]] (default: key, bucket)')
+def main(host, count, specs):
+    """Benchmark Redis memory of dedup layouts"""
+
+    redis = Redis(host=host, port=6379)
+    prefix = f'{DEDUP_PREFIX}-benchmark'
+
+    for spec in specs or ['key', 'bucket']:
+        layout = create_layout(layout_options(spec), prefix)
+        if layout.script is not None:
+            redis.script_load(layout.script)
+
+        ids = [f'benchmark:{uuid.uuid4()}' for _ in range(count)]
+        before = used_memory(redis)
+        if isinstance(layout, BucketLayout):
+            bucket = int(time.time() // layout.bucket_seconds)
+        new_rate = store_ids(redis, layout, ids, 'benchmark')
+        used = used_memory(redis) - before
+        duplicate_rate = store_ids(redis, layout, ids, 'benchmark')
+
+        click.echo(f'{spec}: {used / count * 1e6 / 2 ** 20:.1f} MiB per '
+                   f'million ids ({used / count:.1f} bytes per id), '
+                   f'{new_rate:.0f} new and {duplicate_rate:.0f} duplicate '
+                   'ids per second')
+
+        if isinstance(layout, BucketLayout):
+            # buckets written to while storing the ids
+            delete_keys(redis, [key for shard in range(layout.shards)
+                                for key in layout.keys(shard, bucket)[:2]])
+        else:
+            delete_keys(redis, ids)
+
+
+if __name__ == '__main__':
+    main()
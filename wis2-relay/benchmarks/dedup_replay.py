@@ -0,0 +1,147 @@
+###############################################################################
+#
+# Licensed to the Apache Software Foundation (ASF) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The ASF licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+#
+###############################################################################
+
+"""
+Replay captures of the upstreams of a relay to pick the de-duplication
+TTL: duplicate lags, the suggested TTL and, per TTL, the late duplicates
+and the message ids held
+
+    mosquitto_sub -h upstream -t 'origin/a/wis2/#' -F '%U %p' > upstream.log
+    python benchmarks/dedup_replay.py upstream-1.log upstream-2.log
+"""
+
+from collections import deque
+
+import click
+
+from wis2_relay.dedup import (DEDUP_TTL, DEDUP_TTL_MARGIN,
+                              DEDUP_TTL_PERCENTILE, lag_percentile,
+                              window_ttl)
+from wis2_relay.message import WNMessage
+
+
+def read_capture(path: str) -> list:
+    """
+    Read the messages of an upstream captured by
+    `mosquitto_sub -F '%U %p'`, one per line with its arrival time
+
+    :param path: `str` of capture file
+
+    :returns: `list` of (arrival, id) tuples
+    """
+
+    arrivals = []
+    skipped = 0
+
+    with open(path, 'rb') as fh:
+        for line in fh:
+            arrival, _, payload = line.partition(b' ')
+            try:
+                arrivals.append((float(arrival),
+                                 WNMessage(payload.strip()).id))
+            except (KeyError, ValueError):
+                skipped += 1
+
+    if skipped:
+        click.echo(f'Skipped {skipped} lines without message id in {path}',
+                   err=True)
+
+    return arrivals
+
+
+def replay_ttl(arrivals: list, ttl: float) -> tuple:
+    """
+    Replay arrivals of message ids against a de-duplication TTL
+
+    :param arrivals: `list` of (arrival, id) tuples, in arrival order
+    :param ttl: `float` of seconds ids are remembered
+
+    :returns: `tuple` of number of late duplicates, arriving after the
+              TTL, and of maximum number of ids remembered
+    """
+
+    stored = {}
+    stores = deque()
+    late = 0
+    held = 0
+
+    for arrival, mesg_id in arrivals:
+        first = stored.get(mesg_id)
+        if first is not None and arrival - first <= ttl:
+            continue
+        if first is not None:
+            late += 1
+
+        stored[mesg_id] = arrival
+        stores.append(arrival)
+        while stores[0] < arrival - ttl:
+            stores.popleft()
+        held = max(held, len(stores))
+
+    return late, held
+
+
+@click.command()
+@click.argument('captures', nargs=-1, required=True,
+                type=click.Path(exists=True, dir_okay=False))
+@click.option('--percentile', type=float, default=DEDUP_TTL_PERCENTILE,
+              help='Percentile of duplicate lags covered by the TTL')
+@click.option('--margin', type=float, default=DEDUP_TTL_MARGIN,
+              help='Seconds added to the percentile')
+@click.option('--ttl', 'ttls', type=int, multiple=True,
+              help='TTL to replay (default: suggested and dedup TTL)')
+def main(captures, percentile, margin, ttls):
+    """Replay captured upstreams to pick the de-duplication TTL
+
+    Each CAPTURE holds the messages of an upstream, as written by
+    mosquitto_sub -F '%U %p', over a period longer than the TTL."""
+
+    arrivals = sorted(arrival for capture in captures
+                      for arrival in read_capture(capture))
+
+    first = {}
+    lags = []
+    for arrival, mesg_id in arrivals:
+        if mesg_id in first:
+            lags.append(arrival - first[mesg_id])
+        else:
+            first[mesg_id] = arrival
+
+    click.echo(f'{len(arrivals)} messages, {len(first)} ids and '
+               f'{len(lags)} duplicates from {len(captures)} upstreams')
+    if not lags:
+        return
+
+    lags.sort()
+    click.echo('Duplicate lag: ' + ', '.join(
+        f'p{p:g} {lag_percentile(lags, p):.3f} s'
+        for p in [50, 90, 99, 99.9]) + f', max {lags[-1]:.3f} s')
+
+    suggested = window_ttl(lags, percentile, margin)
+    for ttl in ttls or sorted({suggested, DEDUP_TTL}):
+        late, held = replay_ttl(arrivals, ttl)
+        name = ' (suggested)' if ttl == suggested else ''
+        click.echo(f'TTL {ttl} s{name}: {late} late duplicates '
+                   f'({late / len(lags):.2%}), up to {held} ids held')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,105 @@
+###############################################################################
+#
+# Licensed to the Apache Software Foundation (ASF) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The ASF licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+#
+###############################################################################
+
+"""
+Time of extracting the id of a message from its payload, and of getting
+all hot-path fields of a message, against a full json.loads, by inline
+content size
+
+    python benchmarks/message_fields.py --inline 0 --inline 3000
+"""
+
+import json
+import timeit
+
+import click
+
+from wis2_relay.message import extract_id, WNMessage
+
+
+def message(inline: int) -> bytes:
+    """
+    Create a WIS2 notification message
+
+    :param inline: `int` of bytes of inline content, 0 for none
+
+    :returns: `bytes` of message
+    """
+
+    properties = {
+        'pubtime': '2024-03-20T04:50:18Z',
+        'data_id': 'wis2/ca-eccc-msc/data/core/weather/surface-based-observations/synop/WIGOS_0-454-2-AWSNAMITAMBO_20240101T000000',  # noqa
+        'metadata_id': 'urn:wmo:md:ca-eccc-msc:data.core.weather.surface-based-observations.synop',  # noqa
+        'datetime': '2024-03-20T04:45:00Z',
+        'integrity': {'method': 'sha512', 'value': 'A2KNxvks...S8qfSCw=='}
+    }
+    if inline:
+        properties['content'] = {'encoding': 'base64', 'value': 'x' * inline,
+                                 'size': inline * 3 // 4}
+
+    return json.dumps({
+        'id': '31e9d66a-cd83-4174-9429-b932f1abe1be',
+        'conformsTo': ['http://wis.wmo.int/spec/wnm/1/conf/core'],
+        'type': 'Feature',
+        'geometry': {'type': 'Point', 'coordinates': [6.1462, 46.2232]},
+        'properties': properties,
+        'links': [{'href': 'https://example.org/data/1.bufr4',
+                   'rel': 'canonical', 'type': 'application/bufr'}]
+    }).encode()
+
+
+def all_fields(raw: bytes) -> tuple:
+    mesg = WNMessage(raw)
+    return mesg.id, mesg.metadata_id, mesg.data_id, mesg.inline_size
+
+
+def parsed_fields(raw: bytes) -> tuple:
+    message = json.loads(raw)
+    properties = message['properties']
+    content = properties.get('content') or {}
+    return (message['id'], properties.get('metadata_id'),
+            properties.get('data_id'), len(content.get('value', '')))
+
+
+@click.command()
+@click.option('--inline', 'sizes', type=int, multiple=True,
+              help='Bytes of inline content (default: 0, 1000, 3000, 30000)')
+@click.option('--number', type=int, default=20000,
+              help='Number of runs per measure')
+def main(sizes, number):
+    """Benchmark message field extraction"""
+
+    for size in sizes or [0, 1000, 3000, 30000]:
+        raw = message(size)
+        times = []
+        for name, function in [
+                ('id', lambda: extract_id(raw)),
+                ('all fields', lambda: all_fields(raw)),
+                ('json.loads', lambda: json.loads(raw)),
+                ('json.loads and fields', lambda: parsed_fields(raw))]:
+            seconds = timeit.timeit(function, number=number) / number
+            times.append(f'{name} {seconds * 1e6:.1f} us')
+
+        click.echo(f'{len(raw) / 1000:.1f} kB: ' + ', '.join(times))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,284 @@
+###############################################################################
+#
+# Licensed to the Apache Software Foundation (ASF) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The ASF licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+#
+###############################################################################
+
+"""
+Messages per second relayed by the threads and asyncio engines
+
+Stub MQTT brokers stand in for the upstreams, each pushing its messages
+once subscribed to, and for the Global Broker, counting and acknowledging
+the messages relayed.  The relay runs against the Redis cluster given, as
+`wis2-relay relay` does, with the VERIFY_* variables of the environment.
+
+    python benchmarks/relay_engines.py --upstreams 20 --messages 1000 \\
+        --redis localhost
+"""
+
+import json
+import multiprocessing
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import uuid
+
+import click
+import yaml
+
+STUB_PORT = 21000
+# seconds without new messages relayed ending a run
+STALL_SECONDS = 3
+
+
+def read(sock: socket.socket, count: int) -> bytes:
+    data = b''
+    while len(data) < count:
+        chunk = sock.recv(count - len(data))
+        if not chunk:
+            raise EOFError
+        data += chunk
+    return data
+
+
+def publish_packet(topic: str, payload: bytes) -> bytes:
+    """
+    Encode an MQTT v5 QoS 0 PUBLISH packet
+
+    :param topic: `str` of topic
+    :param payload: `bytes` of payload
+
+    :returns: `bytes` of packet
+    """
+
+    topic = topic.encode()
+    body = len(topic).to_bytes(2, 'big') + topic + b'\x00' + payload
+    length = b''
+    remaining = len(body)
+    while True:
+        digit, remaining = remaining % 128, remaining // 128
+        length += bytes([digit | (128 if remaining else 0)])
+        if not remaining:
+            return b'\x30' + length + body
+
+
+def messages(centre_id: str, count: int) -> bytes:
+    """
+    Create the PUBLISH packets of an upstream
+
+    :param centre_id: `str` of centre identifier of the upstream
+    :param count: `int` of number of messages
+
+    :returns: `bytes` of packets
+    """
+
+    topic = f'origin/a/wis2/{centre_id}/data/core/weather/surface-based-observations/synop'  # noqa
+    packets = []
+    for i in range(count):
+        message = {
+            'id': str(uuid.uuid4()),
+            'type': 'Feature',
+            'conformsTo': ['http://wis.wmo.int/spec/wnm/1/conf/core'],
+            'geometry': None,
+            'properties': {
+                'data_id': f'{centre_id}/{i}',
+                'pubtime': '2024-01-01T00:00:00Z',
+                'datetime': '2024-01-01T00:00:00Z',
+                'integrity': {'method': 'sha512', 'value': 'x'}
+            },
+            'links': [{'href': f'https://example.org/{i}',
+                       'rel': 'canonical', 'type': 'application/bufr'}]
+        }
+        packets.append(publish_packet(topic, json.dumps(message).encode()))
+
+    return b''.join(packets)
+
+
+def handle(sock: socket.socket, packets: bytes, relayed) -> None:
+    """
+    Serve an MQTT client: acknowledge its packets, push `packets` once
+    subscribed and count the messages it publishes
+
+    :param sock: `socket.socket` of client connection
+    :param packets: `bytes` of PUBLISH packets to push
+    :param relayed: `multiprocessing.Value` counting relayed messages
+
+    :returns: `None`
+    """
+
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    try:
+        while True:
+            header = read(sock, 1)[0]
+            length, multiplier = 0, 1
+            while True:
+                digit = read(sock, 1)[0]
+                length += (digit & 127) * multiplier
+                multiplier *= 128
+                if not digit & 128:
+                    break
+            body = read(sock, length) if length else b''
+
+            kind = header >> 4
+            if kind == 1:  # CONNECT
+                sock.sendall(b'\x20\x03\x00\x00\x00')
+            elif kind == 8:  # SUBSCRIBE
+                sock.sendall(b'\x90\x04' + body[:2] + b'\x00\x00')
+                sock.sendall(packets)
+            elif kind == 3:  # PUBLISH
+                topic_length = int.from_bytes(body[:2], 'big')
+                topic = body[2:2 + topic_length]
+                if not topic.startswith(b'wis2-globalbroker/'):
+                    with relayed.get_lock():
+                        relayed.value += 1
+                if (header >> 1) & 3:
+                    packet_id = body[2 + topic_length:4 + topic_length]
+                    sock.sendall(b'\x40\x02' + packet_id)
+            elif kind == 12:  # PINGREQ
+                sock.sendall(b'\xd0\x00')
+            elif kind == 14:  # DISCONNECT
+                return
+    except (EOFError, OSError):
+        pass
+
+
+def serve(port: int, packets: bytes, relayed) -> None:
+    server = socket.socket()
+    server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    server.bind(('127.0.0.1', port))
+    server.listen(512)
+    while True:
+        sock, _ = server.accept()
+        threading.Thread(target=handle, args=(sock, packets, relayed),
+                         daemon=True).start()
+
+
+def stubs(upstreams: int, count: int, relayed, ready) -> None:
+    """
+    Run the stub brokers: the Global Broker on STUB_PORT, the upstreams
+    on the following ports
+
+    :returns: `None`
+    """
+
+    threads = [threading.Thread(target=serve, args=(STUB_PORT, b'', relayed),
+                                daemon=True)]
+    for i in range(upstreams):
+        threads.append(threading.Thread(
+            target=serve, args=(STUB_PORT + 1 + i,
+                                messages(f'centre-{i}', count), relayed),
+            daemon=True))
+
+    for thread in threads:
+        thread.start()
+    ready.set()
+    for thread in threads:
+        thread.join()
+
+
+def run(engine: str, upstreams: int, count: int, redis: str,
+        config: dict) -> tuple:
+    """
+    Relay the messages of the upstreams with an engine
+
+    :returns: `tuple` of messages relayed and messages per second
+    """
+
+    relayed = multiprocessing.Value('i', 0)
+    ready = multiprocessing.Event()
+    stub = multiprocessing.Process(target=stubs,
+                                   args=(upstreams, count, relayed, ready))
+    stub.start()
+    ready.wait()
+
+    config = {
+        'upstreams': [{'url': f'mqtt://127.0.0.1:{STUB_PORT + 1 + i}',
+                       'topics': 'origin/a/wis2/#',
+                       'centre_id': f'centre-{i}'}
+                      for i in range(upstreams)],
+        'metrics_mqtt': False,
+        'qos': 1,
+        **config
+    }
+
+    with tempfile.NamedTemporaryFile('w', suffix='.yml') as fh:
+        yaml.safe_dump(config, fh)
+        fh.flush()
+
+        env = dict(os.environ,
+                   WIS2_GB_BROKER_URL=f'mqtt://127.0.0.1:{STUB_PORT}',
+                   WIS2_GB_CENTRE_ID=os.environ.get('WIS2_GB_CENTRE_ID',
+                                                    'benchmark'),
+                   WIS2_GB_BACKEND_URL=redis)
+        relay = subprocess.Popen(
+            [sys.executable, '-c', 'from wis2_relay import cli; cli()',
+             'relay', '--config', fh.name, '--engine', engine],
+            env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+        total = upstreams * count
+        first = last = None
+        done = 0
+        while relay.poll() is None:
+            time.sleep(0.02)
+            now = time.monotonic()
+            if relayed.value != done:
+                done = relayed.value
+                first = first or now
+                last = now
+            if done >= total or (last and now - last > STALL_SECONDS):
+                break
+
+        relay.kill()
+        stub.kill()
+
+    if first is None or last == first:
+        return done, 0.0
+    return done, done / (last - first)
+
+
+@click.command()
+@click.option('--engine', 'engines', multiple=True,
+              type=click.Choice(['threads', 'asyncio']),
+              help='Engine to measure (default: all)')
+@click.option('--upstreams', type=int, default=20,
+              help='Number of upstreams')
+@click.option('--messages', 'count', type=int, default=1000,
+              help='Number of messages per upstream')
+@click.option('--redis', default='localhost', help='Redis cluster host')
+@click.option('--option', 'options', multiple=True,
+              help='Relay configuration option, as key=value (YAML value)')
+def main(engines, upstreams, count, redis, options):
+    """Benchmark the relay engines"""
+
+    config = {}
+    for option in options:
+        key, _, value = option.partition('=')
+        config[key] = yaml.safe_load(value)
+
+    for engine in engines or ['threads', 'asyncio']:
+        done, rate = run(engine, upstreams, count, redis, config)
+        click.echo(f'{engine}: {upstreams} x {count} messages, relayed '
+                   f'{done} at {rate:.0f} messages/s')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,92 @@
+###############################################################################
+#
+# Licensed to the Apache Software Foundation (ASF) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The ASF licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+#
+###############################################################################
+
+"""
+Startup time of WIS2TopicHierarchy in a fresh process, parsing the topic
+hierarchy CSV files and loading the precompiled index
+
+    python benchmarks/topic_startup.py --runs 5
+"""
+
+import os
+from pathlib import Path
+import shutil
+import subprocess
+import sys
+import tempfile
+
+import click
+
+from wis2_relay.topic import TOPIC_SCHEMA_DIR
+
+STARTUP = '''
+import time
+from wis2_relay.topic import WIS2TopicHierarchy
+start = time.perf_counter()
+WIS2TopicHierarchy()
+print(time.perf_counter() - start)
+'''
+
+
+def startup(home: Path) -> float:
+    """
+    Create a WIS2TopicHierarchy in a fresh process
+
+    :param home: `Path` of home directory holding the topic hierarchy
+
+    :returns: `float` of seconds
+    """
+
+    output = subprocess.run([sys.executable, '-c', STARTUP],
+                            env=dict(os.environ, HOME=str(home)),
+                            capture_output=True, text=True, check=True)
+    return float(output.stdout)
+
+
+@click.command()
+@click.option('--dir', 'directory', type=click.Path(exists=True),
+              default=str(TOPIC_SCHEMA_DIR),
+              help='Directory of the topic hierarchy CSV files')
+@click.option('--runs', type=int, default=5, help='Number of runs')
+def main(directory, runs):
+    """Benchmark the startup of the topic hierarchy"""
+
+    with tempfile.TemporaryDirectory() as home:
+        hierarchy = Path(home) / TOPIC_SCHEMA_DIR.name
+        hierarchy.mkdir()
+        for name in ['centre-id.csv', 'earth-system-discipline.csv']:
+            shutil.copy(Path(directory) / name, hierarchy)
+        index = hierarchy / 'wis2-topic-hierarchy-index.json'
+
+        parse = []
+        for _ in range(runs):
+            index.unlink(missing_ok=True)
+            parse.append(startup(home))
+        load = [startup(home) for _ in range(runs)]
+
+        click.echo(f'CSV parse and index write: '
+                   f'{sum(parse) / runs * 1000:.2f} ms')
+        click.echo(f'index: {sum(load) / runs * 1000:.2f} ms '
+                   f'({index.stat().st_size / 1000:.0f} kB)')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,126 @@
+###############################################################################
+#
+# Licensed to the Apache Software Foundation (ASF) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The ASF licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+#
+###############################################################################
+
+"""
+Messages per second validated in process and by validation pools, in
+arrival order, against the schema of `wis2-relay schema sync`
+
+    python benchmarks/validation_pool.py --workers 1 --workers 4
+"""
+
+import json
+import threading
+import time
+import uuid
+
+import click
+
+from wis2_relay.message import WNMessage
+from wis2_relay.reload import Reloadable
+from wis2_relay.verify import ValidationPool, ValidationSequence, WNMValidate
+
+
+def message(i: int, invalid: bool = False) -> bytes:
+    """
+    Create a WIS2 notification message
+
+    :param i: `int` of message number
+    :param invalid: `bool` of whether to leave out the required links
+
+    :returns: `bytes` of message
+    """
+
+    message = {
+        'id': str(uuid.uuid4()),
+        'conformsTo': ['http://wis.wmo.int/spec/wnm/1/conf/core'],
+        'type': 'Feature',
+        'geometry': None,
+        'properties': {
+            'data_id': f'centre/data/{i}',
+            'pubtime': '2024-01-01T00:00:00Z',
+            'datetime': '2024-01-01T00:00:00Z',
+            'integrity': {'method': 'sha512', 'value': 'x'}
+        },
+        'links': [{'href': f'https://example.org/{i}', 'rel': 'canonical',
+                   'type': 'application/bufr'}]
+    }
+    if invalid:
+        del message['links']
+
+    return json.dumps(message).encode()
+
+
+@click.command()
+@click.option('--messages', 'count', type=int, default=20000,
+              help='Number of messages')
+@click.option('--invalid', type=int, default=100,
+              help='One invalid message every INVALID messages')
+@click.option('--workers', 'worker_counts', type=int, multiple=True,
+              help='Number of pool workers (default: 1, 2 and 4)')
+def main(count, invalid, worker_counts):
+    """Benchmark schema validation in process and in validation pools"""
+
+    payloads = [message(i, i % invalid == 0) for i in range(count)]
+    schema = WNMValidate()
+
+    start = time.perf_counter()
+    expected = [payload for payload in payloads
+                if schema.validate_message(json.loads(payload))[0]]
+    elapsed = time.perf_counter() - start
+    click.echo(f'in process: {count / elapsed:.0f} messages/s, '
+               f'{count - len(expected)} invalid')
+
+    for workers in worker_counts or [1, 2, 4]:
+        pool = ValidationPool(workers, max_pending=count)
+        pool.start()
+        # wait for the workers to load the schema
+        ready = threading.Event()
+        pool.submit(payloads[0], lambda verdict: ready.set())
+        ready.wait()
+
+        published = []
+        metrics = []
+        done = threading.Event()
+
+        def publish(topic, payload):
+            published.append(payload)
+            if len(published) == len(expected):
+                done.set()
+
+        sequence = ValidationSequence(
+            pool, Reloadable(schema), publish,
+            lambda name, *args: metrics.append(name))
+
+        start = time.perf_counter()
+        for payload in payloads:
+            sequence.validate('topic', WNMessage(payload), 'centre')
+        done.wait()
+        elapsed = time.perf_counter() - start
+
+        click.echo(f'pool of {workers}: {count / elapsed:.0f} messages/s, '
+                   f'{metrics.count("invalid_format_total")} invalid, '
+                   f'{metrics.count("validate_fallback_total")} validated '
+                   f'in process, in order: {published == expected}')
+        pool.executor.shutdown()
+
+
+if __name__ == '__main__':
+    main()
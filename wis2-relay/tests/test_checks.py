@@ -0,0 +1,133 @@
+###############################################################################
+#
+# Licensed to the Apache Software Foundation (ASF) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The ASF licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+#
+###############################################################################
+
+import json
+
+import pytest
+
+from wis2_relay.checks import CheckedMessage, MessageChecks
+from wis2_relay.reload import Reloadable
+
+OPTIONS = {
+    'max_message_size': 10000,
+    'verify_topic': True,
+    'verify_centre_id': True,
+    'verify_data': True,
+    'verify_metadata': True
+}
+
+TOPIC = 'origin/a/wis2/io-wis2dev-11-test/data/core/weather'
+
+
+class FakeTopicHierarchy:
+    """Stand-in for WIS2TopicHierarchy, knowing a single topic"""
+
+    def verdict(self, topic):
+        if not topic.startswith('origin/a/wis2/'):
+            return False, False, False, False
+        return True, True, True, topic == TOPIC
+
+
+def message(**properties):
+    properties = {'data_id': 'data', 'metadata_id': 'urn:wmo:md:x',
+                  **properties}
+    return json.dumps({'id': 'a', 'properties': properties}).encode()
+
+
+REJECTED = [
+    ('size', TOPIC, message(pad='x' * 10000)),
+    # preamble and earth system discipline
+    ('topic', 'cache/b/wis2/io-wis2dev-11-test/data/core/weather',
+     message()),
+    ('topic', 'origin/a/wis2/io-wis2dev-11-test/data/core/unknown',
+     message()),
+    # no id, not JSON
+    ('dedup', TOPIC,
+     json.dumps({'properties': {'data_id': 'data'}}).encode()),
+    ('dedup', TOPIC, b'not json')
+]
+
+# no metadata id, inline content too large
+REJECTED_AFTER_DEDUP = [
+    json.dumps({'id': 'a', 'properties': {'data_id': 'data'}}).encode(),
+    message(content={'value': 'x' * 5000})
+]
+
+
+@pytest.fixture
+def checks():
+    published = []
+    metrics = []
+    deduped = []
+
+    def dedup(checked):
+        try:
+            mesg_id = checked.mesg.id
+        except (KeyError, ValueError):
+            return False
+        deduped.append(mesg_id)
+        return True
+
+    checks = MessageChecks(OPTIONS, Reloadable(FakeTopicHierarchy()), None,
+                           lambda *args: metrics.append(args),
+                           lambda topic, payload: published.append(topic))
+    pipeline = checks.create_pipeline(dedup)
+    return pipeline, published, metrics, deduped
+
+
+@pytest.mark.parametrize('stage,topic,payload', REJECTED)
+def test_rejected_without_dedup(checks, stage, topic, payload):
+    pipeline, published, metrics, deduped = checks
+
+    pipeline.check(CheckedMessage(topic, payload))
+
+    assert pipeline.stats[stage][:2] == [1, 1]
+    assert deduped == []
+    assert published == []
+
+
+@pytest.mark.parametrize('payload', REJECTED_AFTER_DEDUP)
+def test_rejected_after_dedup(checks, payload):
+    pipeline, published, metrics, deduped = checks
+
+    pipeline.check(CheckedMessage(TOPIC, payload))
+
+    # duplicates are rejected before the message is parsed
+    assert deduped == ['a']
+    assert pipeline.stats['fields'][:2] == [1, 1]
+    assert published == []
+    assert metrics
+
+
+@pytest.mark.parametrize('payload', [
+    message(),
+    # an explicit null metadata_id is not missing
+    message(metadata_id=None)
+])
+def test_accepted_after_dedup(checks, payload):
+    pipeline, published, metrics, deduped = checks
+
+    pipeline.check(CheckedMessage(TOPIC, payload))
+
+    assert deduped == ['a']
+    assert published == [TOPIC]
+    assert pipeline.stats['dedup'][:2] == [1, 0]
+    assert ('no_metadata_total',) not in metrics
@@ -0,0 +1,210 @@
+###############################################################################
+#
+# Licensed to the Apache Software Foundation (ASF) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The ASF licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+#
+###############################################################################
+
+import threading
+
+from redis.crc import key_slot
+from redis.exceptions import ConnectionError
+
+from wis2_relay.checks import CheckedMessage
+from wis2_relay.dedup import AdaptiveTTL, DedupCache, DedupCheck, RedisDedup
+
+OPTIONS = {
+    'dedup_window': 0.05,
+    'dedup_batch_size': 4,
+    'dedup_expected_rate': 1
+}
+
+
+class FakePipeline:
+    """Stand-in for a Redis cluster pipeline of SET NX commands"""
+
+    def __init__(self, redis):
+        self.redis = redis
+        self.commands = []
+
+    def set(self, name, value, ex=None, nx=False):
+        self.commands.append((name, value, ex))
+
+    def execute(self, raise_on_error=True):
+        if self.redis.down:
+            raise ConnectionError('Redis is down')
+
+        self.redis.batches.append([name for name, _, _ in self.commands])
+        replies = []
+        for name, value, ex in self.commands:
+            if name in self.redis.store:
+                replies.append(None)
+            else:
+                self.redis.store[name] = (value, ex)
+                replies.append(True)
+        return replies
+
+
+class FakeRedis:
+    """Stand-in for a Redis cluster client"""
+
+    def __init__(self):
+        self.store = {}
+        self.batches = []
+        self.down = False
+        self.broken = False
+
+    def pipeline(self):
+        if self.broken:
+            raise RuntimeError('Redis client is broken')
+        return FakePipeline(self)
+
+    def keyslot(self, key):
+        return key_slot(key.encode())
+
+    def ping(self):
+        if self.down:
+            raise ConnectionError('Redis is down')
+        return True
+
+
+def run(dedup, ids):
+    verdicts = {}
+    lock = threading.Lock()
+
+    def callback(mesg_id, n, verdict):
+        with lock:
+            verdicts[(mesg_id, n)] = verdict
+
+    for n, mesg_id in enumerate(ids):
+        dedup.submit(mesg_id, 'centre',
+                     lambda verdict, m=mesg_id, n=n: callback(m, n, verdict))
+
+    if not dedup.is_alive():
+        dedup.daemon = True
+        dedup.start()
+    dedup.queue.join()
+
+    return [verdicts[(mesg_id, n)] for n, mesg_id in enumerate(ids)]
+
+
+def test_batches_and_verdicts():
+    redis = FakeRedis()
+    metrics = []
+    dedup = RedisDedup(redis, OPTIONS,
+                       lambda *args: metrics.append(args))
+
+    ids = ['a', 'b', 'a', 'c', 'd', 'b', 'e']
+    verdicts = run(dedup, ids)
+
+    assert [bool(verdict) for verdict in verdicts] == [
+        True, True, False, True, True, False, True]
+    assert set(redis.store) == {'a', 'b', 'c', 'd', 'e'}
+    assert redis.store['a'] == ('centre', 3600)
+
+    # queued ids go out in pipelines of at most dedup_batch_size
+    assert [len(batch) for batch in redis.batches] == [4, 3]
+    assert ('dedup_batch_size', 4) in metrics
+    assert ('dedup_batch_size', 3) in metrics
+    assert [name for name, *_ in metrics].count('dedup_latency_seconds') == 2
+
+
+def test_degraded_and_write_back():
+    redis = FakeRedis()
+    dedup = RedisDedup(redis, OPTIONS)
+    redis.down = True
+
+    verdicts = run(dedup, ['a', 'b', 'a'])
+    assert verdicts == [True, True, False]
+    assert dedup.degraded
+    assert redis.store == {}
+
+    redis.down = False
+    dedup.reconnect_at = 0
+    verdicts = run(dedup, ['b', 'c'])
+    assert [bool(verdict) for verdict in verdicts] == [False, True]
+    assert not dedup.degraded
+    # ids accepted while degraded are written back to Redis
+    assert set(redis.store) == {'a', 'b', 'c'}
+
+
+def test_failed_batch():
+    redis = FakeRedis()
+    dedup = RedisDedup(redis, OPTIONS)
+    redis.broken = True
+
+    # the verdicts of a batch failing unexpectedly are the error
+    verdicts = run(dedup, ['a', 'b'])
+    assert all(isinstance(verdict, RuntimeError) for verdict in verdicts)
+
+    redis.broken = False
+    verdicts = run(dedup, ['a', 'b'])
+    assert verdicts == [True, True]
+
+
+def test_cache_ttl_capped():
+    adaptive_ttl = AdaptiveTTL(max_ttl=3600, min_ttl=60)
+    cache = DedupCache(600, 10, adaptive_ttl)
+
+    cache.add('a')
+    adaptive_ttl.ttl = 60
+    cache.add('b', 'first')
+
+    # ids are not cached beyond the de-duplication window of Redis
+    expires = {mesg_id: entry[0] for mesg_id, entry in cache.entries.items()}
+    assert 539 < expires['a'] - expires['b'] <= 540
+    assert cache.seen('b')
+    assert cache.get('b') == 'first'
+
+
+class FakeCheckPipeline:
+    """Stand-in for a CheckPipeline, recording resumed messages"""
+
+    def __init__(self):
+        self.resumed = []
+
+    def resume(self, checked, passed):
+        self.resumed.append((checked.mesg.id, passed))
+
+
+def test_dedup_check():
+    metrics = []
+    dedup = RedisDedup(FakeRedis(), OPTIONS,
+                       lambda *args: metrics.append(args))
+    dedup.daemon = True
+    dedup.start()
+    cache = DedupCache(600, 10)
+    check = DedupCheck(dedup, cache, 'upstream',
+                       lambda *args: metrics.append(args))
+    pipeline = FakeCheckPipeline()
+
+    def checked(payload):
+        checked = CheckedMessage('origin/a/wis2/centre/data/core', payload)
+        checked.pipeline = pipeline
+        return checked
+
+    assert check.check(checked(b'{"type": "Feature"}')) is False
+    assert ('invalid_format_total',) in metrics
+
+    # the first copy awaits its verdict, the second is a cache hit
+    assert check.check(checked(b'{"id": "a"}')) is None
+    dedup.queue.join()
+    assert pipeline.resumed == [('a', True)]
+    assert cache.get('a').upstream == 'upstream'
+    assert check.check(checked(b'{"id": "a"}')) is False
+    assert ('dedup_cache_hits_total',) in metrics
+    assert ('messages_received_total',) in metrics
@@ -0,0 +1,95 @@
+###############################################################################
+#
+# Licensed to the Apache Software Foundation (ASF) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The ASF licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+#
+###############################################################################
+
+import json
+
+import pytest
+
+from wis2_relay.message import extract_id, WNMessage
+
+MESSAGES = [
+    # flat message
+    {'id': 'a', 'properties': {'data_id': 'd', 'metadata_id': 'm',
+                               'content': {'encoding': 'utf-8',
+                                           'value': 'abc', 'size': 3}}},
+    # link content before properties content
+    {'id': 'a', 'links': [{'content': {'value': '12345678'}}],
+     'properties': {'data_id': 'd', 'content': {'value': 'abc'}}},
+    # id only in properties
+    {'properties': {'id': 'x', 'data_id': 'd'}},
+    # data_id only in links
+    {'id': 'a', 'properties': {'metadata_id': 'm'},
+     'links': [{'data_id': 'L'}]},
+    # fields nested in properties or in another object
+    {'properties': {'integrity': {'data_id': 'n'}, 'metadata_id': 'm'},
+     'id': 'z'},
+    {'properties': {'a': 1}, 'geometry': {'data_id': 'no'}, 'id': 'z'},
+    {'x': {'properties': {'data_id': 'no'}}, 'id': 'z'},
+    # brackets, quotes and backslashes in strings
+    {'id': 'a"{', 'properties': {'data_id': 'd}[', 'content': {
+        'value': 'x"\\"y\\', 'encoding': 'utf-8'}}},
+    # id not a string
+    {'id': 5, 'properties': {'data_id': 'd'}},
+    # properties not an object
+    {'id': 'a', 'properties': ['data_id']},
+    {'id': 'a', 'properties': None}
+]
+
+
+def parsed_fields(message: dict) -> tuple:
+    properties = message.get('properties')
+    if not isinstance(properties, dict):
+        properties = {}
+    content = properties.get('content') or {}
+    return (message.get('id'), properties.get('metadata_id'),
+            properties.get('data_id'),
+            len(content['value']) if 'value' in content else None)
+
+
+@pytest.mark.parametrize('message', MESSAGES)
+@pytest.mark.parametrize('indent', [None, 2])
+def test_fields_match_full_parse(message, indent):
+    mesg = WNMessage(json.dumps(message, indent=indent).encode())
+
+    try:
+        mesg_id = mesg.id
+    except KeyError:
+        mesg_id = None
+
+    assert (mesg_id, mesg.metadata_id, mesg.data_id,
+            mesg.inline_size) == parsed_fields(message)
+
+
+def test_nested_id_is_ambiguous():
+    raw = json.dumps({'properties': {'id': 'x'}}).encode()
+
+    assert extract_id(raw) is None
+    with pytest.raises(KeyError):
+        WNMessage(raw).id
+
+
+def test_id_without_full_parse():
+    mesg = WNMessage(json.dumps(MESSAGES[0]).encode())
+
+    assert mesg.id == 'a'
+    assert mesg._dict is None
+    assert mesg.data_id == 'd'
+    assert mesg._dict is not None
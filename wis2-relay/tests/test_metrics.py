@@ -0,0 +1,157 @@
+###############################################################################
+#
+# Licensed to the Apache Software Foundation (ASF) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The ASF licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+#
+###############################################################################
+
+import json
+import os
+import queue
+import sys
+
+import pytest
+
+from wis2_relay.metrics import (HISTOGRAM_BUCKETS, METRICS, metric_labels,
+                                metric_type, RelayMetricAggregator)
+
+COLLECTOR_DIR = os.path.join(os.path.dirname(__file__), '..', '..',
+                             'metrics-collector')
+
+
+@pytest.fixture(scope='module')
+def collector():
+    for name in ['WIS2_GB_BROKER_URL', 'WIS2_GB_CENTRE_ID',
+                 'WIS2_GB_CENTRE_ID_CSV']:
+        os.environ.setdefault(name, '')
+    os.environ.setdefault('WIS2_GB_LOGGING_LEVEL', 'ERROR')
+    sys.path.insert(0, COLLECTOR_DIR)
+    try:
+        import metrics_collector
+    finally:
+        sys.path.remove(COLLECTOR_DIR)
+    return metrics_collector
+
+
+def snapshots(aggregator):
+    aggregator.flush()
+    messages = []
+    while not aggregator.metricq.empty():
+        topic, payload = aggregator.metricq.get()
+        messages.append(json.loads(payload))
+    return messages
+
+
+def test_snapshot_aggregates():
+    aggregator = RelayMetricAggregator(queue.Queue())
+    labels = ['io-wis2dev-11-test', 'gb']
+    for value in [0.0001, 0.001, 0.003, 2]:
+        aggregator.record('dedup_latency_seconds', labels, value)
+    aggregator.record('published_total', labels)
+    aggregator.record('published_total', labels, 2)
+    aggregator.record('connected_flag', labels, 0)
+    aggregator.record('connected_flag', labels, 1)
+
+    snapshot, = snapshots(aggregator)
+    assert snapshot['labels'] == labels
+    assert snapshot['counters'] == {'published_total': 3}
+    assert snapshot['gauges'] == {'connected_flag': 1}
+
+    totals = snapshot['histograms']['dedup_latency_seconds']
+    buckets = HISTOGRAM_BUCKETS['dedup_latency_seconds']
+    assert len(totals['buckets']) == len(buckets) + 1
+    # 0.0001 and 0.001 (upper bounds are inclusive), 0.003 and above 1
+    assert totals['buckets'][0] == 1
+    assert totals['buckets'][1] == 1
+    assert totals['buckets'][3] == 1
+    assert totals['buckets'][-1] == 1
+    assert totals['count'] == 4
+    assert totals['sum'] == pytest.approx(2.0041)
+
+    # counters are deltas, a new snapshot starts from scratch
+    aggregator.record('published_total', labels)
+    snapshot, = snapshots(aggregator)
+    assert snapshot == {'counters': {'published_total': 1}, 'labels': labels}
+
+
+def test_collector_applies_totals(collector):
+    aggregator = RelayMetricAggregator(queue.Queue())
+    labels = ['io-wis2dev-12-test', 'gb']
+    values = [1, 3, 3, 40, 5000]
+    for value in values:
+        aggregator.record('dedup_batch_size', labels, value)
+    aggregator.record('dedup_won_total', labels, 5)
+
+    snapshot, = snapshots(aggregator)
+    collector.apply_snapshot(snapshot)
+    collector.apply_snapshot(snapshot)
+
+    registry = collector.REGISTRY
+
+    def sample(name, **extra):
+        return registry.get_sample_value(name, dict(
+            centre_id=labels[0], report_by=labels[1], **extra))
+
+    assert sample('wmo_wis2_gb_dedup_won_total') == 10
+    assert sample('wmo_wis2_gb_dedup_batch_size_count') == 10
+    assert sample('wmo_wis2_gb_dedup_batch_size_sum') == 2 * sum(values)
+    assert sample('wmo_wis2_gb_dedup_batch_size_bucket', le='1.0') == 2
+    assert sample('wmo_wis2_gb_dedup_batch_size_bucket', le='5.0') == 6
+    assert sample('wmo_wis2_gb_dedup_batch_size_bucket', le='1000.0') == 8
+    assert sample('wmo_wis2_gb_dedup_batch_size_bucket', le='+Inf') == 10
+
+
+def test_collector_applies_observations(collector):
+    labels = ['io-wis2dev-13-test', 'gb']
+    for value in [0.0001, 0.001, 2]:
+        collector.apply_metric('dedup_latency_seconds', labels, value)
+
+    def sample(name, **extra):
+        return collector.REGISTRY.get_sample_value(name, dict(
+            centre_id=labels[0], report_by=labels[1], **extra))
+
+    assert sample('wmo_wis2_gb_dedup_latency_seconds_count') == 3
+    assert sample('wmo_wis2_gb_dedup_latency_seconds_bucket',
+                  le='0.001') == 2
+    assert sample('wmo_wis2_gb_dedup_latency_seconds_bucket',
+                  le='+Inf') == 3
+
+
+def test_collector_definitions_in_sync(collector):
+    for metric_name, metric in collector.METRICS.items():
+        type_ = metric_type(metric_name)
+        family, = metric.describe()
+        assert family.type == type_, metric_name
+
+        if type_ == 'histogram':
+            labelnames = metric.labelnames
+            buckets = [float(bucket) for bucket in
+                       HISTOGRAM_BUCKETS[metric_name]]
+            assert metric.buckets == buckets
+        else:
+            labelnames = metric._labelnames
+        assert list(labelnames) == metric_labels(metric_name)
+
+        if metric_name in METRICS:
+            name = METRICS[metric_name][1]
+            if type_ == 'counter':
+                name = name[:-len('_total')]
+            assert family.name == name
+            assert family.documentation == METRICS[metric_name][2]
+
+    assert set(METRICS) <= set(collector.METRICS)
+    assert set(HISTOGRAM_BUCKETS) <= set(collector.METRICS)
@@ -0,0 +1,43 @@
+###############################################################################
+#
+# Licensed to the Apache Software Foundation (ASF) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The ASF licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+#
+###############################################################################
+
+
+from wis2_relay.relay_queue import LaneQueue
+from wis2_relay.spool import DiskQueue
+
+CORE = 'origin/a/wis2/centre/data/core/weather'
+RECOMMENDED = 'origin/a/wis2/centre/data/recommended/weather'
+
+
+def test_lane_spill(tmp_path):
+    # the same with spooled overflow, one spool per lane
+    for spool in [None, {lane: DiskQueue(tmp_path / lane, fsync='never')
+                         for lane in ['core', 'metadata', 'recommended',
+                                      'metrics']}]:
+        queue_ = LaneQueue(2, 'spill', spool=spool)
+        for n in range(6):
+            queue_.put((RECOMMENDED, f'{n}'))
+        queue_.put((CORE, 'core'))
+
+        assert queue_.qsize() == 7
+        # spilled core data is not held behind spilled recommended data
+        topics = [queue_.get()[0] for _ in range(7)]
+        assert topics == [CORE] + [RECOMMENDED] * 6
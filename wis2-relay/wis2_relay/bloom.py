@@ -0,0 +1,136 @@
+###############################################################################
+#
+# Licensed to the Apache Software Foundation (ASF) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The ASF licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+#
+###############################################################################
+
+from hashlib import blake2b
+import math
+import threading
+import time
+from typing import List
+
+BLOOM_ERROR_RATE = 0.001
+BLOOM_GENERATIONS = 4
+
+
+class BloomFilter:
+    """Fixed size Bloom filter"""
+
+    def __init__(self, capacity: int, error_rate: float) -> None:
+        """
+        Bloom filter initializer
+
+        :param capacity: `int` of expected number of items
+        :param error_rate: `float` of acceptable false positive rate
+
+        :returns: `None`
+        """
+
+        capacity = max(1, capacity)
+        self.size = max(64, int(-capacity * math.log(error_rate) /
+                                math.log(2) ** 2))
+        self.hashes = max(1, round(self.size / capacity * math.log(2)))
+        self.bits = bytearray((self.size + 7) // 8)
+
+    def indexes(self, key: str) -> List[int]:
+        """
+        Derive bit positions of a key (Kirsch-Mitzenmacher double hashing)
+
+        :param key: `str` of key
+
+        :returns: `list` of bit positions
+        """
+
+        digest = blake2b(key.encode(), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], 'little')
+        h2 = int.from_bytes(digest[8:], 'little') | 1
+
+        return [(h1 + i * h2) % self.size for i in range(self.hashes)]
+
+    def contains(self, indexes: List[int]) -> bool:
+        bits = self.bits
+        return all(bits[i >> 3] & (1 << (i & 7)) for i in indexes)
+
+    def add(self, indexes: List[int]) -> None:
+        bits = self.bits
+        for i in indexes:
+            bits[i >> 3] |= 1 << (i & 7)
+
+
+class RotatingBloomFilter:
+    """Time-rotated Bloom filter remembering keys for about `ttl` seconds"""
+
+    def __init__(self, capacity: int, ttl: float,
+                 error_rate: float = BLOOM_ERROR_RATE,
+                 generations: int = BLOOM_GENERATIONS) -> None:
+        """
+        Rotating Bloom filter initializer
+
+        Keys are added to the newest of `generations` filters, and a new
+        filter replaces the oldest every `ttl / generations` seconds.
+
+        :param capacity: `int` of expected number of keys over `ttl`
+                         (expected rate x ttl)
+        :param ttl: `float` of seconds keys are remembered
+        :param error_rate: `float` of acceptable false positive rate
+        :param generations: `int` of number of filters
+
+        :returns: `None`
+        """
+
+        self.capacity = capacity // generations
+        self.error_rate = error_rate / generations
+        self.generations = generations
+        self.period = ttl / generations
+        self.filters = [BloomFilter(self.capacity, self.error_rate)]
+        self.rotated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def rotate(self) -> None:
+        now = time.monotonic()
+        if now - self.rotated >= self.period * self.generations:
+            self.filters = []
+            self.rotated = now - self.period
+        while now - self.rotated >= self.period:
+            self.filters.append(BloomFilter(self.capacity, self.error_rate))
+            self.filters = self.filters[-self.generations:]
+            self.rotated += self.period
+
+    def add(self, key: str) -> bool:
+        """
+        Add a key to the filter
+
+        :param key: `str` of key
+
+        :returns: `bool` of whether the key was not (probably) seen before
+        """
+
+        with self.lock:
+            self.rotate()
+            indexes = self.filters[0].indexes(key)
+            if any(f.contains(indexes) for f in self.filters):
+                return False
+            self.filters[-1].add(indexes)
+            return True
+
+    def __contains__(self, key: str) -> bool:
+        with self.lock:
+            self.rotate()
+            indexes = self.filters[0].indexes(key)
+            return any(f.contains(indexes) for f in self.filters)
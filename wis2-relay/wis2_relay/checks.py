@@ -0,0 +1,351 @@
+###############################################################################
+#
+# Licensed to the Apache Software Foundation (ASF) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The ASF licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+#
+###############################################################################
+
+
+import logging
+import threading
+import time
+from typing import Callable, Optional
+
+from wis2_relay.message import WNMessage
+from wis2_relay.reload import Reloadable
+from wis2_relay.verify import ValidationSampler, ValidationSequence
+
+LOGGER = logging.getLogger(__name__)
+
+INLINE_SIZE_LIMIT = 4096
+# maximum bytes of a message payload, 0 for no limit
+MESSAGE_SIZE_LIMIT = 0
+# check stages, cheapest first: duplicates only need the message id, so
+# the fields needing a full parse are checked after de-duplication
+CHECK_PIPELINE = ['size', 'topic', 'dedup', 'fields', 'schema']
+
+
+class CheckedMessage:
+    """Message going through a CheckPipeline"""
+
+    __slots__ = ('topic', 'centre_id', 'mesg', 'pipeline', 'index', 'start',
+                 'arrival')
+
+    def __init__(self, topic: str, payload: bytes) -> None:
+        """
+        Checked message initializer
+
+        :param topic: `str` of topic
+        :param payload: `bytes` of MQTT message payload
+
+        :returns: `None`
+        """
+
+        self.topic = topic
+        levels = topic.split('/')
+        self.centre_id = levels[3] if len(levels) > 3 else None
+        self.mesg = WNMessage(payload)
+        self.pipeline = None
+        self.index = 0
+        self.start = None
+        self.arrival = time.time()
+
+    def resume(self, passed: bool) -> None:
+        """
+        Resume the checks after a stage completed later
+
+        :param passed: `bool` of whether the message passed the stage
+
+        :returns: `None`
+        """
+
+        self.pipeline.resume(self, passed)
+
+
+class CheckPipeline:
+    """Checks messages in a sequence of stages and accepts those passing
+    all stages"""
+
+    def __init__(self, stages: dict, order: list,
+                 accept: Callable[[CheckedMessage], None],
+                 metrics=None, labels: list = None) -> None:
+        """
+        Check pipeline initializer
+
+        A stage is a callable taking a `CheckedMessage` and returning
+        whether the message passes, or `None` when the stage completes
+        later with `CheckedMessage.resume` (e.g. after a Redis round trip).
+
+        :param stages: `dict` of stages by name
+        :param order: `list` of names of the stages to run, in order
+        :param accept: callable receiving messages passing all stages
+        :param metrics: `RelayMetricAggregator` to report checked and
+                        rejected messages and time spent per stage to
+        :param labels: `list` of metric label values
+
+        :returns: `None`
+        """
+
+        unknown = [name for name in order if name not in stages]
+        if unknown:
+            raise ValueError(f'Unknown check stages: {unknown}')
+
+        self.stages = [(name, stages[name]) for name in order]
+        self.accept = accept
+        self.metrics = metrics
+        self.labels = labels
+        self.stats = self.new_stats()
+        self.lock = threading.Lock()
+
+        if metrics is not None:
+            metrics.add_collector(self.collect)
+
+    def new_stats(self) -> dict:
+        # checked messages, rejected messages, seconds
+        return {name: [0, 0, 0.0] for name, _ in self.stages}
+
+    def check(self, checked: CheckedMessage) -> None:
+        """
+        Run the stages of a message, from its next stage
+
+        :param checked: `CheckedMessage` of message
+
+        :returns: `None`
+        """
+
+        checked.pipeline = self
+        stages = self.stages
+        # stage, seconds and verdict of each completed stage
+        completed = []
+        now = time.perf_counter()
+
+        while checked.index < len(stages):
+            name, stage = stages[checked.index]
+            checked.index += 1
+            checked.start = now
+            passed = stage(checked)
+            if passed is None:
+                break
+            now = time.perf_counter()
+            completed.append((name, now - checked.start, passed))
+            if not passed:
+                break
+        else:
+            self.accept(checked)
+
+        self.record(completed)
+
+    def resume(self, checked: CheckedMessage, passed: bool) -> None:
+        name = self.stages[checked.index - 1][0]
+        self.record([(name, time.perf_counter() - checked.start, passed)])
+        if passed:
+            self.check(checked)
+
+    def record(self, completed: list) -> None:
+        with self.lock:
+            for name, seconds, passed in completed:
+                stats = self.stats[name]
+                stats[0] += 1
+                stats[1] += not passed
+                stats[2] += seconds
+
+    def collect(self) -> None:
+        with self.lock:
+            stats, self.stats = self.stats, self.new_stats()
+
+        for name, (checked, rejected, seconds) in stats.items():
+            if not checked:
+                continue
+            labels = self.labels + [name]
+            self.metrics.record('check_total', labels, checked)
+            self.metrics.record('check_rejected_total', labels, rejected)
+            self.metrics.record('check_seconds_total', labels, seconds)
+
+
+class MessageChecks:
+    """Check stages of a subscription, as shared by the relay engines"""
+
+    def __init__(self, options: dict, wnm_topic: Reloadable,
+                 wnm_schema: Reloadable,
+                 process_metric: Callable[..., None],
+                 process_mesg: Callable[[str, bytes], None],
+                 validation: ValidationSequence = None,
+                 sampler: ValidationSampler = None) -> None:
+        """
+        Message checks initializer
+
+        :param options: `dict` of relay options
+        :param wnm_topic: `Reloadable` of `WIS2TopicHierarchy` of topic
+                          validator
+        :param wnm_schema: `Reloadable` of `WNMValidate` of message
+                           validator
+        :param process_metric: callable to report metrics
+        :param process_mesg: callable publishing a message
+        :param validation: `ValidationSequence` validating messages in a
+                           `ValidationPool`, `None` to validate in process
+        :param sampler: `ValidationSampler` of messages to validate
+
+        :returns: `None`
+        """
+
+        self.options = options
+        self.wnm_topic = wnm_topic
+        self.wnm_schema = wnm_schema
+        self.process_metric = process_metric
+        self.process_mesg = process_mesg
+        self.validation = validation
+        self.sampler = sampler
+        self.size_limit = options.get('max_message_size', MESSAGE_SIZE_LIMIT)
+
+    def create_pipeline(self, dedup: Callable[[CheckedMessage],
+                                              Optional[bool]],
+                        metrics=None, labels: list = None) -> CheckPipeline:
+        """
+        Create the check pipeline of the subscription
+
+        :param dedup: de-duplication stage of the relay engine
+        :param metrics: `RelayMetricAggregator` to report stage metrics to
+        :param labels: `list` of metric label values
+
+        :returns: `CheckPipeline` of stages of the `check_pipeline` option
+        """
+
+        stages = {
+            'size': self.size,
+            'topic': self.topic,
+            'fields': self.fields,
+            'dedup': dedup,
+            'schema': self.schema
+        }
+
+        return CheckPipeline(stages,
+                             self.options.get('check_pipeline',
+                                              CHECK_PIPELINE),
+                             self.publish, metrics, labels)
+
+    def size(self, checked: CheckedMessage) -> bool:
+        size = len(checked.mesg.raw)
+        if self.size_limit and size > self.size_limit:
+            LOGGER.error(f'Message too large. Centre: {checked.centre_id} Size: {size}')  # noqa
+            self.process_metric("invalid_total")
+            return False
+
+        return True
+
+    def topic(self, checked: CheckedMessage) -> bool:
+        topic = checked.topic
+        process_metric = self.process_metric
+        wnm_topic = self.wnm_topic.get()
+
+        preamble, centre_valid, depth, esd = wnm_topic.verdict(topic)
+        if not preamble:
+            LOGGER.error(f'Invalid WIS2 Topic Preamble {topic}')
+            LOGGER.error('Review Global Broker Client Subscriptions')
+            process_metric("invalid_topic_total")
+            return False
+        if self.options.get('verify_centre_id', False) and not centre_valid:
+            LOGGER.error(f'Invalid Centre-ID in Topic: {topic}')
+            process_metric("invalid_topic_total")
+            return False
+        if self.options.get('verify_topic', False):
+            if not depth:
+                LOGGER.error(f'Invalid WIS2 Topic Preamble {topic}')
+                process_metric("invalid_topic_total")
+                return False
+            if not esd:
+                LOGGER.error(f'Invalid Earth System Discipline Topic {topic}')  # noqa
+                process_metric("invalid_topic_total")
+                return False
+
+        return True
+
+    def fields(self, checked: CheckedMessage) -> bool:
+        mesg = checked.mesg
+        centre_id = checked.centre_id
+
+        try:
+            mesg.id
+            inlinesize = mesg.inline_size
+            # an explicit null metadata_id is not missing
+            has_metadata = 'metadata_id' in mesg.properties()
+        except (KeyError, ValueError) as err:
+            LOGGER.error(f'Invalid message on {checked.topic}: {err!r}')
+            self.process_metric("invalid_format_total")
+            return False
+
+        if self.options.get('verify_data', False):
+            if inlinesize is None:
+                LOGGER.debug('no inline data found')
+            elif inlinesize > INLINE_SIZE_LIMIT:
+                LOGGER.error(f'Message inline content too large. Centre: {centre_id} Size: {inlinesize}')  # noqa
+                self.process_metric("invalid_total")
+                return False
+
+        if not has_metadata and self.options.get('verify_metadata', False):
+            LOGGER.error(f'Message missing metadata.  Centre: {centre_id}')
+            self.process_metric("no_metadata_total")
+            return False
+
+        return True
+
+    def schema(self, checked: CheckedMessage) -> Optional[bool]:
+        centre_id = checked.centre_id
+
+        if not self.options.get('validate_message', False):
+            return True
+        if self.sampler is not None and not self.sampler.sample(centre_id):
+            return True
+
+        if self.validation is not None:
+            self.validation.validate(checked.topic, checked.mesg, centre_id,
+                                     checked.resume)
+            return None
+
+        try:
+            LOGGER.debug('Validating message')
+            wnm_schema = self.wnm_schema.get()
+            success, err = wnm_schema.validate_message(checked.mesg.dict)
+        except (RuntimeError, ValueError) as err:
+            LOGGER.error(f'Cannot validate message: {err}', exc_info=True)
+            return False
+
+        if not success:
+            LOGGER.error(f'Message is not valid. Centre: {centre_id} Error: {err}')  # noqa
+            self.process_metric("invalid_format_total")
+            if self.sampler is not None:
+                self.sampler.invalid(centre_id)
+            return False
+
+        return True
+
+    def publish(self, checked: CheckedMessage) -> None:
+        mesg = checked.mesg
+        try:
+            has_metadata = 'metadata_id' in mesg.properties()
+            data_id = mesg.data_id
+        except ValueError:
+            # not checked by a fields stage
+            has_metadata, data_id = False, None
+
+        # counted once per new message (rejected by the fields stage with
+        # verify_metadata)
+        if not has_metadata:
+            LOGGER.error(f'Message missing metadata.  Centre: {checked.centre_id}')  # noqa
+            self.process_metric("no_metadata_total")
+
+        LOGGER.debug(f'Received message with Data_ID: {data_id}')
+        self.process_mesg(checked.topic, mesg.payload)
@@ -0,0 +1,1179 @@
+###############################################################################
+#
+# Licensed to the Apache Software Foundation (ASF) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The ASF licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+#
+###############################################################################
+
+from collections import deque, OrderedDict
+from functools import lru_cache, partial
+from hashlib import blake2b, sha1
+import logging
+import math
+import queue
+import threading
+import time
+from typing import Any, Callable, List, Optional
+
+from redis.crc import REDIS_CLUSTER_HASH_SLOTS, key_slot
+from redis.exceptions import NoScriptError
+
+from wis2_relay.bloom import BLOOM_ERROR_RATE, RotatingBloomFilter
+
+LOGGER = logging.getLogger(__name__)
+
+DEDUP_TTL = 3600
+DEDUP_TTL_MIN = 600
+DEDUP_TTL_PERCENTILE = 99
+DEDUP_TTL_MARGIN = 300
+DEDUP_TTL_INTERVAL = 60
+DEDUP_LAG_SAMPLES = 100000
+DEDUP_LAG_MIN_SAMPLES = 100
+DEDUP_WINDOW = 0.005
+DEDUP_BATCH_SIZE = 500
+DEDUP_CACHE_TTL = 600
+DEDUP_CACHE_SIZE = 100000
+DEDUP_EXPECTED_RATE = 100
+DEDUP_LAYOUT = 'key'
+DEDUP_BUCKET_SECONDS = 300
+DEDUP_SHARDS = 1024
+DEDUP_PREFIX = 'dedup'
+
+# The counters of ids won and duplicates per upstream of both scripts are
+# cumulative: they are never expired or reset, and hold two fields per
+# upstream in each hash (one per cluster slot or shard)
+
+# Adds the fields ARGV[3], ARGV[5].. (values ARGV[4], ARGV[6]..) to the hash
+# KEYS[1] unless found in any bucket of KEYS, expires KEYS[1] at ARGV[1]
+# and returns 1 per added field, the value found per field found.  With
+# accounting (ARGV[2] set), the last of KEYS is a hash of counters of ids
+# won and duplicates per upstream, the second word of the value of a field
+BUCKET_SET_NX = """
+local buckets = #KEYS
+if ARGV[2] ~= '' then
+    buckets = buckets - 1
+end
+local replies = {}
+local counts = {}
+for i = 3, #ARGV, 2 do
+    local stored = false
+    for k = 1, buckets do
+        stored = redis.call('HGET', KEYS[k], ARGV[i])
+        if stored then
+            break
+        end
+    end
+    local counter = ':won'
+    if stored then
+        replies[#replies + 1] = stored
+        counter = ':duplicate'
+    else
+        redis.call('HSET', KEYS[1], ARGV[i], ARGV[i + 1])
+        replies[#replies + 1] = 1
+    end
+    local upstream = string.match(ARGV[i + 1], '^%S+ (%S+)')
+    if buckets < #KEYS and upstream then
+        counter = upstream .. counter
+        counts[counter] = (counts[counter] or 0) + 1
+    end
+end
+redis.call('EXPIREAT', KEYS[1], ARGV[1])
+for counter, count in pairs(counts) do
+    redis.call('HINCRBY', KEYS[#KEYS], counter, count)
+end
+return replies
+"""
+
+# Sets the keys KEYS[2].. (values ARGV[1], ARGV[3].., expiring in ARGV[2],
+# ARGV[4].. seconds) unless they exist, counts ids won and duplicates per
+# upstream, the second word of the value, in the hash KEYS[1] and returns
+# 1 per key set, the value found per key found
+KEY_SET_NX = """
+local replies = {}
+local counts = {}
+for k = 2, #KEYS do
+    local value = ARGV[2 * k - 3]
+    local stored = redis.call('GET', KEYS[k])
+    local counter = ':won'
+    if stored then
+        replies[#replies + 1] = stored
+        counter = ':duplicate'
+    else
+        redis.call('SET', KEYS[k], value, 'EX', ARGV[2 * k - 2])
+        replies[#replies + 1] = 1
+    end
+    local upstream = string.match(value, '^%S+ (%S+)')
+    if upstream then
+        counter = upstream .. counter
+        counts[counter] = (counts[counter] or 0) + 1
+    end
+end
+for counter, count in pairs(counts) do
+    redis.call('HINCRBY', KEYS[1], counter, count)
+end
+return replies
+"""
+
+FIRST_RECONNECT_DELAY = 1
+RECONNECT_RATE = 2
+MAX_RECONNECT_DELAY = 60
+
+
+def lag_percentile(lags: list, percentile: float) -> float:
+    """
+    Get a percentile of lags (nearest rank)
+
+    :param lags: `list` of sorted lags
+    :param percentile: `float` of percentile
+
+    :returns: `float` of lag
+    """
+
+    return lags[max(0, math.ceil(len(lags) * percentile / 100) - 1)]
+
+
+def window_ttl(lags: list, percentile: float = DEDUP_TTL_PERCENTILE,
+               margin: float = DEDUP_TTL_MARGIN,
+               min_ttl: float = DEDUP_TTL_MIN,
+               max_ttl: float = math.inf) -> int:
+    """
+    Get the de-duplication TTL covering a percentile of duplicate lags
+
+    :param lags: `list` of seconds from the first arrival of message ids
+                 to the arrival of their duplicates
+    :param percentile: `float` of percentile of lags covered
+    :param margin: `float` of seconds added to the percentile
+    :param min_ttl: `float` of minimum TTL
+    :param max_ttl: `float` of maximum TTL
+
+    :returns: `int` of seconds
+    """
+
+    lag = lag_percentile(sorted(lags), percentile)
+
+    return int(min(max(math.ceil(lag + margin), min_ttl), max_ttl))
+
+
+class AdaptiveTTL:
+    """De-duplication TTL set from a rolling high percentile of the lag
+    of duplicates, between a minimum and the configured TTL"""
+
+    def __init__(self, max_ttl: int = DEDUP_TTL, min_ttl: int = DEDUP_TTL_MIN,
+                 percentile: float = DEDUP_TTL_PERCENTILE,
+                 margin: float = DEDUP_TTL_MARGIN,
+                 samples: int = DEDUP_LAG_SAMPLES,
+                 interval: float = DEDUP_TTL_INTERVAL,
+                 metrics=None, labels: list = None) -> None:
+        """
+        Adaptive TTL initializer
+
+        The TTL starts at `max_ttl` and is recomputed every `interval`
+        seconds from the last `samples` lags, once enough are known.
+
+        :param max_ttl: `int` of maximum (and initial) TTL
+        :param min_ttl: `int` of minimum TTL
+        :param percentile: `float` of percentile of lags covered
+        :param margin: `float` of seconds added to the percentile
+        :param samples: `int` of number of recent lags kept
+        :param interval: `float` of seconds between updates of the TTL
+        :param metrics: `RelayMetricAggregator` to report the TTL to
+        :param labels: `list` of metric labels
+
+        :returns: `None`
+        """
+
+        self.ttl = max_ttl
+        self.max_ttl = max_ttl
+        self.min_ttl = min_ttl
+        self.percentile = percentile
+        self.margin = margin
+        self.interval = interval
+        self.lags = deque(maxlen=samples)
+        self.updated = time.monotonic()
+        self.metrics = metrics
+        self.labels = labels
+        self.lock = threading.Lock()
+
+        if metrics is not None:
+            metrics.add_collector(self.collect)
+
+    def observe(self, lag: float) -> None:
+        """
+        Record the lag of a duplicate
+
+        :param lag: `float` of seconds from the first arrival of the id
+
+        :returns: `None`
+        """
+
+        with self.lock:
+            self.lags.append(lag)
+
+    def update(self) -> int:
+        """
+        Recompute the TTL when due
+
+        :returns: `int` of seconds ids are remembered
+        """
+
+        now = time.monotonic()
+        with self.lock:
+            if now - self.updated < self.interval:
+                return self.ttl
+            self.updated = now
+            lags = list(self.lags)
+
+        if len(lags) >= DEDUP_LAG_MIN_SAMPLES:
+            ttl = window_ttl(lags, self.percentile, self.margin,
+                             self.min_ttl, self.max_ttl)
+            if ttl != self.ttl:
+                LOGGER.info(f'De-duplication TTL set to {ttl} seconds')
+                self.ttl = ttl
+
+        return self.ttl
+
+    def collect(self) -> None:
+        self.metrics.record('dedup_ttl_seconds', self.labels, self.ttl)
+
+
+def create_adaptive_ttl(options: dict, metrics=None,
+                        labels: list = None) -> Optional[AdaptiveTTL]:
+    """
+    Create the adaptive de-duplication TTL, shared by the upstreams
+
+    :param options: `dict` of relay options
+    :param metrics: `RelayMetricAggregator` to report the TTL to
+    :param labels: `list` of metric labels
+
+    :returns: `AdaptiveTTL`, `None` unless `dedup_ttl_adaptive` is set
+    """
+
+    if not options.get('dedup_ttl_adaptive', False):
+        return None
+
+    if not options.get('dedup_accounting', False):
+        LOGGER.warning('dedup_ttl_adaptive without dedup_accounting only '
+                       'learns from duplicates of message ids first '
+                       'delivered to this relay')
+
+    return AdaptiveTTL(int(options.get('dedup_ttl', DEDUP_TTL)),
+                       int(options.get('dedup_ttl_min', DEDUP_TTL_MIN)),
+                       float(options.get('dedup_ttl_percentile',
+                                         DEDUP_TTL_PERCENTILE)),
+                       float(options.get('dedup_ttl_margin',
+                                         DEDUP_TTL_MARGIN)),
+                       metrics=metrics, labels=labels)
+
+
+class FirstArrival(str):
+    """Value stored with a message id by its first arrival: the centre
+    identifier of its topic and, with accounting, the upstream it came
+    from and its arrival time.  Returned as the (false) verdict of a
+    duplicate id"""
+
+    def __bool__(self) -> bool:
+        return False
+
+    @property
+    def centre_id(self) -> str:
+        return self.split(' ')[0]
+
+    @property
+    def upstream(self) -> Optional[str]:
+        fields = self.split(' ')
+        return fields[1] if len(fields) > 1 else None
+
+    @property
+    def arrival(self) -> Optional[float]:
+        fields = self.split(' ')
+        return float(fields[2]) if len(fields) > 2 else None
+
+
+def first_arrival(centre_id: str, upstream: str,
+                  arrival: float) -> FirstArrival:
+    """
+    Create the value stored with a message id by its first arrival
+
+    :param centre_id: `str` of centre identifier of the topic
+    :param upstream: `str` of centre identifier of the upstream
+    :param arrival: `float` of arrival time (seconds since the epoch)
+
+    :returns: `FirstArrival` of the id
+    """
+
+    return FirstArrival(f'{centre_id} {upstream} {arrival:.3f}')
+
+
+def record_race(process_metric: Callable[..., None], won: bool,
+                first: FirstArrival = None, arrival: float = None,
+                adaptive_ttl: AdaptiveTTL = None) -> None:
+    """
+    Report whether an upstream delivered a message id first and, if not,
+    how long after the first arrival
+
+    :param process_metric: callable to report metrics of the upstream
+    :param won: `bool` of whether the id was not seen before
+    :param first: `FirstArrival` of a duplicate id, when known
+    :param arrival: `float` of arrival time of the duplicate
+    :param adaptive_ttl: `AdaptiveTTL` to record the lag to
+
+    :returns: `None`
+    """
+
+    if won:
+        process_metric('dedup_won_total')
+        return
+
+    process_metric('dedup_duplicate_total')
+    if first is not None and first.arrival is not None:
+        # arrivals recorded by relays with a clock ahead count as no lag
+        lag = max(0, arrival - first.arrival)
+        process_metric('dedup_duplicate_lag_seconds', lag)
+        if adaptive_ttl is not None:
+            adaptive_ttl.observe(lag)
+
+
+class DedupCache:
+    """Bounded in-memory TTL/LRU cache of recently seen message ids"""
+
+    def __init__(self, ttl: float = DEDUP_CACHE_TTL,
+                 max_size: int = DEDUP_CACHE_SIZE,
+                 adaptive_ttl: AdaptiveTTL = None) -> None:
+        """
+        Cache initializer
+
+        :param ttl: `float` of seconds an id is remembered
+        :param max_size: `int` of maximum number of ids held (0 disables)
+        :param adaptive_ttl: `AdaptiveTTL` of the de-duplication window,
+                             capping `ttl` so that ids expired from Redis
+                             are not reported as duplicates
+
+        :returns: `None`
+        """
+
+        self.ttl = ttl
+        self.max_size = max_size
+        self.adaptive_ttl = adaptive_ttl
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def seen(self, mesg_id: str) -> bool:
+        """
+        Whether a message id is known to be stored in Redis
+
+        :param mesg_id: `str` of message id
+
+        :returns: `bool` of whether the id is cached
+        """
+
+        now = time.monotonic()
+        with self.lock:
+            entry = self.entries.get(mesg_id)
+            if entry is None:
+                return False
+            if entry[0] < now:
+                del self.entries[mesg_id]
+                return False
+            self.entries.move_to_end(mesg_id)
+            return True
+
+    def get(self, mesg_id: str) -> Optional[FirstArrival]:
+        """
+        Get the first arrival of a cached message id
+
+        :param mesg_id: `str` of message id
+
+        :returns: `FirstArrival` of the id, `None` if unknown
+        """
+
+        with self.lock:
+            entry = self.entries.get(mesg_id)
+        return entry[1] if entry is not None else None
+
+    def add(self, mesg_id: str, first: FirstArrival = None) -> int:
+        """
+        Remember a message id stored in Redis
+
+        :param mesg_id: `str` of message id
+        :param first: `FirstArrival` of the id, when known
+
+        :returns: `int` of live ids evicted to respect the size cap
+        """
+
+        if self.max_size <= 0:
+            return 0
+
+        ttl = self.ttl
+        if self.adaptive_ttl is not None:
+            ttl = min(ttl, self.adaptive_ttl.ttl)
+
+        now = time.monotonic()
+        evicted = 0
+        with self.lock:
+            if mesg_id not in self.entries:
+                self.entries[mesg_id] = (now + ttl, first)
+            self.entries.move_to_end(mesg_id)
+
+            while self.entries:
+                oldest, (expires, _) = next(iter(self.entries.items()))
+                if expires < now:
+                    del self.entries[oldest]
+                elif len(self.entries) > self.max_size:
+                    del self.entries[oldest]
+                    evicted += 1
+                else:
+                    break
+
+        return evicted
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+
+@lru_cache(maxsize=None)
+def slot_tags() -> list:
+    """
+    Get a hash tag of each Redis cluster slot
+
+    :returns: `list` of `str` of the shortest numeric hash tag of each slot
+    """
+
+    tags = [None] * REDIS_CLUSTER_HASH_SLOTS
+    missing = REDIS_CLUSTER_HASH_SLOTS
+    n = 0
+
+    while missing:
+        slot = key_slot(str(n).encode())
+        if tags[slot] is None:
+            tags[slot] = str(n)
+            missing -= 1
+        n += 1
+
+    return tags
+
+
+class KeyLayout:
+    """Message ids stored in Redis as one key each, with SET NX"""
+
+    def __init__(self, ttl: int = DEDUP_TTL, accounting: bool = False,
+                 prefix: str = DEDUP_PREFIX) -> None:
+        """
+        Key layout initializer
+
+        With accounting, ids are checked and set by a script that also
+        counts the ids won and the duplicates of each upstream, in a hash
+        per cluster slot.
+
+        :param ttl: `int` of seconds ids are remembered
+        :param accounting: `bool` of whether to count ids per upstream,
+                           from values ending with the upstream
+        :param prefix: `str` of key prefix of the counters
+
+        :returns: `None`
+        """
+
+        self.ttl = ttl
+        self.accounting = accounting
+        self.prefix = prefix
+        # Lua script of the layout, loaded on the Redis nodes when missing
+        self.script = None
+        if accounting:
+            self.script = KEY_SET_NX
+            self.sha = sha1(self.script.encode()).hexdigest()
+
+    def stats_key(self, tag: str) -> str:
+        """
+        Get the key of the hash of counters of ids won and duplicates per
+        upstream, of a cluster slot
+
+        :param tag: `str` of hash tag of the slot
+
+        :returns: `str` of key
+        """
+
+        return f'{self.prefix}-stats:{{{tag}}}'
+
+    def queue(self, pipe, items: list, keyslot: Callable[[str], int]) -> list:
+        """
+        Queue the commands of a batch of ids on a Redis pipeline
+
+        :param pipe: Redis cluster pipeline
+        :param items: `list` of (id, value, ttl) tuples
+        :param keyslot: callable returning the cluster slot of a key
+
+        :returns: `list` of `list` of indexes of the items of each command
+        """
+
+        if self.script is None:
+            # sorted() is stable, so repeated ids keep their arrival order
+            order = sorted(range(len(items)),
+                           key=lambda i: keyslot(items[i][0]))
+
+            for i in order:
+                mesg_id, value, ttl = items[i]
+                pipe.set(mesg_id, value, ex=ttl, nx=True)
+
+            return [[i] for i in order]
+
+        # a script per cluster slot, with the counters of the slot
+        groups = {}
+        for i, (mesg_id, value, ttl) in enumerate(items):
+            group = groups.setdefault(keyslot(mesg_id), [[], [], []])
+            group[0].append(i)
+            group[1].append(mesg_id)
+            group[2] += [value, ttl]
+
+        tags = slot_tags()
+        for slot, (indexes, keys, args) in groups.items():
+            # cluster pipelines only run scripts with execute_command
+            pipe.execute_command('EVALSHA', self.sha, len(keys) + 1,
+                                 self.stats_key(tags[slot]), *keys, *args)
+
+        return [indexes for indexes, _, _ in groups.values()]
+
+    def verdicts(self, items: list, commands: list, replies: list) -> list:
+        """
+        Map the replies of the commands of a batch to its items
+
+        :param items: `list` of (id, value, ttl) tuples
+        :param commands: `list` of indexes of the items of each command
+        :param replies: `list` of replies of each command
+
+        :returns: `list` of verdicts, in the order of `items`: `True` for
+                  new ids, `FirstArrival` (or `None`, without a script)
+                  for duplicates and the `Exception` of failed commands
+        """
+
+        results = [None] * len(items)
+        for indexes, reply in zip(commands, replies):
+            for n, i in enumerate(indexes):
+                if self.script is None or isinstance(reply, Exception):
+                    results[i] = reply
+                elif reply[n] == 1:
+                    results[i] = True
+                else:
+                    results[i] = FirstArrival(reply[n].decode())
+
+        return results
+
+
+class BucketLayout(KeyLayout):
+    """Digests of message ids stored in Redis in time-bucketed hashes"""
+
+    def __init__(self, ttl: int = DEDUP_TTL,
+                 bucket_seconds: int = DEDUP_BUCKET_SECONDS,
+                 shards: int = DEDUP_SHARDS, accounting: bool = False,
+                 prefix: str = DEDUP_PREFIX) -> None:
+        """
+        Bucket layout initializer
+
+        Ids are stored as 16 byte digests in hashes of `bucket_seconds`,
+        one per shard, that expire as a whole `ttl` seconds after the end
+        of the bucket.  The buckets of a shard share a cluster slot and
+        are checked together by a script.  All relays must use the same
+        layout.
+
+        :param ttl: `int` of seconds ids are remembered
+        :param bucket_seconds: `int` of seconds per bucket
+        :param shards: `int` of number of shards
+        :param accounting: `bool` of whether to count ids per upstream,
+                           in a hash per shard
+        :param prefix: `str` of key prefix
+
+        :returns: `None`
+        """
+
+        self.ttl = ttl
+        self.bucket_seconds = bucket_seconds
+        self.shards = shards
+        self.accounting = accounting
+        self.prefix = prefix
+        self.script = BUCKET_SET_NX
+        self.sha = sha1(self.script.encode()).hexdigest()
+
+    @property
+    def lookback(self) -> int:
+        # buckets of an id stored up to ttl seconds ago, the ttl of an
+        # adaptive window at the time of the check
+        return math.ceil(self.ttl / self.bucket_seconds)
+
+    def digest(self, mesg_id: str) -> bytes:
+        return blake2b(mesg_id.encode(), digest_size=16).digest()
+
+    def keys(self, shard: int, bucket: int) -> list:
+        """
+        Get the keys of the buckets to check
+
+        :param shard: `int` of shard
+        :param bucket: `int` of current bucket
+
+        :returns: `list` of keys, the current bucket first, then the next
+                  bucket of relays with a clock ahead
+        """
+
+        return [f'{self.prefix}:{{{shard}}}:{b}'
+                for b in [bucket, bucket + 1] +
+                list(range(bucket - 1, bucket - self.lookback - 1, -1))]
+
+    def queue(self, pipe, items: list, keyslot: Callable[[str], int]) -> list:
+        now = time.time()
+        groups = {}
+
+        for i, (mesg_id, value, ttl) in enumerate(items):
+            digest = self.digest(mesg_id)
+            shard = int.from_bytes(digest[:4], 'little') % self.shards
+            # ids written back are stored in the bucket they were seen in
+            bucket = int((now - self.ttl + ttl) // self.bucket_seconds)
+            group = groups.setdefault((shard, bucket), [[], []])
+            group[0].append(i)
+            group[1] += [digest, value]
+
+        commands = []
+        for (shard, bucket), (indexes, args) in groups.items():
+            keys = self.keys(shard, bucket)
+            if self.accounting:
+                keys.append(self.stats_key(shard))
+            expire_at = (bucket + 1) * self.bucket_seconds + self.ttl
+            pipe.execute_command('EVALSHA', self.sha, len(keys), *keys,
+                                 expire_at, 'accounting' if self.accounting
+                                 else '', *args)
+            commands.append(indexes)
+
+        return commands
+
+
+def create_layout(options: dict, prefix: str = DEDUP_PREFIX) -> KeyLayout:
+    """
+    Create the Redis de-duplication layout
+
+    :param options: `dict` of relay options
+    :param prefix: `str` of key prefix
+
+    :returns: `KeyLayout` or `BucketLayout` as per `dedup_layout`
+    """
+
+    ttl = int(options.get('dedup_ttl', DEDUP_TTL))
+    layout = options.get('dedup_layout', DEDUP_LAYOUT)
+    accounting = options.get('dedup_accounting', False)
+
+    if layout == 'key':
+        return KeyLayout(ttl, accounting, prefix)
+    if layout == 'bucket':
+        return BucketLayout(ttl, int(options.get('dedup_bucket_seconds',
+                                                 DEDUP_BUCKET_SECONDS)),
+                            int(options.get('dedup_shards', DEDUP_SHARDS)),
+                            accounting, prefix)
+
+    raise ValueError(f'Unknown dedup_layout: {layout}')
+
+
+class BatchDedup:
+    """State of micro-batched Redis message de-duplication shared by the
+    relay engines: TTL, local fallback, reconnect backoff and write-back"""
+
+    def __init__(self, redis, options: dict,
+                 process_metric: Callable[..., None] = None,
+                 fallback: RotatingBloomFilter = None,
+                 adaptive_ttl: AdaptiveTTL = None) -> None:
+        """
+        Dedup initializer
+
+        :param redis: Redis cluster client
+        :param options: `dict` of relay options
+        :param process_metric: callable to report metrics
+        :param fallback: `RotatingBloomFilter` used while Redis is
+                         unavailable (created from options if not set)
+        :param adaptive_ttl: `AdaptiveTTL` setting the TTL of ids (created
+                             from options if not set)
+
+        :returns: `None`
+        """
+
+        self.redis = redis
+        self.ttl = int(options.get('dedup_ttl', DEDUP_TTL))
+        self.window = float(options.get('dedup_window', DEDUP_WINDOW))
+        self.batch_size = int(options.get('dedup_batch_size',
+                                          DEDUP_BATCH_SIZE))
+        self.layout = create_layout(options)
+        self.accounting = options.get('dedup_accounting', False)
+        self.process_metric = process_metric
+
+        self.fallback = fallback
+        self.adaptive_ttl = adaptive_ttl
+        self.degraded = False
+        self.reconnect_delay = FIRST_RECONNECT_DELAY
+        self.reconnect_at = 0
+
+        if self.fallback is None and options.get('dedup_fallback', True):
+            self.fallback = create_fallback(options)
+
+        if self.adaptive_ttl is None:
+            self.adaptive_ttl = create_adaptive_ttl(options)
+
+        # ids accepted locally while degraded, written back to Redis
+        self.pending = deque(maxlen=self.fallback.capacity *
+                             self.fallback.generations
+                             if self.fallback else 0)
+
+    def value(self, value: str, upstream: str = None) -> str:
+        if not self.accounting or upstream is None:
+            return value
+
+        return str(first_arrival(value, upstream, time.time()))
+
+    def check_verdicts(self, items: list, verdicts: list,
+                       elapsed: float) -> List[Any]:
+        """
+        Report a batch run against Redis and fall back to the local filter
+        for ids Redis failed to check
+
+        :param items: `list` of (id, value) tuples
+        :param verdicts: `list` of verdicts of Redis, in the order of
+                         `items`
+        :param elapsed: `float` of seconds of the Redis round trip
+
+        :returns: `list` of verdicts, in the order of `items`
+        """
+
+        if self.process_metric is not None:
+            self.process_metric('dedup_batch_size', len(items))
+            self.process_metric('dedup_latency_seconds', elapsed)
+
+        if self.fallback is None:
+            return verdicts
+
+        for i, (mesg_id, value) in enumerate(items):
+            if isinstance(verdicts[i], Exception):
+                if not self.degraded:
+                    LOGGER.error(f'Redis operation failed: {verdicts[i]}')
+                    self.set_degraded(True)
+                verdicts[i] = self.set_nx_local(mesg_id, value)
+            elif not self.fallback.add(mesg_id) and verdicts[i] is True:
+                self.record_late()
+
+        return verdicts
+
+    def batch_failed(self, batch: list, err: Exception) -> List[Any]:
+        """
+        Fail the ids of a batch that could not be de-duplicated
+
+        :param batch: `list` of queued items
+        :param err: `Exception` raised
+
+        :returns: `list` of verdicts: `err` for every item
+        """
+
+        LOGGER.error(f'De-duplication failed: {err}', exc_info=True)
+        return [err] * len(batch)
+
+    def update_ttl(self) -> None:
+        if self.adaptive_ttl is not None:
+            self.ttl = self.layout.ttl = self.adaptive_ttl.update()
+
+    def record_late(self) -> None:
+        """
+        Report a new id to Redis that the fallback filter, which remembers
+        ids for the configured TTL, has seen: a duplicate arriving after
+        the TTL (or a false positive of the filter)
+
+        :returns: `None`
+        """
+
+        if self.process_metric is not None:
+            self.process_metric('dedup_late_duplicate_total')
+        if self.adaptive_ttl is not None:
+            # the lag of the duplicate is at least the TTL it missed
+            self.adaptive_ttl.observe(self.ttl)
+
+    def set_nx_local(self, mesg_id: str, value: str) -> bool:
+        """
+        De-duplicate an id against the local fallback filter
+
+        :param mesg_id: `str` of message id
+        :param value: `str` of value to store with the id
+
+        :returns: `bool` of whether the id was not seen before
+        """
+
+        if not self.fallback.add(mesg_id):
+            return False
+
+        self.pending.append((mesg_id, value, time.time()))
+        return True
+
+    def set_degraded(self, degraded: bool) -> None:
+        if degraded:
+            LOGGER.warning('Redis unavailable, de-duplicating locally')
+            self.reconnect_delay = FIRST_RECONNECT_DELAY
+            self.reconnect_at = time.monotonic() + self.reconnect_delay
+        else:
+            LOGGER.info('Redis available, leaving local de-duplication')
+
+        self.degraded = degraded
+        if self.process_metric is not None:
+            self.process_metric('dedup_degraded_flag', int(degraded))
+
+    def reconnect_failed(self, err: Exception) -> None:
+        LOGGER.error(f'Redis reconnect failed: {err}. Retrying in {self.reconnect_delay} seconds')  # noqa
+        self.reconnect_at = time.monotonic() + self.reconnect_delay
+        self.reconnect_delay = min(self.reconnect_delay * RECONNECT_RATE,
+                                   MAX_RECONNECT_DELAY)
+
+    def write_back_batch(self) -> tuple:
+        """
+        Take the next batch of ids accepted while degraded, with their
+        remaining TTL
+
+        :returns: `tuple` of `list` of (id, value, ttl) tuples, empty when
+                  all ids taken expired, and of `float` of current time
+        """
+
+        now = time.time()
+        batch = []
+        while self.pending and len(batch) < self.batch_size:
+            mesg_id, value, seen = self.pending.popleft()
+            ttl = int(self.ttl - (now - seen))
+            if ttl > 0:
+                batch.append((mesg_id, value, ttl))
+
+        return batch, now
+
+    def check_write_back(self, batch: list, results: list,
+                         now: float) -> None:
+        """
+        Keep a batch written back for next time if Redis failed to store
+        any of its ids
+
+        :param batch: `list` of (id, value, ttl) tuples
+        :param results: `list` of results of the batch
+        :param now: `float` of time the batch was taken
+
+        :returns: `None`, raises the first error of the batch
+        """
+
+        errors = [r for r in results if isinstance(r, Exception)]
+        if errors:
+            # SET NX is idempotent, keep the whole batch for next time
+            self.pending.extendleft(
+                (mesg_id, value, now - self.ttl + ttl)
+                for mesg_id, value, ttl in reversed(batch))
+            raise errors[0]
+
+    def wrote_back(self, written: int) -> None:
+        LOGGER.info(f'Wrote back {written} locally de-duplicated ids')
+        if written and self.process_metric is not None:
+            self.process_metric('dedup_writeback_total', written)
+
+
+class DedupCheck:
+    """De-duplication stage of the message checks of an upstream, shared
+    by the relay engines"""
+
+    def __init__(self, dedup: BatchDedup, cache: DedupCache, upstream: str,
+                 process_metric: Callable[..., None]) -> None:
+        """
+        Dedup check initializer
+
+        :param dedup: `RedisDedup` or `AsyncRedisDedup` of the relay
+        :param cache: `DedupCache` of the relay
+        :param upstream: `str` of centre identifier of the upstream
+        :param process_metric: callable to report metrics of the upstream
+
+        :returns: `None`
+        """
+
+        self.dedup = dedup
+        self.cache = cache
+        self.upstream = upstream
+        self.process_metric = process_metric
+
+    def check(self, checked) -> Optional[bool]:
+        """
+        Check a message id against the cache, then submit it to Redis
+
+        :param checked: `CheckedMessage` to de-duplicate
+
+        :returns: `False` for a duplicate or invalid message, `None` when
+                  the verdict is pending (see `verdict`)
+        """
+
+        try:
+            mesg_id = checked.mesg.id
+        except (KeyError, ValueError) as err:
+            LOGGER.error(f'Invalid message on {checked.topic}: {err!r}')
+            self.process_metric("invalid_format_total")
+            return False
+
+        if self.cache.seen(mesg_id):
+            LOGGER.info(f"WIS2 Message exists {checked.centre_id} ID: {mesg_id}")  # noqa
+            self.process_metric("dedup_cache_hits_total")
+            record_race(self.process_metric, False, self.cache.get(mesg_id),
+                        checked.arrival, self.dedup.adaptive_ttl)
+            return False
+        self.process_metric("dedup_cache_misses_total")
+
+        return self.submit(checked, mesg_id)
+
+    def submit(self, checked, mesg_id: str) -> Optional[bool]:
+        self.dedup.submit(mesg_id, checked.centre_id,
+                          partial(self.verdict, checked), self.upstream)
+        return None
+
+    def verdict(self, checked, verdict: Any) -> None:
+        """
+        Cache the verdict of a message id and resume its checks
+
+        :param checked: `CheckedMessage` submitted by `check`
+        :param verdict: verdict of the id (see `RedisDedup.submit`)
+
+        :returns: `None`
+        """
+
+        centre_id = checked.centre_id
+        mesg_id = checked.mesg.id
+
+        if isinstance(verdict, Exception):
+            LOGGER.error(f'Redis operation failed: {verdict}')
+            checked.resume(False)
+            return
+
+        first = verdict if isinstance(verdict, FirstArrival) else None
+        if verdict:
+            first = first_arrival(centre_id, self.upstream, checked.arrival)
+
+        evicted = self.cache.add(mesg_id, first)
+        if evicted:
+            self.process_metric("dedup_cache_evictions_total", evicted)
+
+        record_race(self.process_metric, bool(verdict), first,
+                    checked.arrival, self.dedup.adaptive_ttl)
+
+        if not verdict:
+            LOGGER.info(f"WIS2 Message exists {centre_id} ID: {mesg_id}")  # noqa
+            checked.resume(False)
+            return
+
+        LOGGER.info(f"WIS2 Message received {centre_id} ID: {mesg_id}")  # noqa
+        self.process_metric("messages_received_total")
+        checked.resume(True)
+
+
+class RedisDedup(BatchDedup, threading.Thread):
+    """Micro-batched, pipelined Redis message de-duplication"""
+
+    def __init__(self, redis, options: dict,
+                 process_metric: Callable[..., None] = None,
+                 fallback: RotatingBloomFilter = None,
+                 adaptive_ttl: AdaptiveTTL = None) -> None:
+        """
+        Dedup initializer
+
+        :param redis: `redis.cluster.RedisCluster` client
+        :param options: `dict` of relay options
+        :param process_metric: callable to report metrics
+        :param fallback: `RotatingBloomFilter` used while Redis is
+                         unavailable (created from options if not set)
+        :param adaptive_ttl: `AdaptiveTTL` setting the TTL of ids (created
+                             from options if not set)
+
+        :returns: `None`
+        """
+
+        threading.Thread.__init__(self)
+        BatchDedup.__init__(self, redis, options, process_metric, fallback,
+                            adaptive_ttl)
+        self.queue = queue.Queue()
+
+    def submit(self, mesg_id: str, value: str,
+               callback: Callable[[Any], None], upstream: str = None) -> None:
+        """
+        Queue a message id for de-duplication
+
+        The callback is invoked from the dedup thread, in submission order,
+        with `True` if the id was not seen before, a false value if it is
+        a duplicate (the `FirstArrival` stored with the id, when the
+        layout runs a script), or the `Exception` raised by Redis when no
+        local fallback is available or by the de-duplication of its batch.
+
+        :param mesg_id: `str` of message id
+        :param value: `str` of value to store with the id
+        :param callback: callable receiving the verdict
+        :param upstream: `str` of centre identifier of the upstream the id
+                         came from, stored with the id and accounted for
+                         with `dedup_accounting`
+
+        :returns: `None`
+        """
+
+        self.queue.put((mesg_id, self.value(value, upstream), callback))
+
+    def next_batch(self) -> list:
+        """
+        Collect queued ids until the batch window expires or the
+        batch is full
+
+        :returns: `list` of queued items
+        """
+
+        batch = [self.queue.get()]
+        deadline = time.monotonic() + self.window
+
+        while len(batch) < self.batch_size:
+            timeout = deadline - time.monotonic()
+            try:
+                if timeout > 0:
+                    batch.append(self.queue.get(timeout=timeout))
+                else:
+                    batch.append(self.queue.get_nowait())
+            except queue.Empty:
+                break
+
+        return batch
+
+    def pipeline_set_nx(self, items: list) -> List[Any]:
+        """
+        Pipeline SET NX for a batch of ids, grouped by cluster slot
+
+        :param items: `list` of (id, value, ttl) tuples
+
+        :returns: `list` of results, in the order of `items`
+        """
+
+        verdicts = self.execute_layout(items)
+
+        # scripts are lost when a node restarts or fails over
+        retry = [i for i, verdict in enumerate(verdicts)
+                 if isinstance(verdict, NoScriptError)]
+        if retry:
+            LOGGER.info('Loading de-duplication script')
+            try:
+                self.redis.script_load(self.layout.script)
+            except Exception as err:
+                LOGGER.error(f'Redis script load failed: {err}')
+                return verdicts
+
+            for i, verdict in zip(retry, self.execute_layout(
+                    [items[i] for i in retry])):
+                verdicts[i] = verdict
+
+        return verdicts
+
+    def execute_layout(self, items: list) -> List[Any]:
+        pipe = self.redis.pipeline()
+        commands = self.layout.queue(pipe, items, self.redis.keyslot)
+
+        try:
+            replies = pipe.execute(raise_on_error=False)
+        except Exception as err:
+            replies = [err] * len(commands)
+
+        return self.layout.verdicts(items, commands, replies)
+
+    def set_nx(self, items: list) -> List[Any]:
+        """
+        De-duplicate a batch of ids against Redis, or against the local
+        fallback filter while Redis is unavailable
+
+        :param items: `list` of (id, value) tuples
+
+        :returns: `list` of verdicts, in the order of `items`
+        """
+
+        if self.degraded and not self.reconnect():
+            return [self.set_nx_local(mesg_id, value)
+                    for mesg_id, value in items]
+
+        self.update_ttl()
+        start = time.monotonic()
+        verdicts = self.pipeline_set_nx(
+            [(mesg_id, value, self.ttl) for mesg_id, value in items])
+
+        return self.check_verdicts(items, verdicts, time.monotonic() - start)
+
+    def reconnect(self) -> bool:
+        """
+        Retry Redis with exponential backoff, writing back ids accepted
+        locally once it is available again
+
+        :returns: `bool` of whether Redis is available
+        """
+
+        if time.monotonic() < self.reconnect_at:
+            return False
+
+        try:
+            self.redis.ping()
+            self.write_back()
+        except Exception as err:
+            self.reconnect_failed(err)
+            return False
+
+        self.set_degraded(False)
+        return True
+
+    def write_back(self) -> None:
+        """
+        Write ids accepted while degraded back to Redis, in batches
+
+        :returns: `None`
+        """
+
+        written = 0
+
+        while self.pending:
+            batch, now = self.write_back_batch()
+            if not batch:
+                continue
+
+            self.check_write_back(batch, self.pipeline_set_nx(batch), now)
+            written += len(batch)
+
+        self.wrote_back(written)
+
+    def run(self) -> None:
+        while True:
+            batch = self.next_batch()
+            try:
+                verdicts = self.set_nx([item[:2] for item in batch])
+            except Exception as err:
+                verdicts = self.batch_failed(batch, err)
+
+            for (_, _, callback), verdict in zip(batch, verdicts):
+                try:
+                    callback(verdict)
+                except Exception as err:
+                    LOGGER.error(f'Message handling failed: {err}',
+                                 exc_info=True)
+                finally:
+                    self.queue.task_done()
+
+
+def create_fallback(options: dict) -> RotatingBloomFilter:
+    """
+    Create the local de-duplication filter used while Redis is unavailable
+
+    :param options: `dict` of relay options
+
+    :returns: `RotatingBloomFilter` sized for expected rate x dedup TTL
+    """
+
+    ttl = int(options.get('dedup_ttl', DEDUP_TTL))
+    rate = float(options.get('dedup_expected_rate', DEDUP_EXPECTED_RATE))
+    error_rate = float(options.get('dedup_fallback_error_rate',
+                                   BLOOM_ERROR_RATE))
+
+    return RotatingBloomFilter(int(rate * ttl), ttl, error_rate)
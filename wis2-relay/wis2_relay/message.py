@@ -0,0 +1,199 @@
+###############################################################################
+#
+# Licensed to the Apache Software Foundation (ASF) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The ASF licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+#
+###############################################################################
+
+import json
+import logging
+from typing import Optional
+
+from wis2_relay import util
+
+LOGGER = logging.getLogger(__name__)
+
+WHITESPACE = b' \t\n\r'
+
+
+def _skip_separator(raw: bytes, end: int) -> int:
+    """
+    Skip the `:` separating a key from its value
+
+    :param raw: `bytes` of JSON document
+    :param end: `int` of position after the key
+
+    :returns: `int` of position of the value, or -1 if not a key
+    """
+
+    length = len(raw)
+    while end < length and raw[end] in WHITESPACE:
+        end += 1
+    if end >= length or raw[end] != ord(':'):
+        return -1
+    end += 1
+    while end < length and raw[end] in WHITESPACE:
+        end += 1
+    return end if end < length else -1
+
+
+def _depth(raw: bytes, end: int) -> int:
+    """
+    Get the nesting depth of a position of a JSON document
+
+    :param raw: `bytes` of JSON document
+    :param end: `int` of position
+
+    :returns: `int` of brackets opened before `end`, less brackets closed
+    """
+
+    outside = raw[:end]
+    if b'"' in outside:
+        if b'\\' in outside:
+            outside = outside.replace(b'\\\\', b'').replace(b'\\"', b'')
+        outside = b''.join(outside.split(b'"')[::2])
+
+    return (outside.count(b'{') + outside.count(b'[') -
+            outside.count(b'}') - outside.count(b']'))
+
+
+def extract_id(raw: bytes) -> Optional[str]:
+    """
+    Extract the id of a message from its raw payload without a full parse
+
+    The first `id` key must be at the top level of the message, with a
+    string value without escapes, otherwise the message needs a full
+    parse.  The rest of the payload is not scanned, so a repeated
+    top-level `id` (not unique, and invalid for a message) is read from
+    its first occurrence.
+
+    :param raw: `bytes` of message
+
+    :returns: `str` of message id, `None` if not extracted
+    """
+
+    token = b'"id"'
+    start = raw.find(token)
+    if start < 1 or _depth(raw, start) != 1:
+        return None
+
+    start = _skip_separator(raw, start + len(token))
+    if start < 0 or raw[start] != ord('"'):
+        return None
+    end = raw.find(b'"', start + 1)
+    if end < 0:
+        return None
+    value = raw[start + 1:end]
+    if b'\\' in value:
+        return None
+
+    try:
+        return value.decode('utf-8')
+    except UnicodeDecodeError:
+        return None
+
+
+class WNMessage:
+    """WIS2 Notification Message as received from an upstream broker"""
+
+    __slots__ = ('raw', '_dict', '_id', 'modified')
+
+    def __init__(self, payload: bytes) -> None:
+        """
+        Message initializer
+
+        The id is extracted from the raw payload on first access.  The
+        payload is parsed in full, once, for any other field, or when the
+        id cannot be extracted unambiguously.
+
+        :param payload: `bytes` of MQTT message payload
+
+        :returns: `None`
+        """
+
+        self.raw = payload
+        self._dict = None
+        self._id = None
+        self.modified = False
+
+    @property
+    def dict(self) -> dict:
+        return self.parse()
+
+    def parse(self) -> dict:
+        """
+        Fully parse the message (once)
+
+        :returns: `dict` of message
+        """
+
+        if self._dict is None:
+            self._dict = json.loads(self.raw)
+        return self._dict
+
+    def properties(self) -> dict:
+        properties = self.dict.get('properties')
+        return properties if isinstance(properties, dict) else {}
+
+    @property
+    def id(self) -> str:
+        if self._id is None:
+            if self._dict is None:
+                self._id = extract_id(self.raw)
+            if self._id is None:
+                LOGGER.debug('Parsing message id')
+                self._id = self.dict.get('id')
+            if self._id is None:
+                raise KeyError('id')
+        return self._id
+
+    @property
+    def metadata_id(self) -> Optional[str]:
+        return self.properties().get('metadata_id')
+
+    @property
+    def data_id(self) -> Optional[str]:
+        return self.properties().get('data_id')
+
+    @property
+    def inline_size(self) -> Optional[int]:
+        """
+        Length of inline content (`properties.content.value`)
+
+        :returns: `int` of inline content length, or `None` if the message
+                  has no inline content
+        """
+
+        try:
+            return len(self.properties()['content']['value'])
+        except (KeyError, TypeError):
+            return None
+
+    @property
+    def payload(self) -> bytes:
+        """
+        Payload to publish: the original bytes, unless the relay
+        modified the message
+
+        :returns: `bytes` of message payload
+        """
+
+        if not self.modified:
+            return self.raw
+
+        LOGGER.debug('Serializing modified message')
+        return json.dumps(self.dict, default=util.json_serial).encode()
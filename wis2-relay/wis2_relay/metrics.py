@@ -0,0 +1,351 @@
+###############################################################################
+#
+# Licensed to the Apache Software Foundation (ASF) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The ASF licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+#
+###############################################################################
+
+from bisect import bisect_left
+import json
+import logging
+import threading
+import time
+from typing import Callable, Union
+
+from prometheus_client import Counter, Gauge, Histogram, start_http_server
+
+LOGGER = logging.getLogger(__name__)
+
+METRICS_INTERVAL = 10
+
+METRICS_TOPIC = 'wis2-globalbroker/metrics'
+
+METRIC_LABELS = ['centre_id', 'report_by']
+# per publisher connection metrics
+METRIC_CONNECTION_LABELS = METRIC_LABELS + ['connection']
+# per relay queue metrics
+METRIC_QUEUE_LABELS = METRIC_LABELS + ['queue']
+# per priority lane metrics
+METRIC_LANE_LABELS = METRIC_LABELS + ['lane']
+# per topic hierarchy or message schema version metrics
+METRIC_VERSION_LABELS = METRIC_LABELS + ['component', 'version']
+# per check stage metrics
+METRIC_STAGE_LABELS = METRIC_LABELS + ['stage']
+
+# relay metric name: type, Prometheus metric name, description (as per
+# metrics-collector, names not listed are counters)
+METRICS = {
+    'no_metadata_total': (
+        'counter', 'wmo_wis2_gb_messages_no_metadata_total',
+        'Number of WIS2 messages missing recommended metadata'),
+    'invalid_topic_total': (
+        'counter', 'wmo_wis2_gb_messages_invalid_topic_total',
+        'Number of WIS2 messages published to invalid topic'),
+    'invalid_format_total': (
+        'counter', 'wmo_wis2_gb_messages_invalid_format_total',
+        'Number of WIS2 messages failed validation'),
+    'published_total': (
+        'counter', 'wmo_wis2_gb_messages_published_total',
+        'Number of WIS2 messages published'),
+    'messages_received_total': (
+        'counter', 'wmo_wis2_gb_messages_received_total',
+        'Number of WIS2 messages recieved'),
+    'connected_flag': (
+        'gauge', 'wmo_wis2_gb_connected_flag',
+        'WIS2 Node connection status'),
+    'last_message_timestamp': (
+        'gauge', 'wmo_wis2_gb_last_message_timestamp_seconds',
+        'Timestamp in seconds for last message recieved'),
+    'dedup_batch_size': (
+        'histogram', 'wmo_wis2_gb_dedup_batch_size',
+        'Number of message ids per Redis de-duplication batch'),
+    'dedup_latency_seconds': (
+        'histogram', 'wmo_wis2_gb_dedup_latency_seconds',
+        'Round trip time in seconds of Redis de-duplication batches'),
+    'dedup_cache_hits_total': (
+        'counter', 'wmo_wis2_gb_dedup_cache_hits_total',
+        'Number of duplicate message ids rejected by the in-memory cache'),
+    'dedup_cache_misses_total': (
+        'counter', 'wmo_wis2_gb_dedup_cache_misses_total',
+        'Number of message ids not found in the in-memory cache'),
+    'dedup_cache_evictions_total': (
+        'counter', 'wmo_wis2_gb_dedup_cache_evictions_total',
+        'Number of live message ids evicted from the in-memory cache'),
+    'dedup_degraded_flag': (
+        'gauge', 'wmo_wis2_gb_dedup_degraded_flag',
+        'Whether de-duplication runs locally because Redis is unavailable'),
+    'dedup_writeback_total': (
+        'counter', 'wmo_wis2_gb_dedup_writeback_total',
+        'Number of locally de-duplicated message ids written back to Redis'),
+    'dedup_won_total': (
+        'counter', 'wmo_wis2_gb_dedup_won_total',
+        'Number of message ids an upstream delivered first'),
+    'dedup_duplicate_total': (
+        'counter', 'wmo_wis2_gb_dedup_duplicate_total',
+        'Number of message ids an upstream delivered after another'),
+    'dedup_duplicate_lag_seconds': (
+        'histogram', 'wmo_wis2_gb_dedup_duplicate_lag_seconds',
+        'Time in seconds from the first arrival of a message id to its '
+        'arrival from an upstream'),
+    'dedup_late_duplicate_total': (
+        'counter', 'wmo_wis2_gb_dedup_late_duplicate_total',
+        'Number of message ids seen before that arrived after the '
+        'de-duplication TTL'),
+    'dedup_ttl_seconds': (
+        'gauge', 'wmo_wis2_gb_dedup_ttl_seconds',
+        'Seconds message ids are remembered in Redis'),
+    'publish_latency_seconds': (
+        'histogram', 'wmo_wis2_gb_publish_latency_seconds',
+        'Time in seconds from publish to Global Broker acknowledgement'),
+    'publish_queue_depth': (
+        'gauge', 'wmo_wis2_gb_publish_queue_depth',
+        'Number of messages waiting for a Global Broker publisher connection'),
+    'publish_connection_total': (
+        'counter', 'wmo_wis2_gb_publish_connection_total',
+        'Number of messages published by a Global Broker publisher '
+        'connection'),
+    'queue_overflow_total': (
+        'counter', 'wmo_wis2_gb_queue_overflow_total',
+        'Number of items put on a full relay queue'),
+    'queue_dropped_total': (
+        'counter', 'wmo_wis2_gb_queue_dropped_total',
+        'Number of items dropped by the overflow policy of a relay queue'),
+    'queue_spilled_total': (
+        'counter', 'wmo_wis2_gb_queue_spilled_total',
+        'Number of items spilled to the overflow buffer of a relay queue'),
+    'queue_high_watermark': (
+        'gauge', 'wmo_wis2_gb_queue_high_watermark',
+        'Highest number of items in a relay queue over the last interval'),
+    'queue_spool_bytes': (
+        'gauge', 'wmo_wis2_gb_queue_spool_bytes',
+        'Number of bytes on disk of the spool of a relay queue'),
+    'queue_lane_latency_seconds': (
+        'histogram', 'wmo_wis2_gb_queue_lane_latency_seconds',
+        'Time in seconds messages of a priority lane wait to be published'),
+    'validate_fallback_total': (
+        'counter', 'wmo_wis2_gb_validate_fallback_total',
+        'Number of messages validated in process as the validation pool '
+        'was full'),
+    'validation_rate': (
+        'gauge', 'wmo_wis2_gb_validation_rate',
+        'Fraction of new messages of a centre validated against the schema '
+        'over the last interval'),
+    'active_version': (
+        'gauge', 'wmo_wis2_gb_active_version',
+        'Whether a version of the topic hierarchy or message schema is in '
+        'use (1) or was replaced (0)'),
+    'check_total': (
+        'counter', 'wmo_wis2_gb_check_total',
+        'Number of messages checked by a check stage'),
+    'check_rejected_total': (
+        'counter', 'wmo_wis2_gb_check_rejected_total',
+        'Number of messages rejected by a check stage'),
+    'check_seconds_total': (
+        'counter', 'wmo_wis2_gb_check_seconds_total',
+        'Time in seconds spent by messages in a check stage')
+}
+
+CONNECTION_METRICS = ['publish_queue_depth', 'publish_connection_total']
+QUEUE_METRICS = ['queue_overflow_total', 'queue_dropped_total',
+                 'queue_spilled_total', 'queue_high_watermark',
+                 'queue_spool_bytes']
+LANE_METRICS = ['queue_lane_latency_seconds']
+VERSION_METRICS = ['active_version']
+STAGE_METRICS = ['check_total', 'check_rejected_total', 'check_seconds_total']
+
+HISTOGRAM_BUCKETS = {
+    'dedup_batch_size': (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000),
+    'dedup_latency_seconds': (.0005, .001, .0025, .005, .01, .025, .05, .1,
+                              .25, .5, 1),
+    'dedup_duplicate_lag_seconds': (.01, .025, .05, .1, .25, .5, 1, 2.5, 5,
+                                    10, 30, 60, 300, 900, 3600),
+    'publish_latency_seconds': (.0005, .001, .0025, .005, .01, .025, .05, .1,
+                                .25, .5, 1, 2.5, 5),
+    'queue_lane_latency_seconds': (.001, .005, .01, .05, .1, .5, 1, 5, 10,
+                                   30, 60)
+}
+
+
+def metric_type(metric_name: str) -> str:
+    """
+    Get the type of a relay metric
+
+    :param metric_name: `str` of metric name
+
+    :returns: `str` of metric type (counter, gauge or histogram)
+    """
+
+    return METRICS.get(metric_name, ('counter',))[0]
+
+
+def metric_labels(metric_name: str) -> list:
+    """
+    Get the label names of a relay metric
+
+    :param metric_name: `str` of metric name
+
+    :returns: `list` of label names
+    """
+
+    if metric_name in CONNECTION_METRICS:
+        return METRIC_CONNECTION_LABELS
+    if metric_name in QUEUE_METRICS:
+        return METRIC_QUEUE_LABELS
+    if metric_name in LANE_METRICS:
+        return METRIC_LANE_LABELS
+    if metric_name in VERSION_METRICS:
+        return METRIC_VERSION_LABELS
+    if metric_name in STAGE_METRICS:
+        return METRIC_STAGE_LABELS
+    return METRIC_LABELS
+
+
+class RelayMetricAggregator(threading.Thread):
+    """Aggregates relay metrics and flushes them as periodic snapshots"""
+
+    def __init__(self, metricq, interval: float = METRICS_INTERVAL,
+                 publish: bool = True) -> None:
+        """
+        Aggregator initializer
+
+        :param metricq: `queue.Queue` of metric messages to publish
+        :param interval: `float` of seconds between snapshots
+        :param publish: `bool` of whether to publish snapshots over MQTT
+
+        :returns: `None`
+        """
+
+        threading.Thread.__init__(self)
+        self.metricq = metricq
+        self.interval = interval
+        self.publish = publish
+        self.snapshots = {}
+        self.prometheus = {}
+        self.collectors = []
+        self.lock = threading.Lock()
+
+    def add_collector(self, collector: Callable[[], None]) -> None:
+        """
+        Register a callable recording metrics before each snapshot
+
+        :param collector: Python callable
+
+        :returns: `None`
+        """
+
+        self.collectors.append(collector)
+
+    def expose(self, port: int) -> None:
+        """
+        Expose metrics for Prometheus on an HTTP /metrics endpoint
+
+        :param port: `int` of HTTP port
+
+        :returns: `None`
+        """
+
+        for metric_name, (type_, name, description) in METRICS.items():
+            labels = metric_labels(metric_name)
+            if type_ == 'counter':
+                metric = Counter(name, description, labels)
+            elif type_ == 'gauge':
+                metric = Gauge(name, description, labels)
+            else:
+                metric = Histogram(name, description, labels,
+                                   buckets=HISTOGRAM_BUCKETS[metric_name])
+            self.prometheus[metric_name] = metric
+
+        LOGGER.info(f'Exposing metrics on port {port}')
+        start_http_server(port)
+
+    def record(self, metric_name: str, labels: list,
+               value: Union[str, int, float] = None) -> None:
+        """
+        Record a metric event
+
+        Counters are incremented by `value` (default 1), gauges are set to
+        `value` and histograms observe `value`.  Snapshots keep histograms
+        as per bucket counts (the last one for values above all buckets)
+        with the sum and count of observations.
+
+        :param metric_name: `str` of metric name
+        :param labels: `list` of metric label values
+        :param value: value of metric event
+
+        :returns: `None`
+        """
+
+        type_ = metric_type(metric_name)
+        if type_ == 'counter' and value is None:
+            value = 1
+
+        metric = self.prometheus.get(metric_name)
+        if metric is not None:
+            if type_ == 'counter':
+                metric.labels(*labels).inc(value)
+            elif type_ == 'gauge':
+                metric.labels(*labels).set(value)
+            else:
+                metric.labels(*labels).observe(value)
+
+        if not self.publish:
+            return
+
+        with self.lock:
+            snapshot = self.snapshots.setdefault(tuple(labels), {})
+            metrics = snapshot.setdefault(f'{type_}s', {})
+
+            if type_ == 'counter':
+                metrics[metric_name] = metrics.get(metric_name, 0) + value
+            elif type_ == 'gauge':
+                metrics[metric_name] = value
+            else:
+                buckets = HISTOGRAM_BUCKETS[metric_name]
+                totals = metrics.get(metric_name)
+                if totals is None:
+                    totals = metrics[metric_name] = {
+                        'buckets': [0] * (len(buckets) + 1),
+                        'sum': 0,
+                        'count': 0
+                    }
+                totals['buckets'][bisect_left(buckets, value)] += 1
+                totals['sum'] += value
+                totals['count'] += 1
+
+    def flush(self) -> None:
+        """
+        Queue one snapshot message per set of labels
+
+        :returns: `None`
+        """
+
+        with self.lock:
+            snapshots, self.snapshots = self.snapshots, {}
+
+        for labels, snapshot in snapshots.items():
+            LOGGER.debug(f'Publishing metrics snapshot {labels}')
+            snapshot['labels'] = list(labels)
+            self.metricq.put((f'{METRICS_TOPIC}/snapshot',
+                              json.dumps(snapshot)))
+
+    def run(self) -> None:
+        while self.publish or self.collectors:
+            time.sleep(self.interval)
+            for collector in self.collectors:
+                collector()
+            if self.publish:
+                self.flush()
@@ -24,7 +24,9 @@ import logging
 import random
 import string
 import ssl
-from typing import Any, Callable
+import threading
+import time
+from typing import Any, Callable, Union
 from urllib.parse import urlparse
 
 from paho.mqtt import client as mqtt_client
@@ -35,11 +37,15 @@ LOGGER = logging.getLogger(__name__)
 
 class MQTTPubSubClient:
     """MQTT PubSub client"""
-    def __init__(self, broker: str, options: dict = {}) -> None:
+    def __init__(self, broker: str, options: dict = {},
+                 publish_window: int = 0) -> None:
         """
         PubSub initializer
 
         :param config: RFC1738 URL of broker
+        :param publish_window: `int` of maximum number of in-flight
+                               messages of publisher mode (see
+                               `start_publisher`), `0` to disable
 
         :returns: `None`
         """
@@ -48,6 +54,8 @@ class MQTTPubSubClient:
         self.broker_url = urlparse(self.broker)
         self.broker_safe_url = util.safe_url(self.broker)
         self.userdata = {}
+        self.publish_window = publish_window
+        self.on_published = None
 
         randstring = ''.join(random.choice(string.hexdigits) for i in range(6))
         self.type = 'mqtt'
@@ -70,6 +78,12 @@ class MQTTPubSubClient:
                                        userdata=self.userdata, transport=transport)
         self.conn.enable_logger(logger=LOGGER)
 
+        if self.publish_window:
+            # the window is enforced by pub_async; paho rescans its queue
+            # on each acknowledgement when limiting in-flight messages.
+            # Can only be set before connecting
+            self.conn.max_inflight_messages_set(0)
+
         if self.broker_url.scheme in ['ws', 'wss']:
             LOGGER.debug('Setting Websockets path: {self.broker_url.path}')
             self.conn.ws_set_options(self.broker_url.path)
@@ -123,21 +137,114 @@ class MQTTPubSubClient:
 
         LOGGER.debug('Connected to broker')
 
-    def pub(self, topic: str, message: str, qos: int = 1) -> bool:
+    def start_publisher(self,
+                        on_published: Callable[[float], Any] = None) -> None:
+        """
+        Run the network loop in the background and publish asynchronously
+
+        At most `publish_window` messages are in flight, further publishes
+        block until a PUBACK (QoS 1/2) or write (QoS 0) completes one of
+        them.
+
+        :param on_published: optional callable receiving the publish
+                             latency in seconds of each completed message
+
+        :returns: `None`
+        """
+
+        self.on_published = on_published
+        self.window = threading.BoundedSemaphore(self.publish_window)
+        self.inflight = {}
+        self.acked = {}
+        self.inflight_lock = threading.Lock()
+
+        self.conn.on_publish = self._on_publish
+        self.conn.loop_start()
+
+    def _on_publish(self, client, userdata, mid, reason_code, properties):
+        now = time.monotonic()
+
+        # the broker may acknowledge before pub_async registered the mid
+        with self.inflight_lock:
+            start = self.inflight.pop(mid, None)
+            if start is None:
+                self.acked[mid] = now
+
+        self.window.release()
+
+        if reason_code.is_failure:
+            LOGGER.warning(f'Publish {mid} rejected by {self.broker_safe_url}: {reason_code}')  # noqa
+        if start is not None:
+            self._published(now - start)
+
+    def _published(self, latency: float) -> None:
+        if self.on_published is not None:
+            self.on_published(latency)
+
+    def pub_async(self, topic: str, message: Union[bytes, str],
+                  qos: int = 1) -> mqtt_client.MQTTMessageInfo:
+        """
+        Publish a message without waiting for its acknowledgement
+
+        Requires `start_publisher`.  Blocks while the in-flight window
+        is full.
+
+        :param topic: `str` of topic
+        :param message: `str` or `bytes` of message
+        :param qos: `int` of quality of service (0, 1, 2)
+
+        :returns: `paho.mqtt.client.MQTTMessageInfo` of the message,
+                  `wait_for_publish()` and `is_published()` report its
+                  completion
+        """
+
+        self.window.acquire()
+        start = time.monotonic()
+
+        try:
+            result = self.conn.publish(topic, message, qos)
+        except Exception:
+            self.window.release()
+            raise
+
+        if qos == 0 and result.rc != mqtt_client.MQTT_ERR_SUCCESS:
+            # QoS 0 messages are not queued while disconnected
+            self.window.release()
+            LOGGER.warning(f'Publishing error code: {result.rc}')
+            return result
+
+        with self.inflight_lock:
+            acked = self.acked.pop(result.mid, None)
+            if acked is None:
+                self.inflight[result.mid] = start
+
+        if acked is not None:
+            self._published(acked - start)
+
+        return result
+
+    def pub(self, topic: str, message: Union[bytes, str],
+            qos: int = 1) -> bool:
         """
         Publish a message to a broker/topic
 
         :param topic: `str` of topic
-        :param message: `str` of message
+        :param message: `str` or `bytes` of message
 
         :returns: `bool` of publish result
         """
 
-        self.conn.loop()
         LOGGER.debug(f'Publishing to broker {self.broker_safe_url}')
         LOGGER.debug(f'Topic: {topic}')
         LOGGER.debug(f'Message: {message}')
 
+        if self.publish_window:
+            result = self.pub_async(topic, message, qos)
+            # QoS 1/2 messages are queued by paho until acknowledged
+            return (result.rc == mqtt_client.MQTT_ERR_SUCCESS or
+                    (qos > 0 and result.rc == mqtt_client.MQTT_ERR_NO_CONN))
+
+        self.conn.loop()
         result = self.conn.publish(topic, message, qos)
 
         # TODO: investigate implication
@@ -184,6 +291,8 @@ class MQTTPubSubClient:
         """
 
         self.conn.disconnect()
+        if self.publish_window:
+            self.conn.loop_stop()
 
     def bind(self, event: str, function: Callable[..., Any]) -> None:
         """
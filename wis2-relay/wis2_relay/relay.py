@@ -1,28 +1,84 @@
-import queue
 import logging
+from pathlib import Path
+import signal
 
 import click
+from redis.cluster import RedisCluster as Redis
 
 from wis2_relay import cli_options
 from wis2_relay import util
+from wis2_relay.bloom import BLOOM_ERROR_RATE
+from wis2_relay.checks import CHECK_PIPELINE, MESSAGE_SIZE_LIMIT
+from wis2_relay.dedup import (DEDUP_BATCH_SIZE, DEDUP_BUCKET_SECONDS,
+                              DEDUP_CACHE_SIZE, DEDUP_CACHE_TTL,
+                              DEDUP_EXPECTED_RATE, DEDUP_LAYOUT, DEDUP_SHARDS,
+                              DEDUP_TTL, DEDUP_TTL_MARGIN, DEDUP_TTL_MIN,
+                              DEDUP_TTL_PERCENTILE, DEDUP_WINDOW,
+                              create_adaptive_ttl, create_fallback,
+                              DedupCache)
+from wis2_relay.metrics import METRICS_INTERVAL, RelayMetricAggregator
+from wis2_relay.relay_async import ENGINE_WORKERS, run_engine
 from wis2_relay.relay_metric import RelayMetric
-from wis2_relay.relay_message import RelayMessage
+from wis2_relay.relay_queue import (LANE_WEIGHTS, QUEUE_POLICY, QUEUE_SIZE,
+                                    QUEUE_SPILL_SIZE, QUEUE_TIMEOUT,
+                                    LaneQueue, RelayQueue, SpoolSync)
+from wis2_relay.relay_message import (PUBLISH_CONNECTIONS, PUBLISH_SHARD_BY,
+                                      RelayMessagePool)
 from wis2_relay.relay_sub import RelaySub
+from wis2_relay.reload import RELOAD_INTERVAL, Reloadable, Reloader
+from wis2_relay.spool import (SPOOL_FSYNC, SPOOL_FSYNC_INTERVAL,
+                              SPOOL_MAX_BYTES, SPOOL_SEGMENT_SIZE, DiskQueue)
+from wis2_relay.topic import WIS2TopicHierarchy
+from wis2_relay.verify import (VALIDATE_BATCH_SIZE, VALIDATE_MAX_PENDING,
+                               VALIDATE_SAMPLE_COOLDOWN, VALIDATE_SAMPLE_RATE,
+                               VALIDATE_WINDOW, VALIDATE_WORKERS,
+                               ValidationPool, ValidationSampler, WNMValidate)
 from wis2_relay import env
 
-BUF_SIZE = 10000
-
 LOGGER = logging.getLogger(__name__)
 
-mesgq = queue.Queue(BUF_SIZE)
-metricq = queue.Queue(BUF_SIZE)
+
+def get_upstreams(config: dict) -> list:
+    """
+    Derive upstream subscriptions from configuration
+
+    Falls back to the single upstream defined by the SUB_* environment
+    variables when no `upstreams` are configured.
+
+    :param config: `dict` of relay configuration
+
+    :returns: `list` of `dict` of upstream url, topics and centre_id
+    """
+
+    upstreams = []
+
+    for upstream in config.get('upstreams') or []:
+        topics = upstream['topics']
+        if isinstance(topics, str):
+            topics = topics.split()
+        upstreams.append({
+            'url': upstream['url'],
+            'topics': topics,
+            'centre_id': upstream['centre_id']
+        })
+
+    if not upstreams:
+        upstreams.append({
+            'url': env.SUB_BROKER_URL,
+            'topics': env.SUB_TOPICS.split(),
+            'centre_id': env.SUB_CENTRE_ID
+        })
+
+    return upstreams
 
 
 @click.command()
 @click.pass_context
 @cli_options.OPTION_CONFIG
 @cli_options.OPTION_VERBOSITY
-def relay(ctx, config, verbosity='NOTSET'):
+@click.option('--engine', type=click.Choice(['threads', 'asyncio']),
+              default='threads', help='Relay engine')
+def relay(ctx, config, verbosity='NOTSET', engine='threads'):
     """Subscribe to a broker/topic, relay to another broker/topic"""
 
     if config is None:
@@ -30,8 +86,7 @@ def relay(ctx, config, verbosity='NOTSET'):
     config = util.yaml_load(config)
 
     pubbroker = env.WIS2_GB_BROKER_URL
-    subbroker = env.SUB_BROKER_URL
-    subscribe_topics = env.SUB_TOPICS.split()
+    upstreams = get_upstreams(config)
 
     options = {
         'verify_certs': config.get('verify_certs', True),
@@ -47,18 +102,213 @@ def relay(ctx, config, verbosity='NOTSET'):
     options['verify_data'] = env.VERIFY_DATA
     options['verify_topic'] = env.VERIFY_TOPIC
     options['verify_metadata'] = env.VERIFY_METADATA
-    options['verify_cenre_id'] = env.VERIFY_CENTRE_ID
+    options['verify_centre_id'] = env.VERIFY_CENTRE_ID
     options['clean_session'] = config.get('clean_session', True)
+    options['dedup_ttl'] = int(config.get('dedup_ttl', DEDUP_TTL))
+    options['dedup_ttl_adaptive'] = config.get('dedup_ttl_adaptive', False)
+    options['dedup_ttl_min'] = int(config.get('dedup_ttl_min', DEDUP_TTL_MIN))
+    options['dedup_ttl_percentile'] = float(config.get(
+        'dedup_ttl_percentile', DEDUP_TTL_PERCENTILE))
+    options['dedup_ttl_margin'] = float(config.get('dedup_ttl_margin',
+                                                   DEDUP_TTL_MARGIN))
+    options['dedup_window'] = float(config.get('dedup_window', DEDUP_WINDOW))
+    options['dedup_batch_size'] = int(config.get('dedup_batch_size',
+                                                 DEDUP_BATCH_SIZE))
+    options['dedup_cache_ttl'] = float(config.get('dedup_cache_ttl',
+                                                  DEDUP_CACHE_TTL))
+    options['dedup_cache_size'] = int(config.get('dedup_cache_size',
+                                                 DEDUP_CACHE_SIZE))
+    options['dedup_fallback'] = config.get('dedup_fallback', True)
+    options['dedup_expected_rate'] = float(config.get(
+        'dedup_expected_rate', DEDUP_EXPECTED_RATE))
+    options['dedup_fallback_error_rate'] = float(config.get(
+        'dedup_fallback_error_rate', BLOOM_ERROR_RATE))
+    options['dedup_layout'] = config.get('dedup_layout', DEDUP_LAYOUT)
+    options['dedup_bucket_seconds'] = int(config.get('dedup_bucket_seconds',
+                                                     DEDUP_BUCKET_SECONDS))
+    options['dedup_shards'] = int(config.get('dedup_shards', DEDUP_SHARDS))
+    options['dedup_accounting'] = config.get('dedup_accounting', False)
+    options['metrics_interval'] = float(config.get('metrics_interval',
+                                                   METRICS_INTERVAL))
+    options['metrics_mqtt'] = config.get('metrics_mqtt', True)
+    options['metrics_port'] = config.get('metrics_port')
+    options['publish_window'] = int(config.get('publish_window', 0))
+    options['publish_connections'] = int(config.get('publish_connections',
+                                                    PUBLISH_CONNECTIONS))
+    options['publish_shard_by'] = config.get('publish_shard_by',
+                                             PUBLISH_SHARD_BY)
+    options['queue_size'] = int(config.get('queue_size', QUEUE_SIZE))
+    options['queue_policy'] = config.get('queue_policy', QUEUE_POLICY)
+    options['queue_timeout'] = float(config.get('queue_timeout',
+                                                QUEUE_TIMEOUT))
+    options['queue_spill_size'] = int(config.get('queue_spill_size',
+                                                 QUEUE_SPILL_SIZE))
+    options['spool_path'] = config.get('spool_path')
+    options['spool_segment_size'] = int(config.get('spool_segment_size',
+                                                   SPOOL_SEGMENT_SIZE))
+    options['spool_max_bytes'] = int(config.get('spool_max_bytes',
+                                                SPOOL_MAX_BYTES))
+    options['spool_fsync'] = config.get('spool_fsync', SPOOL_FSYNC)
+    options['spool_fsync_interval'] = float(config.get(
+        'spool_fsync_interval', SPOOL_FSYNC_INTERVAL))
+    options['validate_workers'] = int(config.get('validate_workers',
+                                                 VALIDATE_WORKERS))
+    options['validate_batch_size'] = int(config.get('validate_batch_size',
+                                                    VALIDATE_BATCH_SIZE))
+    options['validate_window'] = float(config.get('validate_window',
+                                                  VALIDATE_WINDOW))
+    options['validate_max_pending'] = int(config.get(
+        'validate_max_pending', VALIDATE_MAX_PENDING))
+    options['validate_sample_rate'] = float(config.get(
+        'validate_sample_rate', VALIDATE_SAMPLE_RATE))
+    options['validate_sample_cooldown'] = float(config.get(
+        'validate_sample_cooldown', VALIDATE_SAMPLE_COOLDOWN))
+    options['reload_interval'] = float(config.get('reload_interval',
+                                                  RELOAD_INTERVAL))
+    options['check_pipeline'] = config.get('check_pipeline', CHECK_PIPELINE)
+    options['max_message_size'] = int(config.get('max_message_size',
+                                                 MESSAGE_SIZE_LIMIT))
+
+    options['priority'] = config.get('priority')
+    if options['priority'] is True:
+        options['priority'] = LANE_WEIGHTS
+
+    if options['spool_path'] and options['queue_policy'] != 'spill':
+        raise click.ClickException('spool_path requires queue_policy: spill')
+
+    if options['dedup_layout'] not in ['key', 'bucket']:
+        raise click.ClickException(
+            f"Unknown dedup_layout: {options['dedup_layout']}")
+
+    if options['dedup_ttl_min'] > options['dedup_ttl']:
+        raise click.ClickException('dedup_ttl_min exceeds dedup_ttl')
+
+    unknown = set(options['check_pipeline']) - set(CHECK_PIPELINE)
+    if unknown:
+        raise click.ClickException(f'Unknown check_pipeline stages: {unknown}')  # noqa
+
+    if len(upstreams) > 1:
+        # egress connections are shared, identify them as the Global Broker
+        options['centre_id'] = options['gb_centre_id']
+
+    if engine == 'asyncio':
+        options['engine_workers'] = int(config.get('engine_workers',
+                                                   ENGINE_WORKERS))
+        run_engine(upstreams, pubbroker, options)
+        return
+
+    try:
+        LOGGER.info(f"Connecting to Redis Cluster {options['redis_server']}")
+        redis = Redis(host=options['redis_server'], port=6379)
+    except Exception as err:
+        msg = f"Redis connect failed: {err} Redis Server Config: {options['redis_server']}"  # noqa
+        LOGGER.error(msg, exc_info=True)
+        raise click.ClickException(msg)
+
+    wnm_topic = Reloadable(WIS2TopicHierarchy())
+    wnm_schema = Reloadable(WNMValidate())
+    dedup_fallback = None
+    if options['dedup_fallback']:
+        dedup_fallback = create_fallback(options)
+    validation_pool = None
+    if options['validate_message'] and options['validate_workers'] > 0:
+        validation_pool = ValidationPool(options['validate_workers'],
+                                         options['validate_batch_size'],
+                                         options['validate_window'],
+                                         options['validate_max_pending'])
+    labels = [options['centre_id'], options['gb_centre_id']]
+
+    def create_queue(name, metrics, spool=None, priority=None):
+        args = (options['queue_size'], options['queue_policy'],
+                options['queue_timeout'], options['queue_spill_size'],
+                spool, metrics, labels + [name])
+        if priority:
+            return LaneQueue(*args, weights=priority)
+        return RelayQueue(*args)
+
+    def create_spool(name, priority=None):
+        if not options['spool_path']:
+            return None
+        if priority:
+            # one spool per lane, spooled items keep their priority
+            return {lane: create_spool(f'{name}/{lane}')
+                    for lane in LANE_WEIGHTS}
+        return DiskQueue(Path(options['spool_path']) / name,
+                         options['spool_segment_size'],
+                         options['spool_max_bytes'], options['spool_fsync'],
+                         options['spool_fsync_interval'])
+
+    try:
+        metrics = RelayMetricAggregator(None, options['metrics_interval'],
+                                        options['metrics_mqtt'])
+
+        mesgqs = [create_queue(f'publish-{i}', metrics,
+                               create_spool(f'publish-{i}',
+                                            options['priority']),
+                               options['priority'])
+                  for i in range(options['publish_connections'])]
+        publisher = RelayMessagePool(pubbroker, options, mesgqs,
+                                     metrics=metrics)
+
+        if options['priority']:
+            # metrics are deferred in the metrics lane of the publishers
+            metricq = publisher
+        else:
+            metricq = create_queue('metrics', metrics)
+        metrics.metricq = metricq
+    except ValueError as err:
+        raise click.ClickException(str(err))
+
+    if options['metrics_port'] is not None:
+        metrics.expose(int(options['metrics_port']))
+
+    sampler = None
+    if options['validate_message'] and options['validate_sample_rate'] < 1:
+        sampler = ValidationSampler(options['validate_sample_rate'],
+                                    options['validate_sample_cooldown'],
+                                    metrics, options['gb_centre_id'])
+
+    adaptive_ttl = create_adaptive_ttl(options, metrics, labels)
+    dedup_cache = DedupCache(options['dedup_cache_ttl'],
+                             options['dedup_cache_size'], adaptive_ttl)
+
+    sub_threads = []
+    for upstream in upstreams:
+        sub_options = options.copy()
+        sub_options['centre_id'] = upstream['centre_id']
+        sub_threads.append(RelaySub(upstream['url'], upstream['topics'],
+                                    sub_options, publisher, metricq,
+                                    priority=options['priority'],
+                                    redis=redis,
+                                    wnm_topic=wnm_topic,
+                                    wnm_schema=wnm_schema,
+                                    dedup_cache=dedup_cache,
+                                    dedup_fallback=dedup_fallback,
+                                    metrics=metrics,
+                                    validation_pool=validation_pool,
+                                    sampler=sampler,
+                                    adaptive_ttl=adaptive_ttl))
+
+    reloader = Reloader(wnm_topic, wnm_schema, options['reload_interval'],
+                        validation_pool, metrics, labels)
+    signal.signal(signal.SIGHUP, reloader.request)
+
+    threads = [publisher, metrics, reloader]
+    if validation_pool is not None:
+        threads.append(validation_pool)
+    if options['spool_path'] and options['spool_fsync_interval'] > 0:
+        threads.append(SpoolSync(mesgqs, options['spool_fsync_interval']))
 
-    sub_thread = RelaySub(subbroker, subscribe_topics, options,
-                          mesgq, metricq, priority=None)
-    mesg_thread = RelayMessage(pubbroker, options, mesgq, priority=None)
-    metric_thread = RelayMetric(pubbroker, options, metricq, priority=None)
+    if options['metrics_mqtt'] and not options['priority']:
+        threads.append(RelayMetric(pubbroker, options, metricq,
+                                   priority=None))
 
-    mesg_thread.start()
-    metric_thread.start()
-    sub_thread.start()
+    for thread in threads:
+        thread.start()
+    for sub_thread in sub_threads:
+        sub_thread.start()
 
-    mesg_thread.join()
-    metric_thread.join()
-    sub_thread.join()
+    for thread in threads:
+        thread.join()
+    for sub_thread in sub_threads:
+        sub_thread.join()
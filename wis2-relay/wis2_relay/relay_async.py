@@ -0,0 +1,650 @@
+###############################################################################
+#
+# Licensed to the Apache Software Foundation (ASF) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The ASF licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+#
+###############################################################################
+
+
+import asyncio
+from collections import deque
+import logging
+import multiprocessing
+import os
+import signal
+import time
+from typing import Any, Callable, Optional
+
+from paho.mqtt import client as mqtt_client
+from redis.asyncio.cluster import RedisCluster as AsyncRedis
+from redis.exceptions import NoScriptError
+
+from wis2_relay.checks import CheckedMessage, MessageChecks
+from wis2_relay.dedup import (BatchDedup, FIRST_RECONNECT_DELAY,
+                              MAX_RECONNECT_DELAY, RECONNECT_RATE,
+                              create_adaptive_ttl, create_fallback,
+                              DedupCache, DedupCheck)
+from wis2_relay.metrics import RelayMetricAggregator
+from wis2_relay.mqtt import MQTTPubSubClient
+from wis2_relay.relay_message import (PUBLISH_SHARD_BY, PUBLISH_STATS_INTERVAL,
+                                      shard_index)
+from wis2_relay.relay_queue import QUEUE_SIZE
+from wis2_relay.reload import RELOAD_INTERVAL, Reloadable, Reloader
+from wis2_relay.topic import WIS2TopicHierarchy
+from wis2_relay.verify import (ValidationPool, ValidationSampler,
+                               ValidationSequence, WNMValidate)
+
+LOGGER = logging.getLogger(__name__)
+
+ENGINE_WORKERS = 1
+# in-flight window of the asyncio publishers when publish_window is 0
+ASYNC_PUBLISH_WINDOW = 1000
+
+
+class AsyncioMQTTClient:
+    """Drives the network loop of a MQTTPubSubClient from an asyncio loop"""
+
+    def __init__(self, client: MQTTPubSubClient,
+                 loop: asyncio.AbstractEventLoop) -> None:
+        """
+        Asyncio MQTT client initializer
+
+        Registers the socket of the (connected) client with the event loop,
+        runs its keepalive and reconnects it with exponential backoff.
+
+        :param client: `MQTTPubSubClient` of connection
+        :param loop: `asyncio.AbstractEventLoop` of event loop
+
+        :returns: `None`
+        """
+
+        self.client = client
+        self.conn = client.conn
+        self.loop = loop
+
+        self.conn.on_socket_open = self.on_socket_open
+        self.conn.on_socket_close = self.on_socket_close
+        self.conn.on_socket_register_write = self.on_socket_register_write
+        self.conn.on_socket_unregister_write = \
+            self.on_socket_unregister_write
+
+        # the client connected before the callbacks were set
+        sock = self.conn.socket()
+        if sock is not None:
+            self.on_socket_open(self.conn, None, sock)
+            if self.conn.want_write():
+                self.on_socket_register_write(self.conn, None, sock)
+
+        self.misc = loop.create_task(self.misc_loop())
+
+    def on_socket_open(self, client, userdata, sock):
+        self.loop.add_reader(sock, client.loop_read)
+
+    def on_socket_close(self, client, userdata, sock):
+        self.loop.remove_reader(sock)
+        self.loop.remove_writer(sock)
+
+    def on_socket_register_write(self, client, userdata, sock):
+        self.loop.add_writer(sock, client.loop_write)
+
+    def on_socket_unregister_write(self, client, userdata, sock):
+        self.loop.remove_writer(sock)
+
+    async def misc_loop(self) -> None:
+        reconnect_delay = FIRST_RECONNECT_DELAY
+
+        while True:
+            await asyncio.sleep(1)
+            if self.conn.loop_misc() == mqtt_client.MQTT_ERR_SUCCESS:
+                reconnect_delay = FIRST_RECONNECT_DELAY
+                continue
+
+            LOGGER.info(f'Reconnecting to {self.client.broker_safe_url} in {reconnect_delay} seconds')  # noqa
+            await asyncio.sleep(reconnect_delay)
+            try:
+                self.conn.reconnect()
+            except Exception as err:
+                LOGGER.error(f'Reconnect failed: {err}. Retrying...')
+                reconnect_delay = min(reconnect_delay * RECONNECT_RATE,
+                                      MAX_RECONNECT_DELAY)
+
+
+class AsyncRedisDedup(BatchDedup):
+    """asyncio variant of RedisDedup, with the same batching, local
+    fallback and write-back, on a `redis.asyncio` cluster client"""
+
+    def __init__(self, redis, options: dict, process_metric=None,
+                 fallback=None, adaptive_ttl=None) -> None:
+        BatchDedup.__init__(self, redis, options, process_metric, fallback,
+                            adaptive_ttl)
+        self.queue = asyncio.Queue()
+
+    def submit(self, mesg_id: str, value: str,
+               upstream: str = None) -> asyncio.Future:
+        """
+        Queue a message id for de-duplication
+
+        :param mesg_id: `str` of message id
+        :param value: `str` of value to store with the id
+        :param upstream: `str` of centre identifier of the upstream the id
+                         came from (see `RedisDedup.submit`)
+
+        :returns: `asyncio.Future` of the verdict (see `RedisDedup.submit`),
+                  futures are resolved in submission order
+        """
+
+        future = asyncio.get_running_loop().create_future()
+        self.queue.put_nowait((mesg_id, self.value(value, upstream), future))
+        return future
+
+    async def next_batch(self) -> list:
+        batch = [await self.queue.get()]
+
+        if self.queue.qsize() < self.batch_size - 1:
+            await asyncio.sleep(self.window)
+
+        while len(batch) < self.batch_size and not self.queue.empty():
+            batch.append(self.queue.get_nowait())
+
+        return batch
+
+    async def pipeline_set_nx(self, items: list) -> list:
+        verdicts = await self.execute_layout(items)
+
+        retry = [i for i, verdict in enumerate(verdicts)
+                 if isinstance(verdict, NoScriptError)]
+        if retry:
+            LOGGER.info('Loading de-duplication script')
+            try:
+                await self.redis.script_load(self.layout.script)
+            except Exception as err:
+                LOGGER.error(f'Redis script load failed: {err}')
+                return verdicts
+
+            for i, verdict in zip(retry, await self.execute_layout(
+                    [items[i] for i in retry])):
+                verdicts[i] = verdict
+
+        return verdicts
+
+    async def execute_layout(self, items: list) -> list:
+        pipe = self.redis.pipeline()
+        commands = self.layout.queue(pipe, items, self.redis.keyslot)
+
+        try:
+            replies = await pipe.execute(raise_on_error=False)
+        except Exception as err:
+            replies = [err] * len(commands)
+
+        return self.layout.verdicts(items, commands, replies)
+
+    async def set_nx(self, items: list) -> list:
+        if self.degraded and not await self.reconnect():
+            return [self.set_nx_local(mesg_id, value)
+                    for mesg_id, value in items]
+
+        self.update_ttl()
+        start = time.monotonic()
+        verdicts = await self.pipeline_set_nx(
+            [(mesg_id, value, self.ttl) for mesg_id, value in items])
+
+        return self.check_verdicts(items, verdicts, time.monotonic() - start)
+
+    async def reconnect(self) -> bool:
+        if time.monotonic() < self.reconnect_at:
+            return False
+
+        try:
+            await self.redis.ping()
+            await self.write_back()
+        except Exception as err:
+            self.reconnect_failed(err)
+            return False
+
+        self.set_degraded(False)
+        return True
+
+    async def write_back(self) -> None:
+        written = 0
+
+        while self.pending:
+            batch, now = self.write_back_batch()
+            if not batch:
+                continue
+
+            self.check_write_back(batch, await self.pipeline_set_nx(batch),
+                                  now)
+            written += len(batch)
+
+        self.wrote_back(written)
+
+    async def run_async(self) -> None:
+        while True:
+            batch = await self.next_batch()
+            try:
+                verdicts = await self.set_nx([item[:2] for item in batch])
+            except Exception as err:
+                verdicts = self.batch_failed(batch, err)
+
+            for (_, _, future), verdict in zip(batch, verdicts):
+                if not future.done():
+                    future.set_result(verdict)
+
+
+class AsyncPublisher:
+    """Global Broker publisher connection on an asyncio event loop"""
+
+    def __init__(self, broker: str, options: dict,
+                 loop: asyncio.AbstractEventLoop,
+                 metrics: RelayMetricAggregator, connection: int = 0) -> None:
+        """
+        Asyncio publisher initializer
+
+        Up to `publish_window` messages are in flight, further messages
+        wait in a backlog of up to `queue_size` messages, beyond which
+        they are dropped.
+
+        :param broker: RFC1738 URL of broker
+        :param options: `dict` of relay options
+        :param loop: `asyncio.AbstractEventLoop` of event loop
+        :param metrics: `RelayMetricAggregator` of relay metrics
+        :param connection: `int` of connection index
+
+        :returns: `None`
+        """
+
+        self.qos = options['qos']
+        self.window = options.get('publish_window') or ASYNC_PUBLISH_WINDOW
+        self.queue_size = options.get('queue_size', QUEUE_SIZE)
+        self.loop = loop
+        self.metrics = metrics
+        self.labels = [options['centre_id'], options['gb_centre_id']]
+        self.connection_labels = self.labels + [str(connection)]
+        self.queue_labels = self.labels + [f'publish-{connection}']
+
+        self.backlog = deque()
+        self.inflight = {}
+        self.acked = {}
+        self.inflight_count = 0
+        self.published = 0
+        self.draining = False
+
+        self.client = MQTTPubSubClient(broker, options, self.window)
+        self.client.bind('on_publish', self.on_publish)
+        self.helper = AsyncioMQTTClient(self.client, loop)
+        self.stats = loop.create_task(self.stats_loop())
+
+    def publish(self, topic: str, payload) -> None:
+        """
+        Publish a message, or add it to the backlog while the window
+        is full
+
+        :param topic: `str` of topic
+        :param payload: `bytes` or `str` of message
+
+        :returns: `None`
+        """
+
+        if self.backlog or self.inflight_count >= self.window:
+            if len(self.backlog) >= self.queue_size:
+                self.metrics.record('queue_dropped_total',
+                                    self.queue_labels)
+                return
+            self.backlog.append((topic, payload))
+            return
+
+        self.send(topic, payload)
+
+    def send(self, topic: str, payload) -> None:
+        start = time.monotonic()
+        self.inflight_count += 1
+        result = self.client.conn.publish(topic, payload, self.qos)
+
+        if self.qos == 0 and result.rc != mqtt_client.MQTT_ERR_SUCCESS:
+            # QoS 0 messages are not queued while disconnected
+            self.inflight_count -= 1
+            LOGGER.warning(f'Publishing error code: {result.rc}')
+            return
+
+        self.published += 1
+        acked = self.acked.pop(result.mid, None)
+        if acked is None:
+            self.inflight[result.mid] = start
+        else:
+            self.record_latency(acked - start)
+
+    def on_publish(self, client, userdata, mid, reason_code, properties):
+        now = time.monotonic()
+        self.inflight_count -= 1
+
+        # may be called from within publish, before its mid is known
+        start = self.inflight.pop(mid, None)
+        if start is None:
+            self.acked[mid] = now
+        else:
+            self.record_latency(now - start)
+
+        if reason_code.is_failure:
+            LOGGER.warning(f'Publish {mid} rejected: {reason_code}')
+
+        if self.backlog and not self.draining:
+            self.draining = True
+            self.loop.call_soon(self.drain)
+
+    def drain(self) -> None:
+        self.draining = False
+        while self.backlog and self.inflight_count < self.window:
+            self.send(*self.backlog.popleft())
+
+    def record_latency(self, latency: float) -> None:
+        self.metrics.record('publish_latency_seconds', self.labels, latency)
+
+    async def stats_loop(self) -> None:
+        while True:
+            await asyncio.sleep(PUBLISH_STATS_INTERVAL)
+            self.metrics.record('publish_queue_depth', self.connection_labels,
+                                len(self.backlog))
+            if self.published:
+                self.metrics.record('publish_connection_total',
+                                    self.connection_labels, self.published)
+                self.published = 0
+
+
+class AsyncPublisherPool:
+    """Pool of asyncio Global Broker publishers, sharded as
+    RelayMessagePool"""
+
+    def __init__(self, broker: str, options: dict,
+                 loop: asyncio.AbstractEventLoop,
+                 metrics: RelayMetricAggregator) -> None:
+        self.loop = loop
+        self.shard_by = options.get('publish_shard_by', PUBLISH_SHARD_BY)
+        self.publishers = [
+            AsyncPublisher(broker, options, loop, metrics, connection)
+            for connection in range(options.get('publish_connections', 1))]
+
+    def publish(self, topic: str, payload) -> None:
+        index = shard_index(topic, self.shard_by, len(self.publishers))
+        self.publishers[index].publish(topic, payload)
+
+    def put(self, item, block=True, timeout=None) -> None:
+        """
+        Publish a (topic, payload) message from another thread
+
+        :param item: `tuple` of topic and payload
+
+        :returns: `None`
+        """
+
+        self.loop.call_soon_threadsafe(self.publish, *item)
+
+
+class AsyncDedupCheck(DedupCheck):
+    """De-duplication stage of an upstream on an asyncio event loop, with
+    up to `queue_size` message ids of the engine awaiting their verdict"""
+
+    def __init__(self, engine, upstream: str, labels: list,
+                 process_metric: Callable[..., None]) -> None:
+        DedupCheck.__init__(self, engine.dedup, engine.dedup_cache,
+                            upstream, process_metric)
+        self.engine = engine
+        self.labels = labels
+
+    def submit(self, checked, mesg_id: str) -> Optional[bool]:
+        engine = self.engine
+        if engine.pending >= engine.queue_size:
+            engine.metrics.record('queue_dropped_total',
+                                  self.labels + ['dedup'])
+            return False
+
+        engine.pending += 1
+        future = self.dedup.submit(mesg_id, checked.centre_id, self.upstream)
+        future.add_done_callback(
+            lambda future: self.verdict(checked, future.result()))
+        return None
+
+    def verdict(self, checked, verdict: Any) -> None:
+        self.engine.pending -= 1
+        DedupCheck.verdict(self, checked, verdict)
+
+
+class AsyncRelaySub:
+    """Upstream subscription on an asyncio event loop"""
+
+    def __init__(self, broker: str, topics: list, options: dict,
+                 engine) -> None:
+        """
+        Asyncio subscriber initializer
+
+        Messages are checked by the same stages as `RelaySub`.
+
+        :param broker: RFC1738 URL of broker
+        :param topics: `list` of topics
+        :param options: `dict` of relay options
+        :param engine: `AsyncRelay` of shared engine state
+
+        :returns: `None`
+        """
+
+        self.topics = topics
+        self.qos = options['qos']
+        self.engine = engine
+        self.centre_id = options['centre_id']
+        self.labels = [options['centre_id'], options['gb_centre_id']]
+
+        self.client = MQTTPubSubClient(broker, options)
+        self.client.bind('on_connect', self.on_connect)
+        self.client.bind('on_disconnect', self.on_disconnect)
+        self.client.bind('on_message', self.on_message)
+        self.helper = AsyncioMQTTClient(self.client, engine.loop)
+        LOGGER.info(f'Connected to broker {self.client.broker_safe_url}')
+
+        validation = None
+        if engine.validation_pool is not None:
+            validation = ValidationSequence(
+                engine.validation_pool, engine.wnm_schema, self.process_mesg,
+                self.process_metric, engine.loop.call_soon_threadsafe,
+                engine.sampler)
+
+        checks = MessageChecks(options, engine.wnm_topic, engine.wnm_schema,
+                               self.process_metric, self.process_mesg,
+                               validation, engine.sampler)
+        dedup_check = AsyncDedupCheck(engine, self.centre_id, self.labels,
+                                      self.process_metric)
+        self.pipeline = checks.create_pipeline(dedup_check.check,
+                                               engine.metrics, self.labels)
+
+    def process_metric(self, metric_name: str, value=None) -> None:
+        self.engine.metrics.record(metric_name, self.labels, value)
+
+    def process_mesg(self, topic: str, payload: bytes) -> None:
+        LOGGER.debug(f"Publishing message: {topic}")
+        self.process_metric("published_total")
+        self.process_metric("last_message_timestamp", round(time.time()))
+        self.engine.publisher.publish(topic, payload)
+
+    def on_connect(self, client, userdata, flags, reason_code, properties):
+        LOGGER.debug(f'Subscribing to topics {self.topics}')
+        for topic in self.topics:
+            client.subscribe(topic, qos=self.qos)
+        self.process_metric('connected_flag', True)
+
+    def on_disconnect(self, client, userdata, flags, reason_code,
+                      properties):
+        LOGGER.info(f'Disconnected from {self.client.broker_safe_url}: ({reason_code})')  # noqa
+        self.process_metric('connected_flag', False)
+
+    def on_message(self, client, userdata, msg):
+        LOGGER.debug(f'Topic: {msg.topic}')
+        self.pipeline.check(CheckedMessage(msg.topic, msg.payload))
+
+
+class AsyncRelay:
+    """Relay engine running subscriptions, de-duplication, validation and
+    publishing as callbacks and coroutines on one asyncio event loop"""
+
+    def __init__(self, upstreams: list, pubbroker: str,
+                 options: dict) -> None:
+        """
+        Asyncio relay initializer
+
+        :param upstreams: `list` of `dict` of upstream url, topics and
+                          centre_id
+        :param pubbroker: RFC1738 URL of Global Broker
+        :param options: `dict` of relay options
+
+        :returns: `None`
+        """
+
+        self.upstreams = upstreams
+        self.pubbroker = pubbroker
+        self.options = options
+        self.queue_size = options.get('queue_size', QUEUE_SIZE)
+        self.pending = 0
+
+    async def run(self) -> None:
+        options = self.options
+        self.loop = asyncio.get_running_loop()
+
+        LOGGER.info(f"Connecting to Redis Cluster {options['redis_server']}")
+        try:
+            self.redis = AsyncRedis(host=options['redis_server'], port=6379)
+            await self.redis.initialize()
+        except Exception as err:
+            LOGGER.error(f"Redis connect failed: {err} Redis Server Config: {options['redis_server']}", exc_info=True)  # noqa
+            raise
+
+        self.wnm_topic = Reloadable(WIS2TopicHierarchy())
+        self.wnm_schema = Reloadable(WNMValidate())
+        dedup_fallback = None
+        if options['dedup_fallback']:
+            dedup_fallback = create_fallback(options)
+
+        self.validation_pool = None
+        if options['validate_message'] and options['validate_workers'] > 0:
+            self.validation_pool = ValidationPool(
+                options['validate_workers'], options['validate_batch_size'],
+                options['validate_window'], options['validate_max_pending'])
+            self.validation_pool.start()
+
+        self.metrics = RelayMetricAggregator(
+            None, options['metrics_interval'], options['metrics_mqtt'])
+        if options['metrics_port'] is not None:
+            self.metrics.expose(int(options['metrics_port']))
+
+        self.sampler = None
+        if (options['validate_message'] and
+                options['validate_sample_rate'] < 1):
+            self.sampler = ValidationSampler(
+                options['validate_sample_rate'],
+                options['validate_sample_cooldown'], self.metrics,
+                options['gb_centre_id'])
+
+        labels = [options['centre_id'], options['gb_centre_id']]
+        self.reloader = Reloader(
+            self.wnm_topic, self.wnm_schema,
+            options.get('reload_interval', RELOAD_INTERVAL),
+            self.validation_pool, self.metrics, labels)
+        self.reloader.start()
+        self.loop.add_signal_handler(signal.SIGHUP, self.reloader.request)
+
+        self.dedup = AsyncRedisDedup(
+            self.redis, options,
+            lambda name, value=None: self.metrics.record(name, labels,
+                                                         value),
+            dedup_fallback,
+            create_adaptive_ttl(options, self.metrics, labels))
+        self.dedup_cache = DedupCache(options['dedup_cache_ttl'],
+                                      options['dedup_cache_size'],
+                                      self.dedup.adaptive_ttl)
+
+        self.publisher = AsyncPublisherPool(self.pubbroker, options,
+                                            self.loop, self.metrics)
+        # metrics snapshots are published by the publisher connections
+        self.metrics.metricq = self.publisher
+        self.metrics.daemon = True
+        self.metrics.start()
+
+        self.subs = []
+        for upstream in self.upstreams:
+            sub_options = options.copy()
+            sub_options['centre_id'] = upstream['centre_id']
+            self.subs.append(AsyncRelaySub(upstream['url'],
+                                           upstream['topics'], sub_options,
+                                           self))
+
+        await self.dedup.run_async()
+
+
+def run_worker(upstreams: list, pubbroker: str, options: dict) -> None:
+    """
+    Run the asyncio relay engine for upstreams in this process
+
+    :param upstreams: `list` of `dict` of upstream url, topics and
+                      centre_id
+    :param pubbroker: RFC1738 URL of Global Broker
+    :param options: `dict` of relay options
+
+    :returns: `None`
+    """
+
+    asyncio.run(AsyncRelay(upstreams, pubbroker, options).run())
+
+
+def run_engine(upstreams: list, pubbroker: str, options: dict) -> None:
+    """
+    Run the asyncio relay engine, with one event loop per worker process
+
+    Upstreams are assigned to `engine_workers` processes round robin.  With
+    `metrics_port` set, worker N exposes its metrics on `metrics_port + N`.
+
+    :param upstreams: `list` of `dict` of upstream url, topics and
+                      centre_id
+    :param pubbroker: RFC1738 URL of Global Broker
+    :param options: `dict` of relay options
+
+    :returns: `None`
+    """
+
+    workers = max(1, min(options.get('engine_workers', ENGINE_WORKERS),
+                         len(upstreams)))
+
+    if workers == 1:
+        run_worker(upstreams, pubbroker, options)
+        return
+
+    processes = []
+    for worker in range(workers):
+        worker_options = options.copy()
+        if options['metrics_port'] is not None:
+            worker_options['metrics_port'] = \
+                int(options['metrics_port']) + worker
+        process = multiprocessing.Process(
+            target=run_worker, name=f'wis2-relay-{worker}',
+            args=(upstreams[worker::workers], pubbroker, worker_options))
+        process.start()
+        processes.append(process)
+
+    def forward(signum, frame):
+        for process in processes:
+            os.kill(process.pid, signum)
+
+    # workers reload their topic hierarchy and message schema on SIGHUP
+    signal.signal(signal.SIGHUP, forward)
+
+    for process in processes:
+        process.join()
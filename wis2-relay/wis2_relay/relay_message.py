@@ -1,18 +1,45 @@
 import threading
-import json
 import logging
+import queue
 import time
+import zlib
+
+from paho.mqtt import client as mqtt_client
 
-from wis2_relay import util
 from wis2_relay.mqtt import MQTTPubSubClient
 
 LOGGER = logging.getLogger(__name__)
 
 FIRST_RECONNECT_DELAY = 1
 RECONNECT_RATE = 2
-MAX_RECONNECT_COUNT = 12
 MAX_RECONNECT_DELAY = 60
 
+PUBLISH_CONNECTIONS = 1
+PUBLISH_SHARD_BY = 'topic'
+PUBLISH_STATS_INTERVAL = 1
+
+
+def shard_index(topic: str, shard_by: str, shards: int) -> int:
+    """
+    Get the publisher connection of a topic
+
+    :param topic: `str` of topic
+    :param shard_by: `str` of `topic` or `centre_id`
+    :param shards: `int` of number of connections
+
+    :returns: `int` of connection index
+    """
+
+    if shards == 1:
+        return 0
+
+    key = topic
+    if shard_by == 'centre_id':
+        # origin|cache/a/wis2/{centre_id}/...
+        key = (topic.split('/', 4)[3:4] or [topic])[0]
+
+    return zlib.crc32(key.encode()) % shards
+
 
 class RelayMessage(threading.Thread):
     FIRST_RECONNECT_DELAY = 1
@@ -20,35 +47,172 @@ class RelayMessage(threading.Thread):
     MAX_RECONNECT_COUNT = 12
     MAX_RECONNECT_DELAY = 60
 
+    def on_pub_connect(self, client, userdata, flags, rc, props):
+        LOGGER.info(f'Connected to {self.client.broker_safe_url}: {rc}')
+        if not rc.is_failure:
+            self.connected.set()
+
     def on_pub_disconnect(self, client, userdata, disc_flags, rc, props):
         LOGGER.info(f"Disconnected from {userdata['centre_id']} with result code: {rc}")  # noqa
-        reconnect_count, reconnect_delay = 0, FIRST_RECONNECT_DELAY
-        while reconnect_count < MAX_RECONNECT_COUNT:
+        self.connected.clear()
+
+    def wait_for_connection(self):
+        """
+        Wait until connected, messages stay queued (and spooled) meanwhile
+
+        :returns: `None`
+        """
+
+        if self.connected.is_set():
+            return
+
+        if self.client.publish_window:
+            # paho's background loop reconnects by itself
+            self.connected.wait()
+            return
+
+        reconnect_delay = FIRST_RECONNECT_DELAY
+        while not self.connected.is_set():
+            # completes a pending connection, fails without one
+            if self.client.conn.loop() == mqtt_client.MQTT_ERR_SUCCESS:
+                continue
             LOGGER.info(f'Reconnecting in {reconnect_delay} seconds')
             time.sleep(reconnect_delay)
             try:
-                client.reconnect()
-                LOGGER.info('Reconnected successfully!')
-                return
+                self.client.conn.reconnect()
             except Exception as err:
                 LOGGER.error(f'Reconnect failed: {err}. Retrying...')
             reconnect_delay *= RECONNECT_RATE
             reconnect_delay = min(reconnect_delay, MAX_RECONNECT_DELAY)
-            reconnect_count += 1
-        LOGGER.info(f'Reconnect failed after {reconnect_count} attempts.')
 
-    def __init__(self, broker, options, mesgq, priority=None):
+        LOGGER.info('Reconnected successfully!')
+
+    def on_published(self, latency):
+        self.metrics.record('publish_latency_seconds', self.labels, latency)
+
+    def record_stats(self):
+        labels = self.labels + [str(self.connection)]
+        self.metrics.record('publish_queue_depth', labels, self.queue.qsize())
+        if self.published:
+            self.metrics.record('publish_connection_total', labels,
+                                self.published)
+            self.published = 0
+
+    def __init__(self, broker, options, mesgq, priority=None, metrics=None,
+                 connection=0):
         LOGGER.debug(f"Setup Message Pub {broker} with options: {options}")
         threading.Thread.__init__(self)
         self.qos = options['qos']
         self.queue = mesgq
         self.priority = priority
-        self.client = MQTTPubSubClient(broker, options)
+        self.metrics = metrics
+        self.labels = [options['centre_id'], options['gb_centre_id']]
+        self.connection = connection
+        self.published = 0
+        self.connected = threading.Event()
+        publish_window = options.get('publish_window', 0)
+        self.client = MQTTPubSubClient(broker, options, publish_window)
+        self.client.bind('on_connect', self.on_pub_connect)
         self.client.bind('on_disconnect', self.on_pub_disconnect)
 
+        if publish_window:
+            # paho's background loop reconnects by itself
+            self.client.conn.reconnect_delay_set(FIRST_RECONNECT_DELAY,
+                                                 MAX_RECONNECT_DELAY)
+            on_published = None
+            if self.metrics is not None:
+                on_published = self.on_published
+            self.client.start_publisher(on_published)
+
     def run(self):
+        if self.metrics is None:
+            while True:
+                self.wait_for_connection()
+                topic, payload = self.queue.get()
+                # payload bytes are published unchanged
+                self.client.pub(topic, payload, self.qos)
+                self.queue.task_done()
+
+        sampled = time.monotonic()
         while True:
-            topic, mesg = self.queue.get()
-            self.client.pub(
-                topic, json.dumps(mesg, default=util.json_serial), self.qos)
-            self.queue.task_done()
+            self.wait_for_connection()
+            try:
+                topic, payload = self.queue.get(
+                    timeout=PUBLISH_STATS_INTERVAL)
+            except queue.Empty:
+                topic = None
+            else:
+                # payload bytes are published unchanged
+                self.client.pub(topic, payload, self.qos)
+                self.queue.task_done()
+                self.published += 1
+
+            now = time.monotonic()
+            if topic is None or now - sampled >= PUBLISH_STATS_INTERVAL:
+                self.record_stats()
+                sampled = now
+
+
+class RelayMessagePool:
+    """Pool of Global Broker publisher connections"""
+
+    def __init__(self, broker, options, mesgqs, metrics=None):
+        """
+        Publisher pool initializer
+
+        Messages are sharded across one connection per queue by a hash of
+        their topic (`publish_shard_by: topic`) or of the centre_id in
+        their topic (`publish_shard_by: centre_id`), preserving the order
+        of messages of a topic.
+
+        :param broker: RFC1738 URL of broker
+        :param options: `dict` of relay options
+        :param mesgqs: `list` of `queue.Queue`, one per connection
+        :param metrics: `RelayMetricAggregator` of relay metrics
+
+        :returns: `None`
+        """
+
+        self.shard_by = options.get('publish_shard_by', PUBLISH_SHARD_BY)
+        if self.shard_by not in ['topic', 'centre_id']:
+            raise ValueError(f'Invalid publish_shard_by: {self.shard_by}')
+
+        self.queues = mesgqs
+        self.threads = [RelayMessage(broker, options, mesgq, metrics=metrics,
+                                     connection=connection)
+                        for connection, mesgq in enumerate(mesgqs)]
+
+    def shard(self, topic: str) -> int:
+        """
+        Get the connection of a topic
+
+        :param topic: `str` of topic
+
+        :returns: `int` of connection index
+        """
+
+        return shard_index(topic, self.shard_by, len(self.queues))
+
+    def put(self, item, block=True, timeout=None):
+        """
+        Queue a (topic, payload) message on the connection of its topic
+
+        :param item: `tuple` of topic and payload
+        :param block: `bool` of whether to wait for free space
+        :param timeout: `float` of seconds to wait for free space
+
+        :returns: `None`
+        """
+
+        self.queues[self.shard(item[0])].put(item, block, timeout)
+
+    def qsize(self):
+        return sum(mesgq.qsize() for mesgq in self.queues)
+
+    def start(self):
+        for thread in self.threads:
+            thread.start()
+
+    def join(self):
+        for thread in self.threads:
+            thread.join()
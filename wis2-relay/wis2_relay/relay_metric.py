@@ -49,6 +49,7 @@ class RelayMetric(threading.Thread):
     def run(self):
         while True:
             topic, mesg = self.queue.get()
-            self.client.pub(
-                topic, json.dumps(mesg, default=util.json_serial), self.qos)
+            if not isinstance(mesg, (bytes, str)):
+                mesg = json.dumps(mesg, default=util.json_serial)
+            self.client.pub(topic, mesg, self.qos)
             self.queue.task_done()
@@ -0,0 +1,412 @@
+###############################################################################
+#
+# Licensed to the Apache Software Foundation (ASF) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The ASF licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+#
+###############################################################################
+
+
+from collections import deque
+import logging
+import queue
+import threading
+import time
+from typing import Any
+
+from wis2_relay.metrics import METRICS_TOPIC
+
+LOGGER = logging.getLogger(__name__)
+
+QUEUE_SIZE = 10000
+QUEUE_POLICY = 'spill'
+QUEUE_POLICIES = ['block', 'drop_oldest', 'drop_newest', 'spill']
+QUEUE_TIMEOUT = 1
+QUEUE_SPILL_SIZE = 100000
+
+LANE_WEIGHTS = {
+    'core': 8,
+    'metadata': 4,
+    'recommended': 2,
+    'metrics': 1
+}
+LANE_LATENCY_SAMPLE = 0.1
+
+
+def get_lane(topic: str) -> str:
+    """
+    Get the priority lane of a topic
+
+    :param topic: `str` of topic
+
+    :returns: `str` of lane (core, recommended, metadata or metrics)
+    """
+
+    if topic.startswith(METRICS_TOPIC):
+        return 'metrics'
+
+    # origin|cache/a/wis2/{centre_id}/data/core|recommended/...
+    # origin|cache/a/wis2/{centre_id}/metadata/...
+    levels = topic.split('/', 6)
+    if len(levels) > 4 and levels[4] == 'metadata':
+        return 'metadata'
+    if len(levels) > 5 and levels[4] == 'data' and levels[5] == 'core':
+        return 'core'
+
+    return 'recommended'
+
+
+class RelayQueue(queue.Queue):
+    """Bounded relay queue with an overflow policy"""
+
+    def __init__(self, maxsize: int = QUEUE_SIZE,
+                 policy: str = QUEUE_POLICY, timeout: float = QUEUE_TIMEOUT,
+                 spill_size: int = QUEUE_SPILL_SIZE, spool=None,
+                 metrics=None, labels: list = None) -> None:
+        """
+        Relay queue initializer
+
+        When the queue is full, `put` applies the overflow policy:
+
+        - `block`: wait up to `timeout` seconds for free space, then drop
+          the new item
+        - `drop_oldest`: drop the oldest queued item
+        - `drop_newest`: drop the new item
+        - `spill`: keep the new item in an overflow buffer of up to
+          `spill_size` items, then drop the new item.  The overflow buffer
+          is in memory, or `spool` on disk
+
+        Only the overflow buffer is spooled: the up to `maxsize` items
+        queued in memory are lost on a restart.
+
+        :param maxsize: `int` of maximum number of queued items
+        :param policy: `str` of overflow policy
+        :param timeout: `float` of seconds to wait for free space (`block`)
+        :param spill_size: `int` of maximum number of overflow items
+                           (`spill`)
+        :param spool: optional `DiskQueue` of overflow items (`spill`),
+                      items spooled before a restart are queued first
+        :param metrics: `RelayMetricAggregator` of relay metrics
+        :param labels: `list` of metric label values (centre_id,
+                       report_by, queue)
+
+        :returns: `None`
+        """
+
+        if policy not in QUEUE_POLICIES:
+            raise ValueError(f'Invalid queue policy: {policy}')
+
+        queue.Queue.__init__(self, maxsize)
+        self.policy = policy
+        self.timeout = timeout
+        self.spill_size = spill_size
+        self.overflow = deque() if spool is None else spool
+        self.metrics = metrics
+        self.labels = labels if labels is not None else []
+        self.high_watermark = 0
+
+        if self.metrics is not None:
+            self.metrics.add_collector(self.collect)
+
+    def _qsize(self) -> int:
+        return len(self.queue) + len(self.overflow)
+
+    def _drop_oldest(self) -> None:
+        self.queue.popleft()
+
+    def _spill(self, item: Any) -> None:
+        self.overflow.append(item)
+
+    def _get(self) -> Any:
+        if not self.queue:
+            return self.overflow.popleft()
+        item = self.queue.popleft()
+        if self.overflow:
+            self.queue.append(self.overflow.popleft())
+        return item
+
+    def record(self, metric_name: str, value: int = None) -> None:
+        if self.metrics is not None:
+            self.metrics.record(metric_name, self.labels, value)
+
+    def sync_spool(self) -> None:
+        with self.mutex:
+            sync_pending = getattr(self.overflow, 'sync_pending', None)
+            if sync_pending is not None:
+                sync_pending()
+
+    def put(self, item: Any, block: bool = True,
+            timeout: float = None) -> None:
+        """
+        Put an item on the queue, applying the overflow policy when full
+
+        :param item: item to queue
+        :param block: `bool` of whether to wait for free space (`block`)
+        :param timeout: `float` of seconds to wait for free space, default
+                        `timeout` of the queue (`block`)
+
+        :returns: `None`
+        """
+
+        with self.not_full:
+            size = self._qsize()
+
+            if self.maxsize > 0 and size >= self.maxsize:
+                if not self.overflow_put(item, block, timeout):
+                    self.record('queue_dropped_total')
+                    return
+            else:
+                self._put(item)
+
+            size = self._qsize()
+            if size > self.high_watermark:
+                self.high_watermark = size
+            self.unfinished_tasks += 1
+            self.not_empty.notify()
+
+    def overflow_put(self, item: Any, block: bool, timeout: float) -> bool:
+        """
+        Apply the overflow policy to an item put on a full queue
+
+        Called with the queue mutex held.
+
+        :param item: item to queue
+        :param block: `bool` of whether to wait for free space (`block`)
+        :param timeout: `float` of seconds to wait for free space
+
+        :returns: `bool` of whether `item` was added without dropping
+                  an item
+        """
+
+        self.record('queue_overflow_total')
+
+        if self.policy == 'block' and block:
+            if timeout is None:
+                timeout = self.timeout
+            endtime = time.monotonic() + timeout
+            while self._qsize() >= self.maxsize:
+                remaining = endtime - time.monotonic()
+                if remaining <= 0:
+                    LOGGER.warning('Queue full, dropping new item')
+                    return False
+                self.not_full.wait(remaining)
+            self._put(item)
+            return True
+        elif self.policy == 'drop_oldest':
+            # the oldest item is replaced, unfinished tasks are unchanged
+            self._drop_oldest()
+            self._put(item)
+            return False
+        elif self.policy == 'spill' and len(self.overflow) < self.spill_size:
+            try:
+                self._spill(item)
+            except queue.Full:
+                LOGGER.warning('Spool full, dropping new item')
+                return False
+            self.record('queue_spilled_total')
+            return True
+
+        return False
+
+    def collect(self) -> None:
+        """
+        Record and reset the high watermark of the queue, and record the
+        size of its spool
+
+        :returns: `None`
+        """
+
+        with self.mutex:
+            high_watermark, self.high_watermark = (self.high_watermark,
+                                                   self._qsize())
+            spool_bytes = getattr(self.overflow, 'size', None)
+
+        self.record('queue_high_watermark', high_watermark)
+        if spool_bytes is not None:
+            self.record('queue_spool_bytes', spool_bytes)
+
+
+class LaneOverflow:
+    """Overflow buffer of a lane queue, one buffer per lane"""
+
+    def __init__(self, spools: dict = None) -> None:
+        """
+        Lane overflow initializer
+
+        :param spools: optional `dict` of lane name and `DiskQueue`,
+                       default in memory
+
+        :returns: `None`
+        """
+
+        self.spooled = spools is not None
+        self.lanes = {lane: deque() if spools is None else spools[lane]
+                      for lane in LANE_WEIGHTS}
+
+    def append(self, item: Any) -> None:
+        self.lanes[get_lane(item[0])].append(item)
+
+    def __len__(self) -> int:
+        return sum(len(lane) for lane in self.lanes.values())
+
+    @property
+    def size(self) -> int:
+        if not self.spooled:
+            return None
+        return sum(spool.size for spool in self.lanes.values())
+
+    def sync_pending(self) -> None:
+        if self.spooled:
+            for spool in self.lanes.values():
+                spool.sync_pending()
+
+
+class LaneQueue(RelayQueue):
+    """Relay queue of weighted priority lanes"""
+
+    def __init__(self, maxsize: int = QUEUE_SIZE,
+                 policy: str = QUEUE_POLICY, timeout: float = QUEUE_TIMEOUT,
+                 spill_size: int = QUEUE_SPILL_SIZE, spool=None,
+                 metrics=None, labels: list = None,
+                 weights: dict = LANE_WEIGHTS) -> None:
+        """
+        Lane queue initializer
+
+        Items are queued in the lane of their topic (see `get_lane`) and
+        taken by smooth weighted round robin over the non-empty lanes:
+        with the default weights, core data gets 8 of every 15 items
+        while all lanes are busy, but an idle lane costs nothing.
+        Overflow is handled as by `RelayQueue`, `drop_oldest` dropping
+        from the lowest weighted lane.  `spill` keeps an overflow buffer
+        per lane, a lane being served from its buffer once its queued
+        items are taken, so that spilled core data is not held behind
+        spilled items of lower weighted lanes.  The queueing latency of
+        each lane is sampled every `LANE_LATENCY_SAMPLE` seconds.
+
+        :param spool: optional `dict` of lane name and `DiskQueue` of
+                      overflow items (`spill`)
+        :param weights: `dict` of lane name and `int` weight
+
+        :returns: `None`
+        """
+
+        unknown = set(weights) - set(LANE_WEIGHTS)
+        if unknown:
+            raise ValueError(f'Invalid priority lanes: {sorted(unknown)}')
+        self.weights = {lane: int(weights.get(lane, weight))
+                        for lane, weight in LANE_WEIGHTS.items()}
+        if min(self.weights.values()) < 1:
+            raise ValueError('Priority lane weights must be positive')
+
+        RelayQueue.__init__(self, maxsize, policy, timeout, spill_size,
+                            LaneOverflow(spool), metrics, labels)
+
+    def _init(self, maxsize: int) -> None:
+        self.queue = {lane: deque() for lane in LANE_WEIGHTS}
+        self.current = dict.fromkeys(LANE_WEIGHTS, 0)
+        self.sampled = dict.fromkeys(LANE_WEIGHTS, 0)
+        self.length = 0
+        # enqueue times of the items spilled since startup
+        self.spilled = {lane: deque() for lane in LANE_WEIGHTS}
+
+    def _qsize(self) -> int:
+        return self.length + len(self.overflow)
+
+    def _put(self, item: Any, queued: float = None) -> None:
+        if queued is None:
+            queued = time.monotonic()
+        self.queue[get_lane(item[0])].append((queued, item))
+        self.length += 1
+
+    def _spill(self, item: Any) -> None:
+        lane = get_lane(item[0])
+        self.overflow.lanes[lane].append(item)
+        self.spilled[lane].append(time.monotonic())
+
+    def _refill(self, lane: str) -> None:
+        # items spooled before a restart are ahead of those spilled since
+        # startup, and are queued from now
+        overflow, spilled = self.overflow.lanes[lane], self.spilled[lane]
+        queued = None
+        if len(overflow) <= len(spilled):
+            queued = spilled.popleft()
+        self._put(overflow.popleft(), queued)
+
+    def _drop_oldest(self) -> None:
+        for lane in sorted(self.queue, key=self.weights.get):
+            if self.queue[lane]:
+                self.queue[lane].popleft()
+                self.length -= 1
+                return
+
+    def _get(self) -> Any:
+        # smooth weighted round robin over the non-empty lanes
+        total, selected = 0, None
+        for lane, lane_queue in self.queue.items():
+            if lane_queue or self.overflow.lanes[lane]:
+                self.current[lane] += self.weights[lane]
+                total += self.weights[lane]
+                if (selected is None or
+                        self.current[lane] > self.current[selected]):
+                    selected = lane
+        self.current[selected] -= total
+
+        # the overflow of a lane follows its queued items
+        if self.overflow.lanes[selected]:
+            self._refill(selected)
+
+        queued, item = self.queue[selected].popleft()
+        self.length -= 1
+
+        now = time.monotonic()
+        if now - self.sampled[selected] >= LANE_LATENCY_SAMPLE:
+            self.sampled[selected] = now
+            if self.metrics is not None:
+                self.metrics.record('queue_lane_latency_seconds',
+                                    self.labels[:2] + [selected],
+                                    now - queued)
+
+        return item
+
+
+class SpoolSync(threading.Thread):
+    """Periodic sync of the spools of relay queues"""
+
+    def __init__(self, queues: list, interval: float) -> None:
+        """
+        Spool sync initializer
+
+        Spools sync on append once `interval` has elapsed, the last items
+        of a burst are synced here.
+
+        :param queues: `list` of `RelayQueue` with a spool
+        :param interval: `float` of seconds between syncs
+
+        :returns: `None`
+        """
+
+        threading.Thread.__init__(self, daemon=True)
+        self.queues = queues
+        self.interval = interval
+
+    def run(self) -> None:
+        while True:
+            time.sleep(self.interval)
+            for queue_ in self.queues:
+                try:
+                    queue_.sync_spool()
+                except OSError as err:
+                    LOGGER.error(f'Spool sync failed: {err}')
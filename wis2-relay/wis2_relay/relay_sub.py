@@ -1,13 +1,17 @@
 import threading
-import json
 import logging
 from redis.cluster import RedisCluster as Redis
 import time
 
 from typing import Union
+from wis2_relay.checks import CheckedMessage, MessageChecks
+from wis2_relay.dedup import (DEDUP_CACHE_SIZE, DEDUP_CACHE_TTL,
+                              DedupCache, DedupCheck, RedisDedup)
+from wis2_relay.metrics import METRICS_INTERVAL, RelayMetricAggregator
 from wis2_relay.topic import WIS2TopicHierarchy
 from wis2_relay.mqtt import MQTTPubSubClient
-from wis2_relay.verify import WNMValidate
+from wis2_relay.reload import Reloadable
+from wis2_relay.verify import ValidationSequence, WNMValidate
 
 LOGGER = logging.getLogger(__name__)
 
@@ -15,129 +19,86 @@ LOGGER = logging.getLogger(__name__)
 class RelaySub(threading.Thread):
     def process_metric(self, metric_name: str, value: Union[str, int, float] = None):
         userdata = self.client.userdata
-        LOGGER.debug(f'Publishing metric {metric_name}')
-        message_payload = {
-            'labels': [userdata['centre_id'], userdata['gb_centre_id']]
-        }
-        if value is not None:
-            message_payload['value'] = value
-        self.metricq.put((f'wis2-globalbroker/metrics/{metric_name}', message_payload))
-
-    def process_mesg(self, topic, mesg_dict):
+        LOGGER.debug(f'Recording metric {metric_name}')
+        self.metrics.record(
+            metric_name, [userdata['centre_id'], userdata['gb_centre_id']],
+            value)
+
+    def process_mesg(self, topic, payload: bytes):
         LOGGER.debug(f"Publishing message: {topic}")
         self.process_metric("published_total")
         self.process_metric("last_message_timestamp", round(time.time()))
-        self.mesgq.put((topic, mesg_dict))
+        self.mesgq.put((topic, payload))
 
     def on_message_handler(self, client, userdata, msg):
         LOGGER.debug(f'Topic: {msg.topic}')
         LOGGER.debug(f'Message:\n{msg.payload}')
 
-        msg_dict = json.loads(msg.payload)
-        topic_check = msg.topic.split('/')
-        if len(topic_check) < 5:
-            LOGGER.error(f'Invalid WIS2 Topic Preamble {msg.topic}')
-            LOGGER.error('Review Global Broker Client Subscriptions')
-            self.process_metric("invalid_topic_total")
-            return
-
-        centre_id = topic_check[3]
-
-        try:
-            if not self.redis.set(msg_dict['id'], centre_id, ex=3600, nx=True):
-                LOGGER.info(f"WIS2 Message exists {centre_id} ID: {msg_dict['id']}")  # noqa
-                return
-            else:
-                LOGGER.info(f"WIS2 Message received {centre_id} ID: {msg_dict['id']}")  # noqa
-                self.process_metric("messages_received_total")
-        except Exception as err:
-            LOGGER.error(f'Redis operation failed: {err}', exc_info=True)
-            return
-
-        try:
-            tpc_vfy = self.wnm_topic
-            if not tpc_vfy.get_wis2(topic_check[:6]):
-                LOGGER.error(f'Invalid WIS2 Topic Preamble {msg.topic}')
-                LOGGER.error('Review Global Broker Client Subscriptions')
-                self.process_metric("invalid_topic_total")
-                return
-            if userdata.get('verify_centre_id', False) and not tpc_vfy.get_centre_id(topic_check[3]):  # noqa
-                LOGGER.error(f'Invalid Centre-ID in Topic: {msg.topic}')
-                self.process_metric("invalid_topic_total")
-                return
-            if userdata.get('verify_topic', False):
-                if topic_check[4] == 'metadata' and len(topic_check) in [6, 7]:
-                    LOGGER.error(f'Invalid WIS2 Topic Preamble {msg.topic}')
-                    self.process_metric("invalid_topic_total")
-                    return
-                if topic_check[4] == "data" and len(topic_check) < 8:
-                    LOGGER.error(f'Invalid WIS2 Topic Preamble {msg.topic}')
-                    self.process_metric("invalid_topic_total")
-                    return
-                if len(topic_check) > 7 and not tpc_vfy.get_esd(topic_check[6:]):  # noqa
-                    LOGGER.error(f'Invalid Earth System Discipline Topic {msg.topic}')  # noqa
-                    self.process_metric("invalid_topic_total")
-                    return
-        except RuntimeError as err:
-            LOGGER.error('Problem With Topic Validation')
-            LOGGER.error(f'Topic: {msg.topic} Error: {err}')
-
-        if userdata.get('verify_data', False):
-            try:
-                inlinesize = len(msg_dict['properties']['content']['value'])
-                if inlinesize > 4096:
-                    LOGGER.error(f'Message inline content too large. Centre: {centre_id} Size: {inlinesize}')  # noqa
-                    self.process_metric("invalid_total")
-                    msg_dict['properties']['content']['value'] = 'Inline content too long... truncated'  # noqa
-
-                    return
-            except KeyError:
-                LOGGER.debug('no inline data found')
-
-        if 'metadata_id' not in msg_dict['properties']:
-            LOGGER.error(f'Message missing metadata.  Centre: {centre_id}')
-            self.process_metric("no_metadata_total")
-            if userdata.get('verify_metadata', False):
-                return
-
-        try:
-            if userdata.get('validate_message', False):
-                LOGGER.debug('Validating message')
-                success, err = self.wnm_schema.validate_message(msg_dict)
-                if not success:
-                    LOGGER.error(f'Message is not valid. Centre: {centre_id} Error: {err}')  # noqa
-                    self.process_metric("invalid_format_total")
-                    return
-        except RuntimeError as err:
-            LOGGER.error(f'Cannot validate message: {err}', exc_info=True)
-            return
-
-        LOGGER.debug(f"Received message with Data_ID: {msg_dict['properties']['data_id']}")  # noqa
-        self.process_mesg(msg.topic, msg_dict)
-
-    def __init__(self, broker, topics, options, mesgq, metricq, priority=None):
+        self.pipeline.check(CheckedMessage(msg.topic, msg.payload))
+
+    def __init__(self, broker, topics, options, mesgq, metricq, priority=None,
+                 redis=None, wnm_topic=None, wnm_schema=None,
+                 dedup_cache=None, dedup_fallback=None, metrics=None,
+                 validation_pool=None, sampler=None, adaptive_ttl=None):
         LOGGER.info(f"Setup Message Sub {broker} with options: {options}")
         threading.Thread.__init__(self)
-        self.wnm_topic = WIS2TopicHierarchy()
-        self.wnm_schema = WNMValidate()
+        self.wnm_topic = wnm_topic or Reloadable(WIS2TopicHierarchy())
+        self.wnm_schema = wnm_schema or Reloadable(WNMValidate())
         self.topics = topics
         self.mesgq = mesgq
         self.metricq = metricq
         self.qos = options['qos']
         self.priority = priority
-
-        try:
-            LOGGER.info(f"Connecting to Redis Cluster {options['redis_server']}")
-            self.redis = Redis(host=options['redis_server'], port=6379)
-        except Exception as err:
-            LOGGER.error(f"Redis connect failed: {err} Redis Server Config: {options['redis_server']}", exc_info=True)  # noqa
-            exit
+        self.metrics = metrics
+
+        if self.metrics is None:
+            self.metrics = RelayMetricAggregator(
+                metricq, options.get('metrics_interval', METRICS_INTERVAL),
+                options.get('metrics_mqtt', True))
+        self.redis = redis
+        self.dedup_cache = dedup_cache
+
+        if self.dedup_cache is None:
+            self.dedup_cache = DedupCache(
+                options.get('dedup_cache_ttl', DEDUP_CACHE_TTL),
+                options.get('dedup_cache_size', DEDUP_CACHE_SIZE),
+                adaptive_ttl)
+
+        if self.redis is None:
+            try:
+                LOGGER.info(f"Connecting to Redis Cluster {options['redis_server']}")  # noqa
+                self.redis = Redis(host=options['redis_server'], port=6379)
+            except Exception as err:
+                LOGGER.error(f"Redis connect failed: {err} Redis Server Config: {options['redis_server']}", exc_info=True)  # noqa
+                raise
+
+        self.dedup = RedisDedup(self.redis, options, self.process_metric,
+                                dedup_fallback, adaptive_ttl)
+        self.dedup_check = DedupCheck(self.dedup, self.dedup_cache,
+                                      options['centre_id'],
+                                      self.process_metric)
+
+        validation = None
+        if validation_pool is not None and options.get('validate_message'):
+            validation = ValidationSequence(
+                validation_pool, self.wnm_schema, self.process_mesg,
+                self.process_metric, sampler=sampler)
 
         self.client = MQTTPubSubClient(broker, options)
+        checks = MessageChecks(options, self.wnm_topic, self.wnm_schema,
+                               self.process_metric, self.process_mesg,
+                               validation, sampler)
+        self.pipeline = checks.create_pipeline(
+            self.dedup_check.check, self.metrics,
+            [options['centre_id'], options['gb_centre_id']])
+
         self.client.bind('on_message', self.on_message_handler)
         LOGGER.info(f'Connected to broker {self.client.broker_safe_url}')
 
     def run(self):
         LOGGER.info(f'Subscribing to subscribe_topics {self.topics}')
+        if not self.metrics.is_alive():
+            self.metrics.start()
         self.process_metric("connected_flag", True)
+        self.dedup.start()
         self.client.sub(self.topics, self.qos)
@@ -0,0 +1,226 @@
+###############################################################################
+#
+# Licensed to the Apache Software Foundation (ASF) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The ASF licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+#
+###############################################################################
+
+import logging
+import threading
+from pathlib import Path
+from typing import List
+
+from jsonschema.validators import Draft202012Validator
+
+from wis2_relay.schema import MESSAGE_SCHEMA
+from wis2_relay.topic import (TOPIC_SCHEMA_CENTRE, TOPIC_SCHEMA_ESD,
+                              WIS2TopicHierarchy)
+from wis2_relay.verify import ValidationPool, WNMValidate
+
+LOGGER = logging.getLogger(__name__)
+
+RELOAD_INTERVAL = 30
+
+
+def signature(paths: List[Path]) -> tuple:
+    """
+    Get the modification times and sizes of files
+
+    :param paths: `list` of `Path` of files
+
+    :returns: `tuple` of modification time and size of each file, `None`
+              for missing files
+    """
+
+    result = []
+    for path in paths:
+        try:
+            stat = path.stat()
+            result.append((stat.st_mtime_ns, stat.st_size))
+        except OSError:
+            result.append(None)
+
+    return tuple(result)
+
+
+class Reloadable:
+    """Reference to the loaded version of a validator, shared by its users
+    and swapped when the validator is reloaded"""
+
+    def __init__(self, value: object) -> None:
+        """
+        Reloadable initializer
+
+        Users hold the reference and `get` the validator for each use, so
+        they see either version.
+
+        :param value: loaded validator
+
+        :returns: `None`
+        """
+
+        self.value = value
+        self.lock = threading.Lock()
+
+    def get(self) -> object:
+        with self.lock:
+            return self.value
+
+    def swap(self, new: object) -> object:
+        """
+        Replace the validator by a new version
+
+        :param new: reloaded validator
+
+        :returns: previous validator
+        """
+
+        with self.lock:
+            previous, self.value = self.value, new
+        return previous
+
+
+def load_topic_hierarchy() -> WIS2TopicHierarchy:
+    wnm_topic = WIS2TopicHierarchy()
+    if not wnm_topic.centre_id or not wnm_topic.earth_system:
+        raise RuntimeError('topic hierarchy is empty')
+    return wnm_topic
+
+
+def load_message_schema() -> WNMValidate:
+    wnm_schema = WNMValidate()
+    Draft202012Validator.check_schema(wnm_schema.schema)
+    return wnm_schema
+
+
+class Reloader(threading.Thread):
+    """Rebuilds the topic hierarchy and message validator in the background
+    when their files change, and swaps them in"""
+
+    def __init__(self, wnm_topic: Reloadable, wnm_schema: Reloadable,
+                 interval: float = RELOAD_INTERVAL,
+                 validation_pool: ValidationPool = None,
+                 metrics=None, labels: list = None) -> None:
+        """
+        Reloader initializer
+
+        Files are checked every `interval` seconds, and reloaded once
+        unchanged over two checks (e.g. after `wis2-relay topic sync`).
+        `request` reloads them on the next check.
+
+        :param wnm_topic: `Reloadable` of `WIS2TopicHierarchy` of topic
+                          validator
+        :param wnm_schema: `Reloadable` of `WNMValidate` of message
+                           validator
+        :param interval: `float` of seconds between checks, `0` to reload
+                         on request only
+        :param validation_pool: `ValidationPool` whose workers validate
+                                with `wnm_schema`
+        :param metrics: `RelayMetricAggregator` to report active versions to
+        :param labels: `list` of metric label values
+
+        :returns: `None`
+        """
+
+        threading.Thread.__init__(self, daemon=True)
+        self.interval = interval
+        self.validation_pool = validation_pool
+        self.metrics = metrics
+        self.labels = labels
+        self.requested = threading.Event()
+
+        self.watched = []
+        for name, current, load, paths in [
+                ('topic_hierarchy', wnm_topic, load_topic_hierarchy,
+                 [TOPIC_SCHEMA_CENTRE, TOPIC_SCHEMA_ESD]),
+                ('message_schema', wnm_schema, load_message_schema,
+                 [MESSAGE_SCHEMA])]:
+            loaded = signature(paths)
+            self.watched.append({
+                'name': name,
+                'current': current,
+                'load': load,
+                'paths': paths,
+                'loaded': loaded,
+                'seen': loaded
+            })
+
+        if metrics is not None:
+            metrics.add_collector(self.collect)
+
+    def request(self, *args) -> None:
+        """
+        Request a reload, e.g. from a SIGHUP handler
+
+        :returns: `None`
+        """
+
+        self.requested.set()
+
+    def check(self, watched: dict, requested: bool) -> None:
+        current = signature(watched['paths'])
+        seen, watched['seen'] = watched['seen'], current
+
+        if None in current:
+            LOGGER.debug(f"{watched['name']} files missing, not reloaded")
+            return
+        if not requested and (current == watched['loaded'] or
+                              current != seen):
+            return
+
+        self.reload(watched, current)
+
+    def reload(self, watched: dict, loaded: tuple) -> None:
+        name = watched['name']
+        current = watched['current'].get()
+
+        # not retried until the files change again
+        watched['loaded'] = loaded
+        try:
+            new = watched['load']()
+        except Exception as err:
+            LOGGER.error(f'Cannot reload {name}, keeping {current.version}: {err}')  # noqa
+            return
+
+        if new.version == current.version:
+            LOGGER.debug(f'{name} {current.version} unchanged')
+            return
+
+        watched['current'].swap(new)
+        if name == 'message_schema' and self.validation_pool is not None:
+            self.validation_pool.version = new.version
+
+        LOGGER.info(f'Reloaded {name} {current.version} -> {new.version}')
+        self.record(name, current.version, 0)
+        self.record(name, new.version, 1)
+
+    def record(self, name: str, version: str, value: int) -> None:
+        if self.metrics is not None:
+            self.metrics.record('active_version',
+                                self.labels + [name, version], value)
+
+    def collect(self) -> None:
+        for watched in self.watched:
+            current = watched['current'].get()
+            self.record(watched['name'], current.version, 1)
+
+    def run(self) -> None:
+        while True:
+            requested = self.requested.wait(self.interval or None)
+            self.requested.clear()
+            for watched in self.watched:
+                self.check(watched, requested)
@@ -20,18 +20,23 @@
 ###############################################################################
 
 import click
+import json
 import logging
 from pathlib import Path
 import shutil
 from urllib.request import urlopen
 
 from wis2_relay import cli_options
+from wis2_relay.schema_compiler import (compile_schema, schema_digest,
+                                        SchemaNotCompilable)
 
 LOGGER = logging.getLogger(__name__)
 
 MESSAGE_SCHEMA_URL = 'https://raw.githubusercontent.com/wmo-im/wis2-notification-message/main/schemas/wis2-notification-message-bundled.json'  # noqa
 USERDIR = Path.home() / '.wis2-relay'
 MESSAGE_SCHEMA = USERDIR / 'wis2-notification-message' / 'wis2-notification-message-bundled.json'  # noqa
+# validation module generated from MESSAGE_SCHEMA
+MESSAGE_VALIDATOR = MESSAGE_SCHEMA.with_suffix('.py')
 
 
 def sync_schema() -> None:
@@ -52,6 +57,29 @@ def sync_schema() -> None:
     with MESSAGE_SCHEMA.open('wb') as fh:
         fh.write(urlopen(MESSAGE_SCHEMA_URL).read())
 
+    compile_validator()
+
+
+def compile_validator() -> bool:
+    """
+    Compile WIS2 notification schema into a validation module
+
+    :returns: `bool` of whether the schema was compiled
+    """
+
+    LOGGER.debug('Compiling notification message schema')
+
+    schema_bytes = MESSAGE_SCHEMA.read_bytes()
+    try:
+        source = compile_schema(json.loads(schema_bytes),
+                                schema_digest(schema_bytes))
+    except SchemaNotCompilable as err:
+        LOGGER.warning(f'Cannot compile notification message schema: {err}')
+        return False
+
+    MESSAGE_VALIDATOR.write_text(source)
+    return True
+
 
 @click.group()
 def schema():
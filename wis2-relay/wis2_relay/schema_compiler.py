@@ -0,0 +1,606 @@
+###############################################################################
+#
+# Licensed to the Apache Software Foundation (ASF) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The ASF licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+#
+###############################################################################
+
+from collections.abc import Mapping, Sequence
+from functools import lru_cache
+from hashlib import sha256
+import importlib.util
+import logging
+from pathlib import Path
+from typing import Callable, Optional
+from urllib.parse import unquote, urldefrag, urljoin
+
+from jsonschema.validators import Draft202012Validator
+
+LOGGER = logging.getLogger(__name__)
+
+# bump when the generated code changes, to regenerate cached validators
+COMPILER_VERSION = 1
+FORMAT_CACHE_SIZE = 100000
+
+FORMAT_CHECKER = Draft202012Validator.FORMAT_CHECKER
+
+# keywords without effect on validation
+ANNOTATIONS = {
+    '$schema', '$id', '$comment', '$defs', 'definitions', 'title',
+    'description', 'examples', 'default', 'deprecated', 'readOnly',
+    'writeOnly', 'contentMediaType', 'contentEncoding', 'contentSchema',
+    'minContains', 'maxContains', 'then', 'else'
+}
+
+# Python types of JSON Schema types (as per jsonschema, booleans are not
+# numbers and integral floats are integers)
+TYPES = {
+    'null': 'data is None',
+    'boolean': 'isinstance(data, bool)',
+    'integer': 'is_integer(data)',
+    'number': 'is_number(data)',
+    'string': 'isinstance(data, str)',
+    'array': 'isinstance(data, list)',
+    'object': 'isinstance(data, dict)'
+}
+
+# keywords applying to instances of a type only
+TYPE_KEYWORDS = {
+    'object': {'required', 'properties', 'patternProperties',
+               'additionalProperties', 'propertyNames', 'minProperties',
+               'maxProperties', 'dependentRequired', 'dependentSchemas'},
+    'array': {'items', 'prefixItems', 'contains', 'minItems', 'maxItems',
+              'uniqueItems'},
+    'string': {'minLength', 'maxLength', 'pattern'},
+    'number': {'minimum', 'maximum', 'exclusiveMinimum',
+               'exclusiveMaximum', 'multipleOf'}
+}
+
+
+class SchemaNotCompilable(Exception):
+    """Schema uses keywords the compiler does not support"""
+    pass
+
+
+def is_integer(value) -> bool:
+    if isinstance(value, bool):
+        return False
+    if isinstance(value, float):
+        return value.is_integer()
+    return isinstance(value, int)
+
+
+def is_number(value) -> bool:
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+
+def _unbool(value):
+    # True and 1 (False and 0) are different values in JSON Schema
+    if value is True:
+        return (bool, True)
+    if value is False:
+        return (bool, False)
+    return value
+
+
+def equal(one, two) -> bool:
+    """
+    Compare JSON values as `enum`, `const` and `uniqueItems` do
+
+    :param one: JSON value
+    :param two: JSON value
+
+    :returns: `bool` of whether the values are equal
+    """
+
+    if one is two:
+        return True
+    if isinstance(one, str) or isinstance(two, str):
+        return one == two
+    if isinstance(one, Sequence) and isinstance(two, Sequence):
+        return (len(one) == len(two) and
+                all(equal(i, j) for i, j in zip(one, two)))
+    if isinstance(one, Mapping) and isinstance(two, Mapping):
+        return (one.keys() == two.keys() and
+                all(equal(one[key], two[key]) for key in one))
+    return _unbool(one) == _unbool(two)
+
+
+def is_unique(values: list) -> bool:
+    for i, value in enumerate(values):
+        if any(equal(value, other) for other in values[i + 1:]):
+            return False
+    return True
+
+
+def is_multiple(value, divisor) -> bool:
+    if isinstance(divisor, float):
+        quotient = value / divisor
+        try:
+            return int(quotient) == quotient
+        except OverflowError:
+            return False
+    if isinstance(value, float):
+        quotient = value / divisor
+        try:
+            return int(quotient) == quotient
+        except OverflowError:
+            return False
+    return value % divisor == 0
+
+
+@lru_cache(maxsize=FORMAT_CACHE_SIZE)
+def _check_format(value: str, format_: str) -> bool:
+    return FORMAT_CHECKER.conforms(value, format_)
+
+
+def check_format(value, format_: str) -> bool:
+    """
+    Check a `format`, memoising string values (URIs, date-times, ...
+    repeat across messages)
+
+    :param value: JSON value
+    :param format_: `str` of format
+
+    :returns: `bool` of whether the value conforms to the format
+    """
+
+    if isinstance(value, str):
+        return _check_format(value, format_)
+    return FORMAT_CHECKER.conforms(value, format_)
+
+
+def schema_digest(schema_bytes: bytes) -> str:
+    return sha256(schema_bytes).hexdigest()
+
+
+class SchemaCompiler:
+    """Generates Python source of a validation function specialised to a
+    JSON Schema (draft 2020-12)"""
+
+    def __init__(self, schema: dict) -> None:
+        """
+        Schema compiler initializer
+
+        :param schema: `dict` of JSON Schema
+
+        :returns: `None`
+        """
+
+        self.schema = schema
+        self.resources = {}
+        self.functions = {}
+        self.constants = []
+        self.lines = []
+        self.names = 0
+
+        base = schema.get('$id', '') if isinstance(schema, dict) else ''
+        self.base = urldefrag(base)[0]
+        self.collect_resources(schema, self.base)
+
+    def collect_resources(self, schema, base: str) -> None:
+        if isinstance(schema, list):
+            for item in schema:
+                self.collect_resources(item, base)
+            return
+        if not isinstance(schema, dict):
+            return
+
+        if isinstance(schema.get('$id'), str):
+            base = urldefrag(urljoin(base, schema['$id']))[0]
+            self.resources.setdefault(base, schema)
+        if '$anchor' in schema:
+            self.resources[f"{base}#{schema['$anchor']}"] = schema
+
+        for keyword, value in schema.items():
+            if keyword not in ('enum', 'const', 'examples', 'default'):
+                self.collect_resources(value, base)
+
+    def name(self, prefix: str) -> str:
+        self.names += 1
+        return f'{prefix}{self.names}'
+
+    def constant(self, prefix: str, expression: str) -> str:
+        name = self.name(prefix)
+        self.constants.append(f'{name} = {expression}')
+        return name
+
+    def resolve(self, ref: str, base: str) -> tuple:
+        uri = urljoin(base, ref)
+        if uri in self.resources:
+            return self.resources[uri], urldefrag(uri)[0]
+
+        document_uri, fragment = urldefrag(uri)
+        if document_uri not in self.resources and document_uri != self.base:
+            raise SchemaNotCompilable(f'Cannot resolve $ref {ref}')
+        schema = self.resources.get(document_uri, self.schema)
+
+        if fragment and not fragment.startswith('/'):
+            raise SchemaNotCompilable(f'Cannot resolve $ref {ref}')
+        for token in fragment.split('/')[1:]:
+            token = unquote(token).replace('~1', '/').replace('~0', '~')
+            try:
+                schema = schema[int(token) if isinstance(schema, list)
+                                else token]
+            except (KeyError, IndexError, ValueError):
+                raise SchemaNotCompilable(f'Cannot resolve $ref {ref}')
+
+        return schema, document_uri
+
+    def function(self, schema, base: str) -> str:
+        """
+        Get the name of the generated function validating a (sub)schema
+
+        :param schema: `dict` or `bool` of schema
+        :param base: `str` of base URI of the schema
+
+        :returns: `str` of function name
+        """
+
+        key = (id(schema), base)
+        if key not in self.functions:
+            name = self.name('_v')
+            self.functions[key] = name
+            body = self.checks(schema, 'data', base, 1)
+            self.lines.extend([f'def {name}(data):', *body,
+                               '    return True', '', ''])
+        return self.functions[key]
+
+    def checks(self, schema, var: str, base: str, depth: int) -> list:
+        """
+        Generate statements returning `False` if a value is invalid
+
+        :param schema: `dict` or `bool` of schema
+        :param var: `str` of variable holding the value
+        :param base: `str` of base URI of the schema
+        :param depth: `int` of indentation level
+
+        :returns: `list` of source lines
+        """
+
+        pad = '    ' * depth
+
+        if schema is True or schema == {}:
+            return []
+        if schema is False:
+            return [f'{pad}return False']
+        if not isinstance(schema, dict):
+            raise SchemaNotCompilable(f'Invalid schema {schema!r}')
+
+        unknown = set(schema) - ANNOTATIONS - {'$anchor'}
+        for keywords in TYPE_KEYWORDS.values():
+            unknown -= keywords
+        unknown -= {'type', 'enum', 'const', 'format', '$ref', 'allOf',
+                    'anyOf', 'oneOf', 'not', 'if'}
+        if unknown:
+            raise SchemaNotCompilable(f'Unsupported keywords {unknown}')
+
+        if isinstance(schema.get('$id'), str):
+            base = urldefrag(urljoin(base, schema['$id']))[0]
+
+        lines = []
+        known = None
+
+        if 'type' in schema:
+            types = schema['type']
+            if isinstance(types, str):
+                types = [types]
+            tests = [TYPES[t].replace('data', var) for t in types]
+            lines.append(f"{pad}if not ({' or '.join(tests)}):")
+            lines.append(f'{pad}    return False')
+            if len(types) == 1:
+                known = types[0]
+
+        if '$ref' in schema:
+            target, target_base = self.resolve(schema['$ref'], base)
+            lines.append(f'{pad}if not {self.function(target, target_base)}({var}):')  # noqa
+            lines.append(f'{pad}    return False')
+
+        for keyword in ('enum', 'const'):
+            if keyword not in schema:
+                continue
+            values = schema[keyword]
+            if keyword == 'const':
+                values = [values]
+            if all(isinstance(value, str) for value in values):
+                if len(values) == 1:
+                    test = f'{var} == {values[0]!r}'
+                else:
+                    test = f"{var} in {self.constant('_e', f'frozenset({sorted(values)!r})')}"  # noqa
+                lines.append(f'{pad}if not (isinstance({var}, str) and {test}):')  # noqa
+            else:
+                values = self.constant('_e', repr(values))
+                lines.append(f'{pad}if not any(equal({var}, value) for value in {values}):')  # noqa
+            lines.append(f'{pad}    return False')
+
+        if 'format' in schema:
+            lines.append(f"{pad}if not check_format({var}, {schema['format']!r}):")  # noqa
+            lines.append(f'{pad}    return False')
+
+        for type_, keywords in TYPE_KEYWORDS.items():
+            if not keywords & set(schema):
+                continue
+            if known == type_ or (known == 'integer' and type_ == 'number'):
+                lines.extend(getattr(self, f'{type_}_checks')(
+                    schema, var, base, depth))
+                continue
+            body = getattr(self, f'{type_}_checks')(schema, var, base,
+                                                    depth + 1)
+            if body:
+                test = TYPES[type_].replace('data', var)
+                lines.append(f'{pad}if {test}:')
+                lines.extend(body)
+
+        for subschema in schema.get('allOf', []):
+            lines.extend(self.checks(subschema, var, base, depth))
+
+        if 'anyOf' in schema:
+            calls = ' or '.join(f'{self.function(s, base)}({var})'
+                                for s in schema['anyOf'])
+            lines.append(f'{pad}if not ({calls}):')
+            lines.append(f'{pad}    return False')
+
+        if 'oneOf' in schema:
+            calls = ', '.join(f'{self.function(s, base)}({var})'
+                              for s in schema['oneOf'])
+            lines.append(f'{pad}if [{calls}].count(True) != 1:')
+            lines.append(f'{pad}    return False')
+
+        if 'not' in schema:
+            lines.append(f"{pad}if {self.function(schema['not'], base)}({var}):")  # noqa
+            lines.append(f'{pad}    return False')
+
+        if 'if' in schema:
+            then = self.checks(schema.get('then', True), var, base,
+                               depth + 1)
+            else_ = self.checks(schema.get('else', True), var, base,
+                                depth + 1)
+            if then or else_:
+                lines.append(f"{pad}if {self.function(schema['if'], base)}({var}):")  # noqa
+                lines.extend(then or [f'{pad}    pass'])
+                if else_:
+                    lines.append(f'{pad}else:')
+                    lines.extend(else_)
+
+        return lines
+
+    def object_checks(self, schema, var, base, depth) -> list:
+        pad = '    ' * depth
+        lines = []
+
+        required = schema.get('required', [])
+        if required:
+            tests = ' and '.join(f'{key!r} in {var}' for key in required)
+            lines.append(f'{pad}if not ({tests}):')
+            lines.append(f'{pad}    return False')
+
+        for keyword, test in (('minProperties', '<'),
+                              ('maxProperties', '>')):
+            if keyword in schema:
+                lines.append(f'{pad}if len({var}) {test} {schema[keyword]!r}:')  # noqa
+                lines.append(f'{pad}    return False')
+
+        for key, keys in schema.get('dependentRequired', {}).items():
+            tests = ' and '.join(f'{k!r} in {var}' for k in keys) or 'True'
+            lines.append(f'{pad}if {key!r} in {var} and not ({tests}):')
+            lines.append(f'{pad}    return False')
+
+        for key, subschema in schema.get('dependentSchemas', {}).items():
+            body = self.checks(subschema, var, base, depth + 1)
+            if body:
+                lines.append(f'{pad}if {key!r} in {var}:')
+                lines.extend(body)
+
+        properties = schema.get('properties', {})
+        for key, subschema in properties.items():
+            value = self.name('v')
+            body = self.checks(subschema, value, base, depth + 1)
+            if body:
+                lines.append(f'{pad}{value} = {var}.get({key!r}, MISSING)')
+                lines.append(f'{pad}if {value} is not MISSING:')
+                lines.extend(body)
+
+        patterns = schema.get('patternProperties', {})
+        additional = schema.get('additionalProperties', True)
+        names = schema.get('propertyNames', True)
+        if patterns or additional is not True or names is not True:
+            key, value = self.name('k'), self.name('v')
+            lines.append(f'{pad}for {key}, {value} in {var}.items():')
+            if names is not True:
+                lines.append(f'{pad}    if not {self.function(names, base)}({key}):')  # noqa
+                lines.append(f'{pad}        return False')
+            matched = []
+            for pattern, subschema in patterns.items():
+                regex = self.constant('_p', f're.compile({pattern!r})')
+                matched.append(f'{regex}.search({key})')
+                lines.append(f'{pad}    if {matched[-1]} and not {self.function(subschema, base)}({value}):')  # noqa
+                lines.append(f'{pad}        return False')
+            if additional is not True:
+                if properties:
+                    names_ = self.constant(
+                        '_n', f'frozenset({sorted(properties)!r})')
+                    matched.insert(0, f'{key} in {names_}')
+                test = ' or '.join(matched) or 'False'
+                lines.append(f'{pad}    if not ({test}):')
+                body = self.checks(additional, value, base, depth + 2)
+                lines.extend(body or [f'{pad}        pass'])
+
+        return lines
+
+    def array_checks(self, schema, var, base, depth) -> list:
+        pad = '    ' * depth
+        lines = []
+
+        for keyword, test in (('minItems', '<'), ('maxItems', '>')):
+            if keyword in schema:
+                lines.append(f'{pad}if len({var}) {test} {schema[keyword]!r}:')  # noqa
+                lines.append(f'{pad}    return False')
+
+        if schema.get('uniqueItems'):
+            lines.append(f'{pad}if not is_unique({var}):')
+            lines.append(f'{pad}    return False')
+
+        prefix = schema.get('prefixItems', [])
+        for i, subschema in enumerate(prefix):
+            value = self.name('v')
+            body = self.checks(subschema, value, base, depth + 1)
+            if body:
+                lines.append(f'{pad}if len({var}) > {i}:')
+                lines.append(f'{pad}    {value} = {var}[{i}]')
+                lines.extend(body)
+
+        if 'items' in schema:
+            value = self.name('v')
+            body = self.checks(schema['items'], value, base, depth + 1)
+            if body:
+                items = f'{var}[{len(prefix)}:]' if prefix else var
+                lines.append(f'{pad}for {value} in {items}:')
+                lines.extend(body)
+
+        if 'contains' in schema:
+            minimum = schema.get('minContains', 1)
+            maximum = schema.get('maxContains')
+            function = self.function(schema['contains'], base)
+            count = f'sum(1 for item in {var} if {function}(item))'
+            if maximum is None and minimum == 1:
+                lines.append(f'{pad}if not any({function}(item) for item in {var}):')  # noqa
+                lines.append(f'{pad}    return False')
+            else:
+                matches = self.name('c')
+                lines.append(f'{pad}{matches} = {count}')
+                lines.append(f'{pad}if {matches} < {minimum!r}:')
+                lines.append(f'{pad}    return False')
+                if maximum is not None:
+                    lines.append(f'{pad}if {matches} > {maximum!r}:')
+                    lines.append(f'{pad}    return False')
+
+        return lines
+
+    def string_checks(self, schema, var, base, depth) -> list:
+        pad = '    ' * depth
+        lines = []
+
+        for keyword, test in (('minLength', '<'), ('maxLength', '>')):
+            if keyword in schema:
+                lines.append(f'{pad}if len({var}) {test} {schema[keyword]!r}:')  # noqa
+                lines.append(f'{pad}    return False')
+
+        if 'pattern' in schema:
+            regex = self.constant('_p', f"re.compile({schema['pattern']!r})")
+            lines.append(f'{pad}if not {regex}.search({var}):')
+            lines.append(f'{pad}    return False')
+
+        return lines
+
+    def number_checks(self, schema, var, base, depth) -> list:
+        pad = '    ' * depth
+        lines = []
+
+        for keyword, test in (('minimum', '<'), ('maximum', '>'),
+                              ('exclusiveMinimum', '<='),
+                              ('exclusiveMaximum', '>=')):
+            if keyword in schema:
+                lines.append(f'{pad}if {var} {test} {schema[keyword]!r}:')
+                lines.append(f'{pad}    return False')
+
+        if 'multipleOf' in schema:
+            lines.append(f"{pad}if not is_multiple({var}, {schema['multipleOf']!r}):")  # noqa
+            lines.append(f'{pad}    return False')
+
+        return lines
+
+    def compile(self, digest: str) -> str:
+        """
+        Generate the validator module
+
+        :param digest: `str` of SHA-256 digest of the schema document
+
+        :returns: `str` of Python source
+        """
+
+        entry = self.function(self.schema, self.base)
+
+        return '\n'.join([
+            '# Generated by wis2-relay schema sync, do not edit',
+            '',
+            'import re',
+            '',
+            'from wis2_relay.schema_compiler import (check_format, equal,'
+            ' is_integer,',
+            '                                       is_multiple, is_number,'
+            ' is_unique)',
+            '',
+            f'COMPILER_VERSION = {COMPILER_VERSION}',
+            f'SCHEMA_DIGEST = {digest!r}',
+            '',
+            'MISSING = object()',
+            *self.constants,
+            '',
+            '',
+            *self.lines,
+            'def validate(data):',
+            f'    return {entry}(data)',
+            ''
+        ])
+
+
+def compile_schema(schema: dict, digest: str) -> str:
+    """
+    Generate the source of a module with a `validate(data) -> bool`
+    function specialised to a JSON Schema
+
+    The function only decides whether a document is valid, errors are
+    reported by jsonschema.
+
+    :param schema: `dict` of JSON Schema (draft 2020-12)
+    :param digest: `str` of SHA-256 digest of the schema document
+
+    :returns: `str` of Python source
+    """
+
+    return SchemaCompiler(schema).compile(digest)
+
+
+def load_validator(path: Path, digest: str) -> Optional[Callable]:
+    """
+    Load a compiled validator from disk
+
+    :param path: `Path` of generated module
+    :param digest: `str` of SHA-256 digest of the current schema document
+
+    :returns: `validate` function, or `None` if the module is missing or
+              was generated from another schema or compiler version
+    """
+
+    if not path.exists():
+        return None
+
+    spec = importlib.util.spec_from_file_location(
+        'wis2_relay_compiled_schema', path)
+    module = importlib.util.module_from_spec(spec)
+    try:
+        spec.loader.exec_module(module)
+    except Exception as err:
+        LOGGER.warning(f'Cannot load compiled schema {path}: {err}')
+        return None
+
+    if (getattr(module, 'SCHEMA_DIGEST', None) != digest or
+            getattr(module, 'COMPILER_VERSION', None) != COMPILER_VERSION):
+        LOGGER.debug(f'Compiled schema {path} is out of date')
+        return None
+
+    return module.validate
@@ -0,0 +1,336 @@
+###############################################################################
+#
+# Licensed to the Apache Software Foundation (ASF) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The ASF licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+#
+###############################################################################
+
+
+import logging
+import os
+from pathlib import Path
+import queue
+import struct
+import time
+from typing import Tuple, Union
+import zlib
+
+LOGGER = logging.getLogger(__name__)
+
+SPOOL_SEGMENT_SIZE = 64 * 1024 * 1024
+SPOOL_MAX_BYTES = 1024 * 1024 * 1024
+SPOOL_FSYNC = 'interval'
+SPOOL_FSYNC_POLICIES = ['always', 'interval', 'never']
+SPOOL_FSYNC_INTERVAL = 1
+
+# record: length and crc32 of body, body: topic length, topic, payload
+RECORD_HEADER = struct.Struct('<II')
+TOPIC_HEADER = struct.Struct('<H')
+CURSOR = struct.Struct('<QQ')
+
+
+class DiskQueue:
+    """Append-only, segment-based on-disk FIFO queue of (topic, payload)"""
+
+    def __init__(self, path: Union[Path, str],
+                 segment_size: int = SPOOL_SEGMENT_SIZE,
+                 max_bytes: int = SPOOL_MAX_BYTES,
+                 fsync: str = SPOOL_FSYNC,
+                 fsync_interval: float = SPOOL_FSYNC_INTERVAL) -> None:
+        """
+        Disk queue initializer
+
+        Items are appended to numbered segment files and read back in
+        order, a segment being deleted once read.  The read position is
+        saved every `fsync_interval` seconds and when a segment is
+        deleted, so items read less than `fsync_interval` seconds before
+        a crash are read again after it.  Appends and reads not yet synced
+        are pending until the next append or `sync_pending`, which is
+        expected to be called every `fsync_interval` seconds so that a
+        burst followed by silence is synced too.  A torn record at the end of a
+        segment is truncated on recovery.
+
+        The fsync policy applies to appended items: `always` syncs every
+        item to disk, `interval` every `fsync_interval` seconds and
+        `never` leaves it to the operating system.  Items are always
+        written to the operating system, so they survive a process crash.
+
+        :param path: `Path` or `str` of queue directory
+        :param segment_size: `int` of bytes after which a new segment
+                             is started
+        :param max_bytes: `int` of maximum bytes of all segments
+        :param fsync: `str` of fsync policy
+        :param fsync_interval: `float` of seconds between fsyncs
+                               (`interval`) and saves of the read position
+
+        :returns: `None`
+        """
+
+        if fsync not in SPOOL_FSYNC_POLICIES:
+            raise ValueError(f'Invalid spool fsync policy: {fsync}')
+
+        self.path = Path(path)
+        self.segment_size = segment_size
+        self.max_bytes = max_bytes
+        self.fsync = fsync
+        self.fsync_interval = fsync_interval
+
+        self.count = 0
+        self.size = 0
+        self.writer = None
+        self.reader = None
+        self.synced = time.monotonic()
+        self.saved = self.synced
+        self.pending = False
+
+        self.path.mkdir(parents=True, exist_ok=True)
+        self.recover()
+
+    def segment_path(self, segment: int) -> Path:
+        return self.path / f'{segment:010d}.seg'
+
+    def segments(self) -> list:
+        return sorted(int(p.stem) for p in self.path.glob('*.seg'))
+
+    def scan(self, segment: int, offset: int) -> int:
+        """
+        Count the valid records of a segment, truncating a torn tail
+
+        :param segment: `int` of segment number
+        :param offset: `int` of byte offset of the first record
+
+        :returns: `int` of number of records
+        """
+
+        count = 0
+        path = self.segment_path(segment)
+
+        with path.open('rb') as fh:
+            fh.seek(offset)
+            while True:
+                header = fh.read(RECORD_HEADER.size)
+                if not header:
+                    break
+                if len(header) < RECORD_HEADER.size:
+                    break
+                length, crc = RECORD_HEADER.unpack(header)
+                body = fh.read(length)
+                if len(body) < length or zlib.crc32(body) != crc:
+                    break
+                offset += RECORD_HEADER.size + length
+                count += 1
+
+        if offset < path.stat().st_size:
+            LOGGER.warning(f'Truncating {path} at {offset}')
+            os.truncate(path, offset)
+
+        return count
+
+    def recover(self) -> None:
+        """
+        Restore the queue from its directory
+
+        :returns: `None`
+        """
+
+        segments = self.segments()
+        segment, offset = 0, 0
+
+        cursor = self.path / 'cursor'
+        if cursor.exists():
+            segment, offset = CURSOR.unpack(cursor.read_bytes())
+
+        for stale in [s for s in segments if s < segment]:
+            self.segment_path(stale).unlink()
+        segments = [s for s in segments if s >= segment]
+        if not segments or segments[0] != segment:
+            offset = 0
+
+        for s in segments:
+            self.count += self.scan(s, offset if s == segment else 0)
+            self.size += self.segment_path(s).stat().st_size
+
+        if segments:
+            self.read_segment, self.read_offset = segments[0], offset
+            self.write_segment = segments[-1]
+        else:
+            self.read_segment = self.write_segment = segment
+            self.read_offset = 0
+
+        if self.count:
+            LOGGER.info(f'Recovered {self.count} spooled items from {self.path}')  # noqa
+
+        self.writer = self.segment_path(self.write_segment).open('ab')
+
+    def save_cursor(self) -> None:
+        """
+        Atomically save the read position
+
+        :returns: `None`
+        """
+
+        cursor = self.path / 'cursor'
+        tmp = self.path / 'cursor.tmp'
+        tmp.write_bytes(CURSOR.pack(self.read_segment, self.read_offset))
+        os.replace(tmp, cursor)
+        self.saved = time.monotonic()
+
+    def sync(self) -> None:
+        """
+        Flush appended items to disk and save the read position
+
+        :returns: `None`
+        """
+
+        self.writer.flush()
+        if self.fsync != 'never':
+            os.fsync(self.writer.fileno())
+        self.save_cursor()
+        self.synced = self.saved
+        self.pending = False
+
+    def sync_pending(self) -> None:
+        """
+        Sync appended items and the read position not yet synced
+
+        :returns: `None`
+        """
+
+        if self.pending:
+            self.sync()
+
+    def append(self, item: Tuple[str, Union[bytes, str]]) -> None:
+        """
+        Append an item to the queue
+
+        :param item: `tuple` of topic and payload
+
+        :returns: `None`, raises `queue.Full` when `max_bytes` would be
+                  exceeded
+        """
+
+        topic, payload = item
+        topic = topic.encode()
+        if isinstance(payload, str):
+            payload = payload.encode()
+
+        body = TOPIC_HEADER.pack(len(topic)) + topic + payload
+        record = RECORD_HEADER.pack(len(body), zlib.crc32(body)) + body
+
+        if self.size + len(record) > self.max_bytes:
+            raise queue.Full
+
+        if self.writer.tell() >= self.segment_size:
+            self.writer.close()
+            self.write_segment += 1
+            self.writer = self.segment_path(self.write_segment).open('ab')
+
+        self.writer.write(record)
+        self.writer.flush()
+        self.size += len(record)
+        self.count += 1
+
+        if self.fsync == 'always':
+            os.fsync(self.writer.fileno())
+        elif time.monotonic() - self.synced >= self.fsync_interval:
+            self.sync()
+        else:
+            self.pending = True
+
+    def popleft(self) -> Tuple[str, bytes]:
+        """
+        Remove and return the oldest item of the queue
+
+        :returns: `tuple` of topic and payload, raises `IndexError` when
+                  the queue is empty
+        """
+
+        if not self.count:
+            raise IndexError('pop from an empty spool')
+
+        while True:
+            if self.reader is None:
+                self.reader = self.segment_path(self.read_segment).open('rb')
+                self.reader.seek(self.read_offset)
+
+            header = self.reader.read(RECORD_HEADER.size)
+            if header:
+                break
+
+            # end of a fully read segment, continue with the next one
+            self.reader.close()
+            self.reader = None
+            path = self.segment_path(self.read_segment)
+            self.size -= path.stat().st_size
+            path.unlink()
+            self.read_segment += 1
+            self.read_offset = 0
+            self.save_cursor()
+
+        length, crc = RECORD_HEADER.unpack(header)
+        body = self.reader.read(length)
+        self.read_offset += RECORD_HEADER.size + length
+        self.count -= 1
+
+        if not self.count:
+            self.reset()
+        elif time.monotonic() - self.saved >= self.fsync_interval:
+            self.save_cursor()
+        else:
+            self.pending = True
+
+        topic_length, = TOPIC_HEADER.unpack_from(body)
+        topic_end = TOPIC_HEADER.size + topic_length
+        return body[TOPIC_HEADER.size:topic_end].decode(), body[topic_end:]
+
+    def reset(self) -> None:
+        """
+        Start a new segment once all items are read, freeing the disk
+
+        :returns: `None`
+        """
+
+        self.reader.close()
+        self.reader = None
+        self.writer.close()
+
+        for segment in range(self.read_segment, self.write_segment + 1):
+            self.segment_path(segment).unlink(missing_ok=True)
+
+        self.write_segment += 1
+        self.read_segment, self.read_offset = self.write_segment, 0
+        self.size = 0
+        self.writer = self.segment_path(self.write_segment).open('ab')
+        self.save_cursor()
+
+    def close(self) -> None:
+        """
+        Sync and close the queue
+
+        :returns: `None`
+        """
+
+        self.sync()
+        self.writer.close()
+        if self.reader is not None:
+            self.reader.close()
+
+    def __len__(self) -> int:
+        return self.count
+
+    def __repr__(self):
+        return f'<DiskQueue {self.path}>'
@@ -21,7 +21,10 @@
 
 import click
 import csv
+from hashlib import sha256
+import json
 import logging
+import os
 from pathlib import Path
 import shutil
 import zipfile
@@ -36,6 +39,11 @@ TOPIC_SCHEMA_DIR = Path.home() / '.wis2-topic-hierarchy' # noqa
 TOPIC_SCHEMA_FILE = TOPIC_SCHEMA_DIR / 'wis2-topic-hierarchy-bundled.zip'  # noqa
 TOPIC_SCHEMA_ESD = TOPIC_SCHEMA_DIR/ 'earth-system-discipline.csv'  # noqa
 TOPIC_SCHEMA_CENTRE = TOPIC_SCHEMA_DIR/ 'centre-id.csv'  # noqa
+# precompiled lookup sets of the topic hierarchy, written on sync
+TOPIC_INDEX = TOPIC_SCHEMA_DIR / 'wis2-topic-hierarchy-index.json'
+TOPIC_INDEX_VERSION = 1
+# maximum number of distinct topics with a cached verdict
+TOPIC_CACHE_SIZE = 10000
 
 TOPIC_SCHEMA_WIS2 = [
     "origin/a/wis2/xxx/data/core",
@@ -57,6 +65,11 @@ class WIS2TopicHierarchy():
         self.wis2_topic = {}
         self.earth_system = {}
         self.esd_topic_list = []
+        self.cache = {}
+
+        if self.load_index():
+            self.build_trie()
+            return
 
         if not TOPIC_SCHEMA_DIR.exists():
             TOPIC_SCHEMA_DIR.mkdir(parents=True, exist_ok=True)
@@ -66,11 +79,149 @@ class WIS2TopicHierarchy():
             with zipfile.ZipFile(TOPIC_SCHEMA_FILE, "r") as zip_ref:
                 zip_ref.extractall(TOPIC_SCHEMA_DIR)
 
-        self.centre_id = self.centre_id_to_dict(TOPIC_SCHEMA_CENTRE)
-        self.centre_id = self.centre_id_to_dict(TOPIC_SCHEMA_CENTRE)
-        self.wis2_topic = self.wis2_topic_to_dict(TOPIC_SCHEMA_WIS2)
+        self.load_csv()
+        self.build_trie()
+
+        try:
+            self.save_index()
+        except OSError as err:
+            LOGGER.warning(f'Cannot save topic hierarchy index: {err}')
+
+    def build_trie(self) -> None:
+        """
+        Build the topic level tries of the WIS2 topic preambles (with any
+        centre identifier) and of the earth system disciplines
+
+        :returns: `None`
+        """
+
+        self.wis2_trie = {}
+        for topic in self.wis2_topic:
+            node = self.wis2_trie
+            for level in topic.split('/'):
+                node = node.setdefault(level, {})
+            node[None] = True
+
+        self.esd_trie = {}
+        for topic in self.earth_system:
+            node = self.esd_trie
+            for level in topic.split('/'):
+                node = node.setdefault(level, {})
+            node[None] = True
+
+        self.cache = {}
+        # identifies the topic hierarchy, e.g. when reloaded
+        self.version = sha256('\n'.join(
+            sorted(self.centre_id) + sorted(self.earth_system)).encode()
+        ).hexdigest()[:12]
+
+    def verdict(self, topic: str) -> tuple:
+        """
+        Verify a topic, as `get_wis2`, `get_centre_id` and `get_esd` do
+
+        Verdicts are cached per topic.
+
+        :param topic: `str` of topic
+
+        :returns: `tuple` of `bool` of whether the WIS2 preamble, the
+                  centre identifier, the number of levels (of data and
+                  metadata topics) and the earth system discipline are
+                  valid
+        """
+
+        cache = self.cache
+        verdict = cache.get(topic)
+        if verdict is None:
+            if len(cache) >= TOPIC_CACHE_SIZE:
+                cache.clear()
+            verdict = cache[topic] = self.walk(topic.split('/'))
+        return verdict
+
+    def walk(self, levels: list) -> tuple:
+        # preamble: {origin|cache}/a/wis2/{centre_id}/{data|metadata}[/..]
+        node = self.wis2_trie
+        for i, level in enumerate(levels[:6]):
+            node = node.get('xxx' if i == 3 else level)
+            if node is None:
+                break
+        preamble = node is not None and None in node
+
+        centre_id = len(levels) > 3 and levels[3] in self.centre_id
+
+        depth = len(levels)
+        if len(levels) > 4 and levels[4] == 'metadata':
+            depth = depth not in (6, 7)
+        elif len(levels) > 4 and levels[4] == 'data':
+            depth = depth >= 8
+        else:
+            depth = True
+
+        esd = True
+        if len(levels) > 7:
+            esd_levels = levels[6:]
+            if esd_levels[1] == 'experimental':
+                esd_levels = esd_levels[:2]
+            node = self.esd_trie
+            for level in esd_levels:
+                node = node.get(level)
+                if node is None:
+                    break
+            esd = node is not None and None in node
+
+        return (preamble, centre_id, depth, esd)
+
+    def load_csv(self) -> None:
+        self.centre_id = frozenset(self.centre_id_to_dict(TOPIC_SCHEMA_CENTRE))
+        self.wis2_topic = frozenset(self.wis2_topic_to_dict(TOPIC_SCHEMA_WIS2))
+        self.esd_topic_list = []
         self.flatten_dict(self.esd_to_dict(TOPIC_SCHEMA_ESD), [])
-        self.earth_system = self.list_to_dict(self.esd_topic_list)
+        self.earth_system = frozenset(self.list_to_dict(self.esd_topic_list))
+
+    def load_index(self) -> bool:
+        """
+        Load the topic hierarchy from its precompiled index
+
+        :returns: `bool` of whether a current index was loaded
+        """
+
+        try:
+            with TOPIC_INDEX.open() as fh:
+                index = json.load(fh)
+            indexed = TOPIC_INDEX.stat().st_mtime
+            for source in (TOPIC_SCHEMA_CENTRE, TOPIC_SCHEMA_ESD):
+                if source.exists() and source.stat().st_mtime > indexed:
+                    LOGGER.debug(f'{source} changed since indexed')
+                    return False
+        except (OSError, ValueError) as err:
+            LOGGER.debug(f'No topic hierarchy index: {err}')
+            return False
+
+        if index.get('version') != TOPIC_INDEX_VERSION:
+            LOGGER.debug('Topic hierarchy index version changed')
+            return False
+
+        self.centre_id = frozenset(index['centre_id'])
+        self.wis2_topic = frozenset(TOPIC_SCHEMA_WIS2)
+        self.earth_system = frozenset(index['earth_system'])
+        return True
+
+    def save_index(self) -> None:
+        """
+        Save the topic hierarchy as a precompiled index
+
+        :returns: `None`
+        """
+
+        index = {
+            'version': TOPIC_INDEX_VERSION,
+            'centre_id': sorted(self.centre_id),
+            'earth_system': sorted(self.earth_system)
+        }
+
+        tmp = TOPIC_INDEX.with_suffix('.tmp')
+        with tmp.open('w') as fh:
+            json.dump(index, fh, separators=(',', ':'))
+        os.replace(tmp, TOPIC_INDEX)
 
     def get_esd(self, topic):
         if topic[1] == "experimental":
@@ -81,7 +232,7 @@ class WIS2TopicHierarchy():
             return False
 
     def get_wis2(self, topic):
-        topic[3] = "xxx"
+        topic = topic[:3] + ["xxx"] + topic[4:]
         if "/".join(topic) in self.wis2_topic:
             return True
         else:
@@ -158,10 +309,9 @@ class WIS2TopicHierarchy():
         with zipfile.ZipFile(TOPIC_SCHEMA_FILE, "r") as zip_ref:
             zip_ref.extractall(TOPIC_SCHEMA_DIR)
 
-        self.centre_id = self.centre_id_to_dict(TOPIC_SCHEMA_CENTRE)
-        self.wis2_topic = self.wis2_topic_to_dict(TOPIC_SCHEMA_WIS2)
-        self.flatten_dict(self.esd_to_dict(TOPIC_SCHEMA_ESD), [])
-        self.earth_system = self.list_to_dict(self.esd_topic_list)
+        self.load_csv()
+        self.build_trie()
+        self.save_index()
 
 
 @click.group()
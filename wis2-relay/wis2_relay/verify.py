@@ -19,14 +19,34 @@
 #
 ###############################################################################
 
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
 import json
 import logging
-from typing import Tuple
+import multiprocessing
+import queue
+import random
+import threading
+import time
+from typing import Any, Callable, Optional, Tuple
 from jsonschema.validators import Draft202012Validator
-from wis2_relay.schema import MESSAGE_SCHEMA
+from wis2_relay.schema import (MESSAGE_SCHEMA, MESSAGE_VALIDATOR,
+                               compile_validator)
+from wis2_relay.schema_compiler import load_validator, schema_digest
 
 LOGGER = logging.getLogger(__name__)
 
+VALIDATE_WORKERS = 0
+VALIDATE_BATCH_SIZE = 50
+VALIDATE_WINDOW = 0.002
+VALIDATE_MAX_PENDING = 5000
+VALIDATE_SAMPLE_RATE = 1
+VALIDATE_SAMPLE_COOLDOWN = 3600
+
+# validator of a validation pool worker process
+_validator = None
+
 
 class WNMValidate:
     def __init__(self) -> None:
@@ -35,15 +55,34 @@ class WNMValidate:
             LOGGER.error(msg)
             raise RuntimeError(msg)
 
-        with open(MESSAGE_SCHEMA) as fh:
-            self.schema = json.load(fh)
-            self.validator = Draft202012Validator(
-                self.schema, format_checker=Draft202012Validator.FORMAT_CHECKER)  # noqa
+        schema_bytes = MESSAGE_SCHEMA.read_bytes()
+        self.schema = json.loads(schema_bytes)
+        self.validator = Draft202012Validator(
+            self.schema, format_checker=Draft202012Validator.FORMAT_CHECKER)
+
+        # valid messages are accepted by the compiled schema, jsonschema
+        # reports the errors of invalid messages
+        digest = schema_digest(schema_bytes)
+        self.version = digest[:12]
+        self.compiled = load_validator(MESSAGE_VALIDATOR, digest)
+        if self.compiled is None:
+            try:
+                if compile_validator():
+                    self.compiled = load_validator(MESSAGE_VALIDATOR, digest)
+            except OSError as err:
+                LOGGER.warning(f'Cannot compile schema: {err}')
 
     def validate_message(self, message: dict) -> Tuple[bool, str]:
         success = False
         error_message = None
 
+        if self.compiled is not None:
+            try:
+                if self.compiled(message):
+                    return (True, None)
+            except Exception as err:
+                LOGGER.debug(f'Compiled schema failed: {err}')
+
         try:
             self.validator.validate(message)
             success = True
@@ -51,3 +90,329 @@ class WNMValidate:
             error_message = repr(err)
 
         return (success, error_message)
+
+
+class ValidationSampler:
+    """Validates a sample of the messages of centres with a clean recent
+    history"""
+
+    def __init__(self, rate: float = VALIDATE_SAMPLE_RATE,
+                 cooldown: float = VALIDATE_SAMPLE_COOLDOWN,
+                 metrics=None, report_by: str = None) -> None:
+        """
+        Validation sampler initializer
+
+        Messages of a centre are all validated for `cooldown` seconds
+        after its first message and after each invalid message, and
+        sampled at `rate` otherwise.
+
+        :param rate: `float` of fraction of messages validated of centres
+                     with a clean history
+        :param cooldown: `float` of seconds of full validation
+        :param metrics: `RelayMetricAggregator` to report validation rates
+                        to, per centre
+        :param report_by: `str` of centre identifier reporting metrics
+
+        :returns: `None`
+        """
+
+        self.rate = rate
+        self.cooldown = cooldown
+        self.metrics = metrics
+        self.report_by = report_by
+        self.full_until = {}
+        self.counts = {}
+        self.lock = threading.Lock()
+
+        if metrics is not None:
+            metrics.add_collector(self.collect)
+
+    def sample(self, centre_id: str) -> bool:
+        """
+        Decide whether to validate a message
+
+        :param centre_id: `str` of centre identifier of the topic
+
+        :returns: `bool` of whether to validate the message
+        """
+
+        now = time.monotonic()
+        with self.lock:
+            full_until = self.full_until.get(centre_id)
+            if full_until is None:
+                full_until = self.full_until[centre_id] = now + self.cooldown
+            validate = now < full_until or random.random() < self.rate
+
+            counts = self.counts.get(centre_id)
+            if counts is None:
+                counts = self.counts[centre_id] = [0, 0]
+            counts[0] += 1
+            counts[1] += validate
+
+        return validate
+
+    def invalid(self, centre_id: str) -> None:
+        """
+        Return a centre to full validation after an invalid message
+
+        :param centre_id: `str` of centre identifier of the topic
+
+        :returns: `None`
+        """
+
+        with self.lock:
+            self.full_until[centre_id] = time.monotonic() + self.cooldown
+
+    def collect(self) -> None:
+        with self.lock:
+            counts, self.counts = self.counts, {}
+
+        for centre_id, (received, validated) in counts.items():
+            self.metrics.record('validation_rate',
+                                [centre_id, self.report_by],
+                                validated / received)
+
+
+def _init_worker() -> None:
+    global _validator
+    _validator = WNMValidate()
+
+
+def _validate_batch(payloads: list, version: str = None) -> list:
+    """
+    Validate a batch of raw messages in a validation pool worker
+
+    :param payloads: `list` of `bytes` of messages
+    :param version: `str` of version of the schema of the relay, the
+                    worker reloads the schema when it differs
+
+    :returns: `list` of `tuple` of success and error message
+    """
+
+    global _validator
+    if version is not None and version != _validator.version:
+        _validator = WNMValidate()
+
+    verdicts = []
+    for payload in payloads:
+        try:
+            message = json.loads(payload)
+        except ValueError as err:
+            verdicts.append((False, repr(err)))
+            continue
+        verdicts.append(_validator.validate_message(message))
+
+    return verdicts
+
+
+class ValidationPool(threading.Thread):
+    """Validates messages in batches in a pool of worker processes"""
+
+    def __init__(self, workers: int, batch_size: int = VALIDATE_BATCH_SIZE,
+                 window: float = VALIDATE_WINDOW,
+                 max_pending: int = VALIDATE_MAX_PENDING) -> None:
+        """
+        Validation pool initializer
+
+        :param workers: `int` of number of worker processes
+        :param batch_size: `int` of maximum number of messages per batch
+        :param window: `float` of seconds to collect messages of a batch
+        :param max_pending: `int` of maximum number of messages queued or
+                            being validated by the pool
+
+        :returns: `None`
+        """
+
+        threading.Thread.__init__(self, daemon=True)
+        # workers must not inherit the (locked) state of relay threads
+        self.executor = ProcessPoolExecutor(
+            workers, multiprocessing.get_context('spawn'),
+            initializer=_init_worker)
+        self.batch_size = batch_size
+        self.window = window
+        self.max_pending = max_pending
+        self.pending = 0
+        # schema version of the relay, set when the schema is reloaded
+        self.version = None
+        self.queue = queue.Queue()
+        self.lock = threading.Lock()
+
+    def submit(self, payload: bytes,
+               callback: Callable[[Optional[tuple]], None]) -> bool:
+        """
+        Queue a message for validation
+
+        The callback is invoked from a pool thread with the verdict of
+        `WNMValidate.validate_message`, or `None` if the pool failed and
+        the message must be validated in process.
+
+        :param payload: `bytes` of message
+        :param callback: callable receiving the verdict
+
+        :returns: `bool` of whether the message was queued, `False` when
+                  the pool is saturated
+        """
+
+        with self.lock:
+            if self.pending >= self.max_pending:
+                return False
+            self.pending += 1
+
+        self.queue.put((payload, callback))
+        return True
+
+    def next_batch(self) -> list:
+        batch = [self.queue.get()]
+        deadline = time.monotonic() + self.window
+
+        while len(batch) < self.batch_size:
+            timeout = deadline - time.monotonic()
+            try:
+                if timeout > 0:
+                    batch.append(self.queue.get(timeout=timeout))
+                else:
+                    batch.append(self.queue.get_nowait())
+            except queue.Empty:
+                break
+
+        return batch
+
+    def on_verdicts(self, batch: list, future) -> None:
+        try:
+            verdicts = future.result()
+        except Exception as err:
+            LOGGER.error(f'Validation pool failed: {err}')
+            verdicts = [None] * len(batch)
+
+        with self.lock:
+            self.pending -= len(batch)
+
+        for (_, callback), verdict in zip(batch, verdicts):
+            callback(verdict)
+
+    def run(self) -> None:
+        while True:
+            batch = self.next_batch()
+            try:
+                future = self.executor.submit(
+                    _validate_batch, [payload for payload, _ in batch],
+                    self.version)
+            except RuntimeError as err:
+                LOGGER.error(f'Validation pool failed: {err}')
+                with self.lock:
+                    self.pending -= len(batch)
+                for _, callback in batch:
+                    callback(None)
+                continue
+
+            future.add_done_callback(partial(self.on_verdicts, batch))
+
+
+class ValidationSequence:
+    """Validates the messages of an upstream in a ValidationPool and
+    releases them in arrival order"""
+
+    def __init__(self, pool: ValidationPool, wnm_schema,
+                 process_mesg: Callable[[str, bytes], None],
+                 process_metric: Callable[..., None],
+                 threadsafe: Callable[..., Any] = None,
+                 sampler: ValidationSampler = None) -> None:
+        """
+        Validation sequence initializer
+
+        :param pool: `ValidationPool` of worker processes
+        :param wnm_schema: `Reloadable` of `WNMValidate` of in-process
+                           validator, used when the pool is saturated
+        :param process_mesg: callable publishing a valid message
+        :param process_metric: callable to report metrics
+        :param threadsafe: callable scheduling verdicts of the pool in
+                           the thread of the caller (e.g.
+                           `loop.call_soon_threadsafe`), `None` to release
+                           messages from the pool thread
+        :param sampler: `ValidationSampler` to report invalid messages to
+
+        :returns: `None`
+        """
+
+        self.pool = pool
+        self.wnm_schema = wnm_schema
+        self.process_mesg = process_mesg
+        self.process_metric = process_metric
+        self.threadsafe = threadsafe
+        self.sampler = sampler
+        self.pending = deque()
+        self.releasing = False
+        self.lock = threading.Lock()
+
+    def validate(self, topic: str, mesg, centre_id: str,
+                 done: Callable[[bool], None] = None) -> None:
+        """
+        Validate a message and publish it if valid, after any earlier
+        message of the upstream
+
+        :param topic: `str` of topic
+        :param mesg: `WNMessage` of message
+        :param centre_id: `str` of centre identifier of the topic
+        :param done: callable receiving whether the message is valid, in
+                     order, instead of publishing it
+
+        :returns: `None`
+        """
+
+        item = [topic, mesg, centre_id, done, None]
+        with self.lock:
+            self.pending.append(item)
+
+        callback = partial(self.on_verdict, item)
+        if self.threadsafe is not None:
+            callback = partial(self.threadsafe, callback)
+
+        if not self.pool.submit(mesg.raw, callback):
+            self.process_metric('validate_fallback_total')
+            self.on_verdict(item, None)
+
+    def on_verdict(self, item: list, verdict: Optional[tuple]) -> None:
+        if verdict is None:
+            try:
+                verdict = self.wnm_schema.get().validate_message(
+                    item[1].dict)
+            except ValueError as err:
+                verdict = (False, repr(err))
+
+        with self.lock:
+            item[4] = verdict
+            # a single caller releases messages at a time, outside the lock,
+            # later verdicts are released by its loop
+            if self.releasing:
+                return
+            self.releasing = True
+
+        try:
+            while True:
+                with self.lock:
+                    ready = []
+                    while self.pending and self.pending[0][4] is not None:
+                        ready.append(self.pending.popleft())
+                    if not ready:
+                        self.releasing = False
+                        return
+
+                for topic, mesg, centre_id, done, (success, err) in ready:
+                    self.release(topic, mesg, centre_id, done, success, err)
+        except Exception:
+            with self.lock:
+                self.releasing = False
+            raise
+
+    def release(self, topic: str, mesg, centre_id: str,
+                done: Optional[Callable[[bool], None]], success: bool,
+                err: Optional[str]) -> None:
+        if not success:
+            LOGGER.error(f'Message is not valid. Centre: {centre_id} Error: {err}')  # noqa
+            self.process_metric('invalid_format_total')
+            if self.sampler is not None:
+                self.sampler.invalid(centre_id)
+        if done is not None:
+            done(success)
+        elif success:
+            self.process_mesg(topic, mesg.payload)